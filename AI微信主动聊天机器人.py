@@ -2,12 +2,29 @@ import httpx
 import json
 import time
 import base64
+import hashlib
 import os
+import sys
 import io
 import threading
+import queue
+import heapq
+import bisect
+import itertools
+import weakref
 import re
+import zlib
+import shutil
+import unicodedata
+import sqlite3
+import contextlib
+import atexit
+import logging
+import logging.handlers
 from PIL import Image
 import datetime
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import random
 import websocket
 
@@ -26,14 +43,804 @@ conversation_history = [
 AI_API_URL = "https://zzzzapi.com/v1/chat/completions"
 AI_API_KEY = ""
 
-# 发送微信文本消息
-def send_wechat_message(to_user, message, token):
+# 对话历史持久化配置
+HISTORY_COMPACT_THRESHOLD = 200  # 日志累积到该条数后在后台合并为快照
+HISTORY_JOURNAL_FSYNC = False  # 每条日志写入后是否立即fsync（更安全，但更慢）
+
+# WebSocket重连配置
+WS_RECONNECT_BASE_DELAY = 1  # 首次重连的等待秒数（之后指数增长，并加入随机抖动）
+WS_RECONNECT_MAX_DELAY = 60  # 重连等待的最长秒数（不限制重连次数）
+WS_WATCHDOG_INTERVAL = 10  # 看门狗检查连接状态的间隔秒数
+WS_STALE_TIMEOUT = 90  # 超过该秒数没有收到任何消息或pong时，视为连接假死并重连
+WS_CATCHUP_MAX_ROUNDS = 10  # 重连后通过HTTP同步接口补拉消息的最大轮数
+
+# 多账号配置
+ACCOUNTS_FILE = "accounts.json"  # 存在该文件时以多账号模式运行，从中读取各账号的token等配置
+
+# 会话存储配置
+SESSION_DIR = "sessions"  # 每个联系人的对话历史保存目录
+SESSION_MAX_LOADED = 500  # 内存中最多保留的会话数
+SESSION_MAX_MEMORY = 64 * 1024 * 1024  # 内存中会话消息的总字节数上限（估算值）
+SESSION_MIN_IDLE = 30  # 会话至少闲置多少秒才会被换出内存
+STORAGE_BACKEND = "sqlite"  # 对话历史的存储方式：sqlite（单个数据库文件）或json（每个会话一个文件）
+SQLITE_DB_FILE = "history.db"  # 会话目录下的数据库文件名（同时保存主动发言判断和token用量），多账号时所有账号共用一个
+SQLITE_BATCH_SIZE = 1000  # 写线程每个事务最多提交的写入数
+SQLITE_MAX_RETRIES = 5  # 事务提交失败（数据库被锁、磁盘错误等）后的最大重试次数
+SQLITE_RETRY_DELAY = 0.1  # 首次重试的等待秒数（之后每次翻倍，最长5秒）
+
+# 消息处理流水线配置
+PIPELINE_WORKERS = 8  # 并发生成回复的工作线程数（不同联系人之间并发）
+
+# 上下文窗口配置
+CONTEXT_TOKEN_BUDGET = 8000  # 每次请求的总token预算（系统提示词+历史+回复）
+RESPONSE_TOKEN_RESERVE = 1024  # 为模型回复预留的token数
+MESSAGE_TOKEN_OVERHEAD = 4  # 每条消息的格式开销（role等字段）
+
+# 滚动摘要配置
+SUMMARY_ENABLED = True  # 移出上下文窗口的旧消息在后台生成摘要，代替原始消息放入提示词
+SUMMARY_BLOCK_SIZE = 10  # 每累积多少条移出窗口的消息生成一段摘要
+SUMMARY_MAX_BLOCKS = 4  # 分段摘要超过该数量时，把最早的几段合并进总摘要
+SUMMARY_WORKERS = 2  # 后台生成摘要的线程数
+SUMMARY_MAX_PENDING = 50  # 待摘要消息的最大条数，摘要持续失败时丢弃最早的消息
+SUMMARY_RETRY_DELAY = 60  # 摘要失败后首次重试的等待秒数（之后每次翻倍，最长1小时）
+
+# 自主消息分析门控配置
+AUTONOMOUS_MIN_IDLE = 120  # 用户最后一条消息之后至少闲置多少秒才分析是否主动发言
+AUTONOMOUS_MAX_BACKOFF = 3600  # 连续判定“不发言”后，重新分析同一对话状态的最长等待秒数
+AUTONOMOUS_MAX_UNANSWERED = 2  # 用户未回复时最多连续发送的主动消息数
+AUTONOMOUS_WORKERS = 4  # 并发执行主动发言分析的线程数（所有联系人共用）
+AUTONOMOUS_RECHECK_DELAY = 5  # 分析条件暂不满足（如连接未就绪）时的重试间隔秒数
+AUTONOMOUS_PER_CONTACT = True  # 多账号模式下未指定target的账号，为每个私聊联系人分别判断是否主动发言
+AUTONOMOUS_COMBINED_MODE = True  # 一次请求同时返回是否发言和消息内容（结构化输出），代替“分析+生成”两次请求
+
+# 自主消息结构化输出格式
+AUTONOMOUS_DECISION_SCHEMA = {
+    "name": "autonomous_decision",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "shouldSendMessage": {"type": "boolean"},
+            "reason": {"type": "string"},
+            "messageType": {"type": "string"},
+            "message": {"type": "string"}
+        },
+        "required": ["shouldSendMessage", "reason", "messageType", "message"],
+        "additionalProperties": False
+    }
+}
+
+# 流式回复配置
+STREAM_REPLIES = True  # 流式生成回复，每完成一个句子/段落就发送一条微信消息
+STREAM_MIN_CHUNK_CHARS = 8  # 分段发送的最小字数，过短的句子会与后文合并发送
+STREAM_INTERRUPTED_MARK = "……（回复中断）"  # 流式回复中途出错时，追加在已发出部分之后写入对话历史
+
+# 角色卡库配置
+CARD_LIBRARY_DIR = "cards"  # 角色卡库目录（支持子目录中的JSON和PNG角色卡）
+CARD_LIBRARY_INDEX = "card_index.json"  # 角色卡索引文件
+CARD_LIBRARY_CACHE_SIZE = 32  # 内存中缓存的已编译角色卡数量
+
+# 连发消息合并配置
+BURST_QUIET_PERIOD = 2.0  # 同一联系人停止发送多少秒后，把这段时间内的消息合并为一轮对话（0表示不合并）
+BURST_MAX_WAIT = 8.0  # 从第一条消息开始最多等待的秒数，避免用户持续发送时迟迟不回复
+
+# 群聊配置
+GROUP_REPLY_ENABLED = True  # 是否回复群聊消息
+GROUP_BOT_NAMES = []  # 机器人在群里的昵称，用于识别“@昵称”（角色名称会自动加入）
+GROUP_TRIGGER_KEYWORDS = []  # 群消息包含这些关键词时回复（角色名称会自动加入）
+GROUP_REPLY_PROBABILITY = 0.0  # 没有@机器人、也没有命中关键词的群消息按该概率回复
+GROUP_COOLDOWN = 60  # 同一个群两次回复之间至少间隔的秒数（@机器人的消息不受限制）
+GROUP_CONTEXT_MESSAGES = 20  # 回复群消息时附带的群内最近消息数（所有成员）
+GROUP_MAX_ROOMS = 1000  # 内存中最多保留最近消息的群数
+
+# 回复缓存配置（默认关闭）
+RESPONSE_CACHE_ENABLED = False  # 对同一角色卡、相同的短消息和相同的最近上下文直接使用缓存的回复
+RESPONSE_CACHE_TTL = 6 * 3600  # 缓存回复的有效秒数
+RESPONSE_CACHE_MAX_ENTRIES = 2000  # 最多缓存的消息数（超出时淘汰最久未使用的）
+RESPONSE_CACHE_CONTEXT_MESSAGES = 2  # 计算缓存键时包含的最近消息条数
+RESPONSE_CACHE_MAX_MESSAGE_CHARS = 20  # 只缓存不超过该字数的用户消息（开场白、问候、表情等）
+RESPONSE_CACHE_VARIANTS = 3  # 每个缓存键保留的不同回复数，攒够后随机选用，避免回复千篇一律
+
+# 消息去重配置
+DEDUP_TTL = 600  # 已处理的消息ID保留秒数
+DEDUP_CONTENT_WINDOW = 5  # 消息没有ID时，同一发送者的相同内容在该秒数内视为重复
+DEDUP_MAX_ENTRIES = 50000  # 去重缓存的最大条目数
+
+# 发送限速与批量发送配置
+OUTBOUND_CONTACT_RATE = 1.0  # 每个联系人每秒最多发送的消息数
+OUTBOUND_CONTACT_BURST = 5  # 每个联系人允许的突发条数
+OUTBOUND_ACCOUNT_RATE = 3.0  # 每个微信账号每秒最多发送的消息数
+OUTBOUND_ACCOUNT_BURST = 10  # 每个微信账号允许的突发条数
+OUTBOUND_BATCH_SIZE = 10  # 一次SendTextMessage请求最多包含的MsgItem数
+OUTBOUND_BATCH_LINGER = 0.05  # 收到第一条消息后等待多少秒以便合并更多消息
+OUTBOUND_MAX_RETRIES = 3  # 单条消息发送失败后的最大重试次数
+OUTBOUND_RETRY_DELAY = 1.0  # 首次重试的等待秒数（之后每次翻倍）
+OUTBOUND_SEND_TIMEOUT = 120  # 调用方等待发送结果的最长秒数
+OUTBOUND_WORKERS = 4  # 并发发送请求的线程数（不同账号之间并发，一个账号请求慢不影响其他账号）
+
+# 监控指标配置
+METRICS_ENABLED = True  # 记录各处理阶段的耗时、计数和队列长度
+METRICS_HOST = "127.0.0.1"  # 指标接口只监听本机
+METRICS_PORT = 9108  # 以Prometheus文本格式在 http://127.0.0.1:9108/metrics 提供指标（0表示不启动接口）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # 耗时直方图的分桶上限（秒）
+
+# 日志配置
+LOG_LEVEL = "INFO"  # 控制台日志级别
+LOG_FILE = os.path.join("logs", "bot.log")  # 结构化日志文件（每行一个JSON），为空时不写文件
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024  # 日志文件超过该大小时轮转
+LOG_FILE_BACKUPS = 5  # 保留的历史日志文件数
+LOG_QUEUE_SIZE = 10000  # 日志队列容量，写入跟不上时丢弃新记录，不阻塞消息处理
+DEBUG_SAMPLE_RATE = 0.1  # 调试模式下保存原始消息帧的采样比例（1表示全部保存）
+DEBUG_FRAME_BUFFER = 500  # 内存中保留的最近原始消息帧数
+DEBUG_DUMP_DIR = "logs"  # 导出原始消息帧的目录
+
+# HTTP连接池配置（wechat: WeChatPadPro服务，ai: AI接口）
+HTTP_POOL_CONFIG = {
+    "wechat": {
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "keepalive_expiry": 60,  # 空闲连接保留秒数
+        "connect_timeout": 5,
+        "timeout": 15,
+        "http2": False
+    },
+    "ai": {
+        "max_connections": 50,
+        "max_keepalive_connections": 20,
+        "keepalive_expiry": 120,
+        "connect_timeout": 10,
+        "timeout": 120,  # 大模型生成较慢，读取超时需要更长
+        "http2": True  # 需要安装h2（pip install httpx[http2]），未安装时自动使用HTTP/1.1
+    }
+}
+
+# 日志
+logger = logging.getLogger("wechat_ai")
+
+def log_event(event, message, level=logging.INFO, exc_info=False, **fields):
     """
-    发送微信消息
-    :param to_user: 接收者ID (wxid或特殊ID如filehelper)
-    :param message: 要发送的消息内容
+    记录一条结构化日志
+    :param event: 事件名，便于在JSON日志中检索
+    :param message: 显示在控制台的文本
+    :param exc_info: 是否附带当前异常的堆栈
+    :param fields: 写入JSON日志的附加字段（wxid、耗时等）
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, exc_info=exc_info, extra={"event": event, "fields": fields})
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行JSON：时间、级别、线程、事件名、文本和附加字段"""
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """把日志记录放入有界队列，由后台线程输出；队列满时丢弃记录，调用线程从不等待"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("log_records_dropped_total")
+
+_log_listener = None
+
+def setup_logging(level=LOG_LEVEL, log_file=LOG_FILE):
+    """配置异步日志：控制台输出可读文本，日志文件写入结构化JSON（调试记录只写入文件）"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    console.setLevel(level)
+    handlers = [console]
+    
+    if log_file:
+        try:
+            if os.path.dirname(log_file):
+                os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+            file_handler.setFormatter(JsonLogFormatter())
+            handlers.append(file_handler)
+        except OSError as e:
+            print(f"无法写入日志文件 {log_file}: {e}")
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    # 退出前输出队列中剩余的日志
+    atexit.register(_log_listener.stop)
+
+# 调试用的原始消息帧
+class FrameCapture:
+    """调试模式下按采样率保存收到的原始消息帧（不解析、不重新序列化），只保留最近的若干条，需要时导出到文件"""
+    def __init__(self, sample_rate=DEBUG_SAMPLE_RATE, max_frames=DEBUG_FRAME_BUFFER):
+        self.sample_rate = sample_rate
+        self.frames = deque(maxlen=max_frames)  # (时间, 账号, 原始帧)
+        self.seen = 0
+        self.captured = 0
+    
+    def capture(self, raw, account=None):
+        """按采样率保存一帧，返回是否保存"""
+        self.seen += 1
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        self.frames.append((time.time(), account, raw))
+        self.captured += 1
+        return True
+    
+    def dump(self, path=None):
+        """把缓冲区中的帧写入文件（每行一个JSON），返回(文件路径, 帧数)"""
+        frames = list(self.frames)
+        if path is None:
+            os.makedirs(DEBUG_DUMP_DIR, exist_ok=True)
+            path = os.path.join(DEBUG_DUMP_DIR, f"frames-{datetime.datetime.now():%Y%m%d-%H%M%S}.jsonl")
+        
+        with open(path, 'w', encoding='utf-8') as f:
+            for ts, account, raw in frames:
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf-8', errors='replace')
+                f.write(json.dumps({"ts": ts, "account": account, "frame": raw}, ensure_ascii=False) + "\n")
+        return path, len(frames)
+
+frame_capture = FrameCapture()
+
+def set_debug_logging(enabled):
+    """调试模式下记录DEBUG级别日志（只写入日志文件，控制台仍按LOG_LEVEL输出）"""
+    logger.setLevel(logging.DEBUG if enabled else LOG_LEVEL)
+
+# 监控指标
+class MetricsRegistry:
+    """
+    进程内的监控指标：计数器、耗时直方图，以及导出时才读取的仪表（队列长度等），
+    以Prometheus文本格式导出
+    """
+    def __init__(self, namespace="wechat_ai", buckets=METRICS_LATENCY_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.descriptions = {}  # 指标名 -> (类型, 说明)
+        self.counters = {}  # (指标名, 标签) -> 累计值
+        self.histograms = {}  # (指标名, 标签) -> 各桶计数（最后一个为+Inf）+ [总和]
+        self.gauges = {}  # 指标名 -> 读取函数
+        self.lock = threading.Lock()
+    
+    def describe(self, name, kind, help_text):
+        """登记指标的类型和说明"""
+        self.descriptions[name] = (kind, help_text)
+    
+    def gauge(self, name, help_text, func):
+        """
+        登记仪表：导出时调用func()读取当前值
+        func返回数值，或[(标签字典, 数值), ...]
+        """
+        self.describe(name, "gauge", help_text)
+        self.gauges[name] = func
+    
+    def inc(self, name, value=1, **labels):
+        """计数器增加value"""
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        """直方图记录一个观测值（秒）"""
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+    
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """记录with块的执行耗时（出现异常时同样记录）"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+    
+    def histogram_stats(self, name):
+        """返回直方图各标签组合的(次数, 总耗时)"""
+        with self.lock:
+            return {labels: (sum(counts[:-1]), counts[-1])
+                    for (metric, labels), counts in self.histograms.items() if metric == name}
+    
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}"
+    
+    def render(self):
+        """生成Prometheus文本格式的全部指标"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        
+        samples = {}  # 指标名 -> [(后缀, 标签, 数值)]
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(("", labels, value))
+        
+        for (name, labels), counts in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                lines.append(("_bucket", labels + (("le", str(bound)),), cumulative))
+            lines.append(("_sum", labels, counts[-1]))
+            lines.append(("_count", labels, cumulative))
+        
+        # 仪表在导出时读取，读取失败的跳过
+        for name, func in list(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                log_event("metrics_error", f"读取监控指标{name}失败: {e}", logging.WARNING, metric=name)
+                continue
+            if isinstance(value, (int, float)):
+                value = [({}, value)]
+            samples[name] = [("", tuple(sorted(labels.items())), v) for labels, v in value]
+        
+        output = []
+        for name in sorted(samples):
+            full_name = f"{self.namespace}_{name}"
+            kind, help_text = self.descriptions.get(name, ("untyped", ""))
+            if help_text:
+                output.append(f"# HELP {full_name} {help_text}")
+            output.append(f"# TYPE {full_name} {kind}")
+            for suffix, labels, value in samples[name]:
+                output.append(f"{full_name}{suffix}{self._format_labels(labels)} {value}")
+        return "\n".join(output) + "\n"
+
+metrics = MetricsRegistry()
+
+# 各处理阶段的指标（仪表在相关对象创建后登记）
+metrics.describe("ws_message_handle_seconds", "histogram", "WebSocket消息从解析到放入合并缓冲区的耗时")
+metrics.describe("messages_received_total", "counter", "收到并进入处理流程的消息数")
+metrics.describe("messages_caught_up_total", "counter", "重连后通过HTTP同步接口补拉到的消息数")
+metrics.describe("dedup_hits_total", "counter", "被去重过滤的重复消息数")
+metrics.describe("group_messages_total", "counter", "群消息经过回复门控的结果（只有回复的消息会调用AI）")
+metrics.describe("burst_wait_seconds", "histogram", "连发消息从第一条到合并处理的等待时间")
+metrics.describe("pipeline_queue_wait_seconds", "histogram", "任务在流水线中排队等待工作线程的时间")
+metrics.describe("reply_generate_seconds", "histogram", "生成一轮回复（含流式发送）的耗时")
+metrics.describe("reply_first_send_seconds", "histogram", "从收到消息到第一条回复发送成功的时间")
+metrics.describe("reply_total_seconds", "histogram", "从收到消息到整轮回复处理完的时间")
+metrics.describe("replies_total", "counter", "按结果统计的回复轮数")
+metrics.describe("ai_request_seconds", "histogram", "AI接口请求耗时（流式请求为读取完整响应的时间）")
+metrics.describe("ai_first_chunk_seconds", "histogram", "流式请求收到第一段文本的时间")
+metrics.describe("ai_calls_total", "counter", "AI接口调用次数")
+metrics.describe("ai_errors_total", "counter", "AI接口调用失败次数")
+metrics.describe("ai_tokens_total", "counter", "AI接口消耗的token数（接口未返回用量时为估算值）")
+metrics.describe("response_cache_lookups_total", "counter", "回复缓存查询次数")
+metrics.describe("history_journal_seconds", "histogram", "对话历史追加一条日志的耗时")
+metrics.describe("history_snapshot_seconds", "histogram", "对话历史写入快照的耗时")
+metrics.describe("sqlite_commit_seconds", "histogram", "SQLite写线程提交一批写入的耗时")
+metrics.describe("outbound_queue_wait_seconds", "histogram", "消息在发送队列中等待（限速、合并、重试）的时间")
+metrics.describe("wechat_send_seconds", "histogram", "一次SendTextMessage请求的耗时")
+metrics.describe("wechat_messages_sent_total", "counter", "发送成功的微信消息数")
+metrics.describe("wechat_send_failures_total", "counter", "重试后仍发送失败的微信消息数")
+metrics.describe("wechat_send_retries_total", "counter", "微信消息发送重试次数")
+metrics.describe("http_request_seconds", "histogram", "各连接池的HTTP请求耗时")
+metrics.describe("http_errors_total", "counter", "各连接池的HTTP请求异常数")
+metrics.describe("autonomous_analysis_seconds", "histogram", "一次主动发言分析（含生成和发送）的耗时")
+metrics.describe("autonomous_decisions_total", "counter", "主动发言分析的判断结果")
+metrics.describe("ws_reconnects_total", "counter", "WebSocket重连次数")
+metrics.describe("log_records_dropped_total", "counter", "日志队列已满而丢弃的日志记录数")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """提供 /metrics 接口"""
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+metrics_server = None
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """在后台线程中启动指标接口，端口被占用时只打印提示"""
+    global metrics_server
+    if not METRICS_ENABLED or not port or metrics_server is not None:
+        return metrics_server
+    
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log_event("metrics_server_error", f"监控指标接口启动失败（{host}:{port}）: {e}", logging.WARNING)
+        return None
+    
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    metrics_server = server
+    log_event("metrics_server_started", f"监控指标接口: http://{host}:{port}/metrics", host=host, port=port)
+    return server
+
+# 共享HTTP客户端
+class HttpClientPool:
+    """按目标服务维护长连接的httpx客户端，复用TCP/TLS连接并统计请求情况"""
+    def __init__(self, config=None):
+        self.config = config or HTTP_POOL_CONFIG
+        self.clients = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def get(self, name):
+        """获取（首次使用时创建）指定服务的客户端"""
+        client = self.clients.get(name)
+        if client is not None:
+            return client
+        
+        with self.lock:
+            if name not in self.clients:
+                cfg = self.config[name]
+                http2 = cfg.get("http2", False)
+                if http2:
+                    try:
+                        import h2  # noqa: F401
+                    except ImportError:
+                        log_event("http2_unavailable", f"未安装h2，{name}连接池使用HTTP/1.1", pool=name)
+                        http2 = False
+                
+                self.clients[name] = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=cfg["max_connections"],
+                        max_keepalive_connections=cfg["max_keepalive_connections"],
+                        keepalive_expiry=cfg["keepalive_expiry"]
+                    ),
+                    timeout=httpx.Timeout(cfg["timeout"], connect=cfg["connect_timeout"]),
+                    http2=http2
+                )
+                self.counters[name] = {"requests": 0, "errors": 0, "total_time": 0.0, "http2": http2}
+            return self.clients[name]
+    
+    def post(self, name, url, **kwargs):
+        """通过指定服务的连接池发送POST请求"""
+        client = self.get(name)
+        start_time = time.time()
+        failed = False
+        try:
+            return client.post(url, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record(name, time.time() - start_time, failed)
+    
+    @contextlib.contextmanager
+    def stream(self, name, url, **kwargs):
+        """通过指定服务的连接池发送流式POST请求"""
+        client = self.get(name)
+        start_time = time.time()
+        failed = False
+        try:
+            with client.stream("POST", url, **kwargs) as response:
+                yield response
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record(name, time.time() - start_time, failed)
+    
+    def _record(self, name, elapsed, failed):
+        """记录一次请求的耗时和结果"""
+        with self.lock:
+            counters = self.counters[name]
+            counters["requests"] += 1
+            counters["total_time"] += elapsed
+            if failed:
+                counters["errors"] += 1
+        
+        metrics.observe("http_request_seconds", elapsed, pool=name)
+        if failed:
+            metrics.inc("http_errors_total", pool=name)
+    
+    def stats(self):
+        """返回各连接池的请求统计和连接状态"""
+        result = {}
+        for name, client in list(self.clients.items()):
+            counters = self.counters[name]
+            item = {
+                "requests": counters["requests"],
+                "errors": counters["errors"],
+                "avg_latency": counters["total_time"] / counters["requests"] if counters["requests"] else 0.0,
+                "http2": counters["http2"]
+            }
+            
+            # httpx没有公开连接池状态，这里读取底层httpcore连接池
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = getattr(pool, "connections", None)
+            if connections is not None:
+                item["connections"] = len(connections)
+                item["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+            
+            result[name] = item
+        return result
+    
+    def close(self):
+        """关闭所有客户端"""
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+http_clients = HttpClientPool()
+
+# 令牌桶限速
+class TokenBucket:
+    """令牌桶：以rate的速度补充令牌，最多积攒capacity个"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now, count=1):
+        """返回还需等待多少秒才能取出count个令牌（0表示现在就可以）"""
+        self._refill(now)
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate
+    
+    def take(self, now, count=1):
+        """取出令牌（调用前应先确认wait_time为0）"""
+        self._refill(now)
+        self.tokens -= count
+    
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# 待发送的消息
+class OutboundItem:
+    __slots__ = ("token", "to_user", "message", "attempts", "not_before", "result", "done", "queued_at")
+    
+    def __init__(self, token, to_user, message):
+        self.token = token
+        self.to_user = to_user
+        self.message = message
+        self.queued_at = time.time()
+        self.attempts = 0
+        self.not_before = 0.0
+        self.result = False
+        self.done = threading.Event()
+
+# 发送调度器
+class OutboundScheduler:
+    """
+    统一调度所有发出的微信消息：
+    按联系人和账号分别限速，避免触发微信风控；同一账号排队的消息合并为一个MsgItem数组请求；
+    根据每条的isSendSuccess只重试失败的消息。调度线程只负责取出批次，请求由按账号划分的工作线程发送
+    """
+    def __init__(self):
+        self.queues = {}  # 账号token -> 待发送消息队列
+        self.sending = set()  # 正在发送请求的账号，同一账号同时只有一个请求
+        self.account_buckets = {}
+        self.contact_buckets = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pipeline = None
+        self.stats_counters = {"batches": 0, "sent": 0, "failed": 0, "retries": 0}
+    
+    def send(self, to_user, message, token, wait=True):
+        """
+        把消息放入发送队列
+        :param wait: 是否等待发送结果
+        :return: wait为True时返回是否发送成功，否则返回OutboundItem
+        """
+        item = OutboundItem(token, to_user, message)
+        with self.cond:
+            self.queues.setdefault(token, deque()).append(item)
+            if self.thread is None or not self.thread.is_alive():
+                if self.pipeline is None:
+                    self.pipeline = MessagePipeline(OUTBOUND_WORKERS, name="outbound")
+                self.thread = threading.Thread(target=self._run, name="outbound-sender")
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        
+        if not wait:
+            return item
+        if not item.done.wait(OUTBOUND_SEND_TIMEOUT):
+            log_event("send_timeout", f"等待消息发送超时: '{message}' -> {to_user}", logging.WARNING, to_user=to_user)
+            return False
+        return item.result
+    
+    def pending(self):
+        """当前排队中的消息数"""
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+    
+    def stats(self):
+        """返回发送统计"""
+        with self.cond:
+            return dict(self.stats_counters, pending=sum(len(q) for q in self.queues.values()))
+    
+    def flush(self, timeout=10):
+        """等待队列中和正在发送的消息发送完（退出程序前调用）"""
+        deadline = time.time() + timeout
+        while (self.pending() or self.sending) and time.time() < deadline:
+            time.sleep(0.1)
+    
+    def _bucket(self, buckets, key, rate, capacity):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+    
+    def _collect_batch(self, token, queue_, now):
+        """
+        从账号队列中取出当前允许发送的一批消息
+        每个联系人每批最多一条，且必须是该联系人最早的一条，保证同一联系人的消息按顺序送达
+        :return: (批次, 下一条消息可发送前需等待的秒数)
+        """
+        account_bucket = self._bucket(self.account_buckets, token, OUTBOUND_ACCOUNT_RATE, OUTBOUND_ACCOUNT_BURST)
+        batch = []
+        blocked = set()
+        next_wait = None
+        
+        for item in list(queue_):
+            if len(batch) >= OUTBOUND_BATCH_SIZE:
+                break
+            if item.to_user in blocked:
+                continue
+            blocked.add(item.to_user)
+            
+            contact_bucket = self._bucket(self.contact_buckets, (token, item.to_user),
+                                          OUTBOUND_CONTACT_RATE, OUTBOUND_CONTACT_BURST)
+            wait = max(item.not_before - now, contact_bucket.wait_time(now), account_bucket.wait_time(now))
+            if wait > 0:
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+                continue
+            
+            contact_bucket.take(now)
+            account_bucket.take(now)
+            queue_.remove(item)
+            batch.append(item)
+            metrics.observe("outbound_queue_wait_seconds", now - item.queued_at)
+        
+        return batch, next_wait
+    
+    def _prune_buckets(self, now):
+        """删除已经补满的联系人令牌桶，避免长期运行时无限增长"""
+        if len(self.contact_buckets) > 10000:
+            for key in [k for k, b in self.contact_buckets.items() if b.is_full(now)]:
+                del self.contact_buckets[key]
+    
+    def _run(self):
+        """发送循环"""
+        while True:
+            with self.cond:
+                while not any(self.queues.values()):
+                    self.cond.wait()
+                
+                # 稍等片刻，让同时产生的消息合并到同一个请求里
+                if OUTBOUND_BATCH_LINGER > 0:
+                    self.cond.wait(OUTBOUND_BATCH_LINGER)
+                
+                now = time.time()
+                batches = []
+                next_wait = None
+                for token, queue_ in list(self.queues.items()):
+                    # 上一个请求完成前不取下一批，失败重试的消息才能仍然先于同一联系人后续的消息发送
+                    if token in self.sending:
+                        continue
+                    batch, wait = self._collect_batch(token, queue_, now)
+                    if batch:
+                        self.sending.add(token)
+                        batches.append((token, batch))
+                    if wait is not None:
+                        next_wait = wait if next_wait is None else min(next_wait, wait)
+                    if not queue_:
+                        del self.queues[token]
+                self._prune_buckets(now)
+                
+                if not batches:
+                    self.cond.wait(next_wait)
+                    continue
+            
+            # 按账号交给工作线程发送，某个账号请求缓慢或超时不会阻塞其他账号
+            for token, batch in batches:
+                self.pipeline.submit(token, self._send_batch, token, batch)
+    
+    def _send_batch(self, token, batch):
+        """用一个请求发送一批消息，并逐条处理发送结果（在发送工作线程中调用）"""
+        results = []
+        try:
+            with metrics.timer("wechat_send_seconds"):
+                results = post_text_messages(token, [(item.to_user, item.message) for item in batch])
+        finally:
+            self._handle_results(token, batch, results)
+    
+    def _handle_results(self, token, batch, results):
+        """逐条处理发送结果，失败的消息放回队首等待重试"""
+        retry = []
+        with self.cond:
+            self.sending.discard(token)
+            self.cond.notify()
+            self.stats_counters["batches"] += 1
+            for i, item in enumerate(batch):
+                success, error = results[i] if i < len(results) else (False, "缺少发送结果")
+                if success:
+                    log_event("message_sent", f"消息发送成功: '{item.message}' -> {item.to_user}", to_user=item.to_user,
+                              attempts=item.attempts + 1, queued=round(time.time() - item.queued_at, 3))
+                    self.stats_counters["sent"] += 1
+                    metrics.inc("wechat_messages_sent_total")
+                    item.result = True
+                    item.done.set()
+                    continue
+                
+                item.attempts += 1
+                if item.attempts <= OUTBOUND_MAX_RETRIES:
+                    item.not_before = time.time() + OUTBOUND_RETRY_DELAY * (2 ** (item.attempts - 1))
+                    retry.append(item)
+                    self.stats_counters["retries"] += 1
+                    metrics.inc("wechat_send_retries_total")
+                    log_event("send_retry", f"消息发送失败，稍后重试({item.attempts}/{OUTBOUND_MAX_RETRIES}): {error}", logging.WARNING,
+                              to_user=item.to_user, attempts=item.attempts, error=error)
+                else:
+                    log_event("send_failed", f"消息发送失败: {error}", logging.ERROR, to_user=item.to_user, error=error)
+                    self.stats_counters["failed"] += 1
+                    metrics.inc("wechat_send_failures_total")
+                    item.done.set()
+            
+            # 失败的消息放回队首，保证它仍然先于同一联系人后续的消息发送
+            if retry:
+                queue_ = self.queues.setdefault(token, deque())
+                queue_.extendleft(reversed(retry))
+                self.cond.notify()
+
+outbound = OutboundScheduler()
+
+# 调用SendTextMessage接口
+def post_text_messages(token, messages):
+    """
+    在一个请求中发送多条文本消息
     :param token: 微信登录token
-    :return: 是否发送成功
+    :param messages: [(接收者ID, 消息内容), ...]
+    :return: 与messages一一对应的[(是否成功, 错误信息), ...]
     """
     url = f"{SERVER_URL}/message/SendTextMessage?key={token}"
     headers = {
@@ -50,118 +857,467 @@ def send_wechat_message(to_user, message, token):
                 "TextContent": message,
                 "ToUserName": to_user
             }
+            for to_user, message in messages
         ]
     }
     
     try:
-        response = httpx.post(url, headers=headers, json=payload)
+        response = http_clients.post("wechat", url, headers=headers, json=payload)
         data = response.json()
         
         if data.get("Code") == 200:
-            result = data.get("Data", [])[0]
-            success = result.get("isSendSuccess", False)
-            
-            if success:
-                print(f"消息发送成功: '{message}' -> {to_user}")
-                return True
-            else:
-                error = result.get("errMsg", "未知错误")
-                print(f"消息发送失败: {error}")
-        else:
-            print(f"请求失败: {data.get('Text')}")
+            results = []
+            for result in (data.get("Data") or [])[:len(messages)]:
+                if result.get("isSendSuccess", False):
+                    results.append((True, None))
+                else:
+                    results.append((False, result.get("errMsg", "未知错误")))
+            return results
+        error = f"请求失败: {data.get('Text')}"
     except Exception as e:
-        print(f"发送消息异常: {e}")
+        error = f"发送消息异常: {e}"
     
-    return False
+    return [(False, error)] * len(messages)
+
+# 发送微信文本消息
+def send_wechat_message(to_user, message, token):
+    """
+    发送微信消息（经发送调度器限速，并与同一账号的其他消息合并为一个请求）
+    :param to_user: 接收者ID (wxid或特殊ID如filehelper)
+    :param message: 要发送的消息内容
+    :param token: 微信登录token
+    :return: 是否发送成功
+    """
+    return outbound.send(to_user, message, token)
+
+# token计数
+_token_encoder = None
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+def count_tokens(text):
+    """计算文本的token数：安装了tiktoken时精确计算，否则按字符类型估算"""
+    global _token_encoder
+    if not text:
+        return 0
+    
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _token_encoder = False
+    
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    
+    # 估算：中日韩字符约每字1个token，其他字符约每4个字符1个token
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+def count_message_tokens(message):
+    """计算一条消息占用的token数"""
+    return count_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD
+
+# 后台历史压缩
+class HistoryCompactor:
+    """在后台线程中把对话日志合并为快照，避免在回复路径上重写完整历史"""
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+    
+    def schedule(self, manager):
+        """登记需要处理的对话管理器（排队中的重复登记会被忽略）"""
+        with self.lock:
+            if id(manager) in self.pending:
+                return
+            self.pending.add(id(manager))
+            
+            # 首次使用时才启动线程
+            if not self.threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._run)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        
+        self.queue.put(manager)
+    
+    def _run(self):
+        """处理循环"""
+        while True:
+            manager = self.queue.get()
+            with self.lock:
+                self.pending.discard(id(manager))
+            
+            try:
+                self.process(manager)
+            except Exception as e:
+                log_event("history_background_error", f"后台处理对话历史出错: {e}", logging.ERROR)
+    
+    def process(self, manager):
+        """合并日志为快照"""
+        manager.save_history()
+
+# 后台滚动摘要
+class HistorySummarizer(HistoryCompactor):
+    """在后台线程中为移出上下文窗口的旧消息生成摘要，不占用回复路径"""
+    def process(self, manager):
+        """生成摘要"""
+        manager.summarize_pending()
+
+history_compactor = HistoryCompactor()
+history_summarizer = HistorySummarizer(workers=SUMMARY_WORKERS)
+
+# 增量格式化的对话记录
+class TranscriptBuffer:
+    """缓存每条消息格式化后的文本（不含系统消息），窗口前移时从开头移出，新消息只格式化一次；窗口不变时直接返回上次的拼接结果"""
+    def __init__(self):
+        self.parts = deque()  # (消息对象, 格式化后的文本)
+        self.text = ""  # 上次拼接的结果
+    
+    def render(self, messages, char_name):
+        """返回messages的格式化文本，只格式化新增的消息，窗口有变化时拼接一次"""
+        changed = False
+        
+        # 移出不再位于窗口开头的消息
+        while self.parts and (not messages or self.parts[0][0] is not messages[0]):
+            self.parts.popleft()
+            changed = True
+        
+        # 缓存与当前窗口对不上时（例如重置了历史）整体重建
+        count = len(self.parts)
+        if count and (count > len(messages) or self.parts[-1][0] is not messages[count - 1]):
+            self.parts.clear()
+            count = 0
+        
+        for msg in messages[count:]:
+            # 与include_system=False的路径一致，旧版历史中夹有的系统消息不输出（仍占位以便与窗口对齐）
+            if msg["role"] == "system":
+                line = ""
+            else:
+                role_name = "用户" if msg["role"] == "user" else char_name
+                line = f"{role_name}: {msg['content']}\n\n"
+            self.parts.append((msg, line))
+            changed = True
+        
+        if changed:
+            self.text = "".join(line for _, line in self.parts)
+        return self.text
 
 # 历史对话记录管理
 class ConversationManager:
-    def __init__(self, max_history=50):
-        self.history = []
+    def __init__(self, max_history=50, conversation_file="conversation_history.json", character_card=None):
+        self.history = deque()  # 第一条是系统消息；deque使裁剪最早的消息为O(1)
         self.system_message = {"role": "system", "content": "You are a helpful assistant."}
         self.max_history = max_history
         self.character_data = None
-        self.conversation_file = "conversation_history.json"
+        self.card = None  # 编译后的角色卡（CharacterCard）
+        self.shared_card = character_card  # 快照中的角色卡与之相同时直接复用，不再重新编译
+        self.conversation_file = conversation_file
+        
+        # 追加写入的日志文件：快照之后的每次变更都以一行JSON记录
+        self.journal_file = os.path.splitext(conversation_file)[0] + ".journal"
+        self.rotated_journal_file = self.journal_file + ".1"
+        self.lock = threading.RLock()
+        self.checkpoint_lock = threading.Lock()
+        self.seq = 0  # 最后一条变更记录的序号
+        self.journal_records = 0  # 当前日志中的记录数
+        self.journal_damaged = False
+        self._journal = None
+        self.closed = False  # 已移出内存：排队中的后台摘要、压缩不再写入（会话可能已被重新加载）
+        
+        # 上下文窗口：history[window_start:] 是放得进token预算的最近消息
+        self.token_counts = deque()  # 与history一一对应的token数
+        self.history_budget = 0
+        self.instruction_tokens = 0
+        self.window_start = 1
+        self.window_tokens = 0
+        
+        # 滚动摘要：移出窗口的消息先进入pending_summary，满一段后在后台生成分段摘要，
+        # 分段过多时再合并进总摘要
+        self.summary = ""
+        self.block_summaries = []
+        self.pending_summary = []
+        self.summary_tokens = 0
+        self.summary_epoch = 0  # 每次重置递增，丢弃重置前发起的摘要结果
+        self.summary_failures = 0  # 连续失败次数，失败后按指数退避，期间不再排队
+        self.summary_retry_at = 0
+        self.loading = False
+        
+        # 对话文本增量追加，用于自主消息提示词
+        self.transcript = TranscriptBuffer()
         
         # 尝试加载历史记录
         self.load_history()
     
     def reset(self):
         """重置对话历史"""
-        self.history = []
-        self.initialize_with_system_message()
+        with self.lock:
+            self.initialize_with_system_message()
+            self._append_journal({"op": "reset", "system": self.system_message})
     
     def initialize_with_system_message(self):
         """使用系统消息初始化历史记录"""
-        self.history = [self.system_message]
+        self.history = deque([self.system_message])
+        
+        # 新对话不沿用旧摘要
+        self.summary = ""
+        self.block_summaries = []
+        self.pending_summary = []
+        self.summary_tokens = 0
+        self.summary_epoch += 1
+        
+        self._rebuild_token_index()
     
-    def set_character(self, character_data):
-        """设置角色并更新系统消息"""
-        self.character_data = character_data
+    def _rebuild_token_index(self, window_size=None):
+        """
+        重新计算每条消息的token数和上下文窗口（只在重置或加载时调用）
+        :param window_size: 保存时窗口内的消息数，加载时按它恢复窗口，已移出窗口（计入摘要）的消息不会重新回到上下文
+        """
+        # 保证第一条始终是系统消息
+        if not self.history or self.history[0]["role"] != "system":
+            self.history.insert(0, self.system_message)
         
-        # 验证角色卡
-        card_validator = TavernCardValidator(character_data)
-        card_version = card_validator.validate()
+        self.token_counts = deque(count_message_tokens(msg) for msg in self.history)
+        self._update_history_budget()
+        self.window_start = 1 if window_size is None else max(1, len(self.history) - window_size)
+        self.window_tokens = sum(itertools.islice(self.token_counts, self.window_start, None))
         
-        if not card_version:
-            print(f"角色卡验证失败: {card_validator.lastValidationError}")
-            return False
+        # 窗口外的消息在保存快照前已经计入摘要，这里不再重复收集
+        self._shrink_window(collect=False)
+    
+    def _update_history_budget(self):
+        """历史消息可用的token预算（扣除系统提示词、历史后指令、摘要和回复预留）"""
+        self.summary_tokens = count_tokens(self.get_summary_text())
+        self.instruction_tokens = count_tokens(self.card.post_history_instructions) if self.card else 0
+        self.history_budget = max(CONTEXT_TOKEN_BUDGET - RESPONSE_TOKEN_RESERVE - self.token_counts[0] -
+                                  self.summary_tokens - self.instruction_tokens, 0)
+    
+    def _shrink_window(self, collect=True):
+        """窗口超出预算时从最早的消息开始移出（至少保留最新一条）"""
+        while self.window_tokens > self.history_budget and self.window_start < len(self.history) - 1:
+            if collect:
+                self._collect_for_summary(self.history[self.window_start])
+            self.window_tokens -= self.token_counts[self.window_start]
+            self.window_start += 1
+    
+    def _collect_for_summary(self, message):
+        """记录移出窗口的消息，满一段后交给后台生成摘要"""
+        if not SUMMARY_ENABLED:
+            return
         
-        # 根据角色卡版本设置系统提示词
-        if card_version == 1:
-            # V1格式
-            system_content = f"You are {character_data.get('name', 'Assistant')}, {character_data.get('description', '')}. Your personality: {character_data.get('personality', '')}. Scenario: {character_data.get('scenario', '')}"
-            char_name = character_data.get('name', 'Assistant')
-        else:
-            # V2/V3格式
-            data = character_data.get('data', {})
-            system_content = data.get('system_prompt', '') or \
-                           f"You are {data.get('name', 'Assistant')}, {data.get('description', '')}. Your personality: {data.get('personality', '')}. Scenario: {data.get('scenario', '')}"
-            char_name = data.get('name', 'Assistant')
-        
-        # 更新系统消息
-        self.system_message = {"role": "system", "content": system_content}
-        
-        # 重置历史记录并添加第一条消息
-        self.reset()
-        
-        # 添加角色的第一条消息
-        first_message = ""
-        if card_version == 1:
-            first_message = character_data.get('first_mes', '')
+        self.pending_summary.append(message)
+        
+        # 摘要接口持续失败时只保留最近的消息，避免待摘要列表（以及每个快照）无限增长
+        if len(self.pending_summary) > SUMMARY_MAX_PENDING:
+            del self.pending_summary[:len(self.pending_summary) - SUMMARY_MAX_PENDING]
+        
+        if len(self.pending_summary) >= SUMMARY_BLOCK_SIZE and not self.loading and \
+                time.time() >= self.summary_retry_at:
+            history_summarizer.schedule(self)
+    
+    def _summary_failed(self):
+        """摘要或合并失败后推迟下一次尝试（需持有self.lock）"""
+        self.summary_failures += 1
+        delay = min(SUMMARY_RETRY_DELAY * (2 ** (self.summary_failures - 1)), 3600)
+        self.summary_retry_at = time.time() + delay
+        log_event("summary_backoff", f"生成摘要失败，{delay}秒内不再重试", logging.WARNING,
+                  file=self.conversation_file, failures=self.summary_failures)
+    
+    def get_summary_text(self):
+        """合并总摘要和分段摘要的文本"""
+        parts = ([self.summary] if self.summary else []) + self.block_summaries
+        return "\n".join(parts)
+    
+    def summarize_pending(self):
+        """为待摘要的消息生成分段摘要，必要时合并总摘要（在后台线程中调用）"""
+        with self.lock:
+            if self.closed or len(self.pending_summary) < SUMMARY_BLOCK_SIZE:
+                return
+            epoch = self.summary_epoch
+            block = list(self.pending_summary[:SUMMARY_BLOCK_SIZE])
+            context = self.get_summary_text()
+            char_name = self.get_character_name()
+        
+        block_summary = summarize_conversation(block, context, char_name, self)
+        
+        with self.lock:
+            if not block_summary:
+                self._summary_failed()
+                return
+            # 生成期间最早的消息被丢弃（待摘要过多）时，结果对应的已不是列表开头的消息
+            if self.closed or epoch != self.summary_epoch or not self.pending_summary or \
+                    self.pending_summary[0] is not block[0]:
+                return
+            self.summary_failures = 0
+            self.summary_retry_at = 0
+            record = {"op": "summary", "consumed": len(block), "block": block_summary}
+            self._apply_record(record)
+            self._append_journal(record)
+            
+            if len(self.block_summaries) <= SUMMARY_MAX_BLOCKS:
+                more_pending = len(self.pending_summary) >= SUMMARY_BLOCK_SIZE
+                merge_blocks = None
+            else:
+                more_pending = False
+                merge_blocks = self.block_summaries[:len(self.block_summaries) - SUMMARY_MAX_BLOCKS // 2]
+                previous_summary = self.summary
+        
+        if merge_blocks:
+            merged = merge_summaries(previous_summary, merge_blocks, self)
+            with self.lock:
+                if not merged:
+                    self._summary_failed()
+                elif not self.closed and epoch == self.summary_epoch:
+                    record = {"op": "summary_merge", "blocks": len(merge_blocks), "summary": merged}
+                    self._apply_record(record)
+                    self._append_journal(record)
+                    more_pending = len(self.pending_summary) >= SUMMARY_BLOCK_SIZE
+        
+        # 期间又积累了足够的消息，继续排队
+        if more_pending:
+            history_summarizer.schedule(self)
+    
+    def set_character(self, character_data):
+        """设置角色并更新系统消息（可传入角色卡字典或已编译的CharacterCard）"""
+        if isinstance(character_data, CharacterCard):
+            card = character_data
         else:
-            first_message = character_data.get('data', {}).get('first_mes', '')
+            try:
+                card = CharacterCard.compile(character_data)
+            except ValueError as e:
+                log_event("card_invalid", f"角色卡验证失败: {e}", logging.WARNING, file=self.conversation_file)
+                return False
         
-        if first_message:
-            self.add_message("assistant", first_message)
-            print(f"{char_name}: {first_message}")
+        with self.lock:
+            self.card = card
+            self.character_data = card.raw
+            
+            # 更新系统消息
+            self.system_message = {"role": "system", "content": card.system_prompt}
+            
+            # 重置历史记录并添加角色的第一条消息
+            self.reset()
+            
+            if card.first_mes:
+                self.add_message("assistant", card.first_mes)
+                log_event("character_greeting", f"{card.name}: {card.first_mes}", logging.DEBUG,
+                          file=self.conversation_file)
+        
+        # 角色卡只在快照中保存，切换角色后立即写入快照
+        self.save_history()
         
-        print(f"已加载角色卡: {char_name} (版本 V{card_version})")
+        # 会话存储为所有会话设置角色卡时会逐个调用，只记录DEBUG日志
+        log_event("character_set", f"已加载角色卡: {card.name} (版本 V{card.version})", logging.DEBUG,
+                  file=self.conversation_file, card=card.name)
         return True
     
     def add_message(self, role, content):
         """添加消息到历史记录"""
-        self.history.append({"role": role, "content": content})
-        
-        # 如果超过最大历史记录数，删除最早的非系统消息
-        if len(self.history) > self.max_history + 1:  # +1是因为系统消息
-            # 找到第一个非系统消息
-            for i in range(1, len(self.history)):
-                if self.history[i]["role"] != "system":
-                    self.history.pop(i)
-                    break
+        with self.lock:
+            self._apply_message(role, content)
+            
+            # 只追加一条日志记录，持久化成本与历史长度无关
+            self._append_journal({"op": "message", "role": role, "content": content})
+    
+    def _apply_message(self, role, content):
+        """在内存中追加消息并裁剪历史"""
+        message = {"role": role, "content": content}
+        self.history.append(message)
         
-        # 保存历史记录
-        self.save_history()
+        # 每条消息只计算一次token数，窗口增量维护
+        tokens = count_message_tokens(message)
+        self.token_counts.append(tokens)
+        self.window_tokens += tokens
+        
+        # 如果超过最大历史记录数，删除最早的非系统消息（+1是因为系统消息）
+        if len(self.history) > self.max_history + 1:
+            # 通常就是第二条；只有旧版历史中夹有系统消息时才需要向后查找
+            i = 1
+            while i < len(self.history) - 1 and self.history[i]["role"] == "system":
+                i += 1
+            dropped = self.history[i]
+            dropped_tokens = self.token_counts[i]
+            del self.history[i]
+            del self.token_counts[i]
+            if i < self.window_start:
+                self.window_start -= 1
+            else:
+                # 仍在窗口内就被删除的消息也要计入摘要
+                self._collect_for_summary(dropped)
+                self.window_tokens -= dropped_tokens
+        
+        self._shrink_window()
+    
+    def _apply_record(self, record):
+        """重放一条日志记录"""
+        op = record.get("op")
+        if op == "message":
+            self._apply_message(record["role"], record["content"])
+        elif op == "reset":
+            self.system_message = record.get("system", self.system_message)
+            self.initialize_with_system_message()
+        elif op == "summary":
+            self.pending_summary = self.pending_summary[record["consumed"]:]
+            self.block_summaries.append(record["block"])
+            self._update_history_budget()
+            self._shrink_window()
+        elif op == "summary_merge":
+            self.summary = record["summary"]
+            self.block_summaries = self.block_summaries[record["blocks"]:]
+            self._update_history_budget()
+            self._shrink_window()
+        self.seq = record.get("seq", self.seq)
     
     def get_history_for_api(self):
-        """获取用于API调用的历史记录"""
-        return self.history.copy()
+        """获取用于API调用的历史记录（系统消息+摘要+token预算内的最近消息）"""
+        with self.lock:
+            messages = [self.history[0]]
+            summary_text = self.get_summary_text()
+            if summary_text:
+                messages.append({"role": "system", "content": f"之前对话的摘要：\n{summary_text}"})
+            messages += itertools.islice(self.history, self.window_start, None)
+            
+            # 角色卡的历史后指令放在最近消息之后
+            if self.card and self.card.post_history_instructions:
+                messages.append({"role": "system", "content": self.card.post_history_instructions})
+            return messages
+    
+    def context_tokens(self):
+        """get_history_for_api返回内容的token数（使用已有的计数，不重新计算）"""
+        with self.lock:
+            return self.token_counts[0] + self.summary_tokens + self.instruction_tokens + self.window_tokens
+    
+    def get_recent_messages(self, count):
+        """获取最近count条对话消息（不含系统消息）"""
+        if count <= 0:
+            return []
+        with self.lock:
+            return list(itertools.islice(self.history, max(1, len(self.history) - count), None))
     
     def get_formatted_history(self, include_system=False, max_items=None):
-        """获取格式化的历史记录文本"""
+        """获取格式化的历史记录文本（窗口外的旧消息以摘要代替）"""
         result = ""
-        history = self.history.copy()
+        with self.lock:
+            summary_text = self.get_summary_text()
+            history = list(itertools.islice(self.history, self.window_start, None))
+            
+            if not include_system and not max_items:
+                # 常用路径：直接使用增量维护的对话文本
+                transcript = self.transcript.render(history, self.get_character_name())
+            else:
+                transcript = None
+                if include_system:
+                    history = [self.history[0]] + history
+        
+        if summary_text:
+            result += f"之前对话的摘要: {summary_text}\n\n"
+        
+        if transcript is not None:
+            return result + transcript
         
         if not include_system:
             history = [msg for msg in history if msg["role"] != "system"]
@@ -169,61 +1325,871 @@ class ConversationManager:
         if max_items and len(history) > max_items:
             history = history[-max_items:]
         
+        char_name = self.get_character_name()
+        lines = []
         for msg in history:
             role_name = "系统" if msg["role"] == "system" else \
                         "用户" if msg["role"] == "user" else \
-                        self.get_character_name()
-            result += f"{role_name}: {msg['content']}\n\n"
+                        char_name
+            lines.append(f"{role_name}: {msg['content']}\n\n")
         
-        return result
+        return result + "".join(lines)
     
-    def save_history(self):
-        """保存对话历史到文件"""
+    def get_card_json(self):
+        """获取角色卡的JSON文本（编译角色卡时已序列化）"""
+        return self.card.card_json if self.card else "null"
+    
+    def _append_journal(self, record):
+        """追加一条变更记录到日志文件"""
+        if self.closed:
+            return
+        self.seq += 1
+        record["seq"] = self.seq
+        record["ts"] = time.time()
+        
         try:
-            with open(self.conversation_file, 'w', encoding='utf-8') as f:
-                save_data = {
-                    "history": self.history,
-                    "timestamp": time.time(),
-                    "character": self.character_data
-                }
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
+            with metrics.timer("history_journal_seconds"):
+                if self._journal is None:
+                    self._journal = open(self.journal_file, 'a', encoding='utf-8')
+                self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._journal.flush()
+                if HISTORY_JOURNAL_FSYNC:
+                    os.fsync(self._journal.fileno())
+            self.journal_records += 1
         except Exception as e:
-            print(f"保存对话历史失败: {e}")
+            log_event("journal_write_error", f"写入对话日志失败: {e}", logging.ERROR, file=self.journal_file)
+            return
+        
+        # 日志过长时交给后台线程合并为快照
+        if self.journal_records >= HISTORY_COMPACT_THRESHOLD:
+            history_compactor.schedule(self)
+    
+    def _rotate_journal(self):
+        """把当前日志移到待删除位置，之后的记录写入新日志（需持有self.lock）"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        
+        if os.path.exists(self.journal_file):
+            if os.path.exists(self.rotated_journal_file):
+                # 上一次压缩没有完成，把记录合并到旧日志中
+                with open(self.rotated_journal_file, 'a', encoding='utf-8') as dst, \
+                     open(self.journal_file, 'r', encoding='utf-8') as src:
+                    dst.write(src.read())
+                os.remove(self.journal_file)
+            else:
+                os.replace(self.journal_file, self.rotated_journal_file)
+        
+        self.journal_records = 0
+    
+    def save_history(self):
+        """保存对话历史快照到文件，并清理已合并的日志"""
+        with self.checkpoint_lock, metrics.timer("history_snapshot_seconds"):
+            try:
+                with self.lock:
+                    if self.closed:
+                        return
+                    save_data = {
+                        "history": list(self.history),
+                        "timestamp": time.time(),
+                        "character": self.character_data,
+                        "card_hash": self.card.content_hash if self.card else None,
+                        "seq": self.seq,
+                        "summary": self.summary,
+                        "block_summaries": list(self.block_summaries),
+                        "pending_summary": list(self.pending_summary),
+                        "window_size": len(self.history) - self.window_start
+                    }
+                    self._rotate_journal()
+                
+                # 先写临时文件再原子替换，崩溃时旧快照仍然完整
+                tmp_file = self.conversation_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(save_data, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.conversation_file)
+                
+                if os.path.exists(self.rotated_journal_file):
+                    os.remove(self.rotated_journal_file)
+            except Exception as e:
+                log_event("snapshot_error", f"保存对话历史失败: {e}", logging.ERROR, file=self.conversation_file)
+    
+    def _replay_journal(self, path):
+        """重放日志中序号大于快照的记录，返回重放条数"""
+        if not os.path.exists(path):
+            return 0
+        
+        replayed = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半，丢弃之后的内容
+                    log_event("journal_truncated", f"对话日志 {path} 末尾记录不完整，已丢弃", logging.WARNING, file=path)
+                    self.journal_damaged = True
+                    break
+                
+                if record.get("seq", 0) <= self.seq:
+                    continue
+                self._apply_record(record)
+                replayed += 1
+        
+        return replayed
     
     def load_history(self):
-        """从文件加载对话历史"""
-        try:
-            if os.path.exists(self.conversation_file):
-                with open(self.conversation_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                    self.history = data.get("history", [])
-                    
-                    # 如果有角色数据，也加载
-                    if data.get("character"):
-                        self.character_data = data.get("character")
+        """从快照和日志恢复对话历史"""
+        with self.lock:
+            loaded = False
+            window_size = None
+            self.loading = True
+            try:
+                if os.path.exists(self.conversation_file):
+                    with open(self.conversation_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
                         
-                    print(f"已加载{len(self.history)}条历史消息")
-                    return True
-        except Exception as e:
-            print(f"加载对话历史失败: {e}")
+                        self.history = deque(data.get("history", []))
+                        self.seq = data.get("seq", 0)
+                        self.summary = data.get("summary", "")
+                        self.block_summaries = data.get("block_summaries", [])
+                        self.pending_summary = data.get("pending_summary", [])
+                        window_size = data.get("window_size")
+                        
+                        # 如果有角色数据，也加载
+                        if data.get("character"):
+                            self.card = self._load_card(data.get("character"), data.get("card_hash"))
+                            self.character_data = self.card.raw if self.card else data.get("character")
+                        
+                        loaded = True
+            except Exception as e:
+                log_event("history_load_error", f"加载对话历史失败: {e}", logging.ERROR, file=self.conversation_file)
+            
+            # 如果加载失败，初始化空历史
+            if not loaded:
+                self.initialize_with_system_message()
+            else:
+                self._rebuild_token_index(window_size)
+            
+            # 重放快照之后的日志记录（先重放未完成压缩的旧日志）
+            replayed = 0
+            self.journal_damaged = False
+            try:
+                for path in (self.rotated_journal_file, self.journal_file):
+                    replayed += self._replay_journal(path)
+            except Exception as e:
+                log_event("journal_replay_error", f"重放对话日志失败: {e}", logging.ERROR, file=self.conversation_file)
+            
+            self.loading = False
+            if SUMMARY_ENABLED and len(self.pending_summary) >= SUMMARY_BLOCK_SIZE:
+                history_summarizer.schedule(self)
         
-        # 如果加载失败，初始化空历史
-        self.initialize_with_system_message()
-        return False
+        if loaded or replayed:
+            log_event("history_loaded", f"已加载{len(self.history)}条历史消息", logging.DEBUG,
+                      file=self.conversation_file, replayed=replayed)
+        
+        # 恢复出的状态立即合并为新快照，同时清理可能损坏的日志尾部
+        if replayed:
+            log_event("journal_replayed", f"已从对话日志恢复{replayed}条记录", file=self.conversation_file)
+        if replayed or self.journal_damaged:
+            self.save_history()
+        
+        return loaded or replayed > 0
+    
+    @property
+    def version(self):
+        """历史版本号：每次变更递增（即最后一条变更记录的序号）"""
+        return self.seq
+    
+    def close(self):
+        """关闭日志文件（会话移出内存时调用），之后该实例不再写入任何内容"""
+        with self.lock:
+            self.closed = True
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+    
+    def _load_card(self, character_data, card_hash=None):
+        """编译快照中的角色卡，与共享角色卡相同时直接复用"""
+        if self.shared_card and card_hash == self.shared_card.content_hash:
+            return self.shared_card
+        try:
+            return CharacterCard.compile(character_data)
+        except ValueError as e:
+            log_event("card_invalid", f"快照中的角色卡验证失败: {e}", logging.WARNING, file=self.conversation_file)
+            return None
     
     def get_character_name(self):
         """获取角色名称"""
-        if not self.character_data:
-            return "Assistant"
+        return self.card.name if self.card else "Assistant"
+
+    def estimate_memory(self):
+        """估算历史记录占用的内存字节数"""
+        with self.lock:
+            return sum(len(msg["content"]) * 2 + 100 for msg in self.history)
+
+# SQLite存储
+class SqliteStore:
+    """
+    SQLite数据库（WAL模式）：会话状态、全部消息、主动发言判断和token用量。
+    写入只放入队列，由单个写线程把队列中积攒的写入合并为一个事务提交；读取使用各线程自己的连接，不会被写入阻塞。
+    多账号时所有账号共用一个数据库（一个写线程），会话键带上账号前缀（账号名/会话键）
+    """
+    instances = weakref.WeakSet()  # 所有数据库，用于导出写入队列长度指标
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_key TEXT PRIMARY KEY,
+            wxid TEXT NOT NULL,
+            chatroom TEXT,
+            seq INTEGER NOT NULL,
+            reset_seq INTEGER NOT NULL DEFAULT 0,
+            system_prompt TEXT,
+            card_hash TEXT,
+            summary TEXT,
+            block_summaries TEXT,
+            pending_summary TEXT,
+            window_size INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_wxid ON sessions(wxid);
+        CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at);
         
-        card_validator = TavernCardValidator(self.character_data)
-        card_version = card_validator.validate()
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            session_key TEXT NOT NULL,
+            wxid TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_session_seq ON messages(session_key, seq);
+        CREATE INDEX IF NOT EXISTS idx_messages_wxid_ts ON messages(wxid, ts);
         
-        if card_version == 1:
-            return self.character_data.get("name", "Assistant")
-        else:
-            return self.character_data.get("data", {}).get("name", "Assistant")
+        CREATE TABLE IF NOT EXISTS cards (
+            card_hash TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        
+        CREATE TABLE IF NOT EXISTS decisions (
+            id INTEGER PRIMARY KEY,
+            session_key TEXT NOT NULL,
+            wxid TEXT NOT NULL,
+            ts REAL NOT NULL,
+            should_send INTEGER NOT NULL,
+            reason TEXT,
+            message_type TEXT,
+            mode TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_decisions_wxid_ts ON decisions(wxid, ts);
+        
+        CREATE TABLE IF NOT EXISTS token_usage (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            session_key TEXT,
+            wxid TEXT,
+            kind TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            estimated INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_token_usage_wxid_ts ON token_usage(wxid, ts);
+        CREATE INDEX IF NOT EXISTS idx_token_usage_ts ON token_usage(ts);
+    """
+    
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.pending = {}  # 会话键 -> 尚未提交的写入数，加载会话前需要等待
+        self.saved_cards = set()
+        self.thread = None
+        self.counters = {"committed": 0, "batches": 0, "retries": 0, "errors": 0}
+        SqliteStore.instances.add(self)
+        
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        # 旧版数据库没有window_size列
+        if "window_size" not in {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}:
+            conn.execute("ALTER TABLE sessions ADD COLUMN window_size INTEGER")
+        conn.commit()
+    
+    @staticmethod
+    def split_key(session_key):
+        """会话键拆分为(wxid, 群ID)，忽略账号前缀"""
+        session_key = session_key.rpartition("/")[2]
+        if "@chatroom:" in session_key:
+            chatroom, wxid = session_key.split(":", 1)
+            return wxid, chatroom
+        return session_key, None
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        # WAL模式下NORMAL只在检查点时同步磁盘，每次提交不再fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def _connection(self):
+        """当前线程的读连接"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+    
+    # ---- 写入（放入队列后立即返回） ----
+    
+    def _put(self, kind, session_key, params):
+        with self.cond:
+            if session_key is not None:
+                self.pending[session_key] = self.pending.get(session_key, 0) + 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sqlite-writer")
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((kind, session_key, params))
+    
+    def add_message(self, session_key, seq, role, content, ts):
+        wxid, _ = self.split_key(session_key)
+        self._put("message", session_key, (session_key, wxid, seq, role, content, ts))
+    
+    def save_session(self, session_key, seq, reset_seq, system_prompt, card_hash, summary,
+                     block_summaries, pending_summary, window_size=None):
+        """写入会话状态（同一批次中同一会话只保留最后一次）"""
+        wxid, chatroom = self.split_key(session_key)
+        now = time.time()
+        self._put("session", session_key, (
+            session_key, wxid, chatroom, seq, reset_seq, system_prompt, card_hash, summary,
+            json.dumps(block_summaries, ensure_ascii=False), json.dumps(pending_summary, ensure_ascii=False),
+            window_size, session_key, now, now))
+    
+    def save_card(self, card):
+        """保存角色卡（按内容哈希去重，所有会话共用一份）"""
+        if card.content_hash in self.saved_cards:
+            return
+        self.saved_cards.add(card.content_hash)
+        self._put("card", None, (card.content_hash, card.card_json, time.time()))
+    
+    def import_messages(self, session_key, messages):
+        """导入会话的全部消息，替换数据库中已有的消息（用于迁移旧的JSON历史）"""
+        wxid, _ = self.split_key(session_key)
+        rows = [(session_key, wxid, seq, msg["role"], msg["content"], ts) for seq, msg, ts in messages]
+        self._put("import", session_key, (session_key, rows))
+    
+    def record_decision(self, session_key, should_send, reason=None, message_type=None, mode=None):
+        wxid, _ = self.split_key(session_key)
+        self._put("decision", None, (session_key, wxid, time.time(), int(should_send), reason, message_type, mode))
+    
+    def record_usage(self, session_key, kind, prompt_tokens, completion_tokens, estimated):
+        wxid = self.split_key(session_key)[0] if session_key else None
+        self._put("usage", None, (time.time(), session_key, wxid, kind, prompt_tokens, completion_tokens,
+                                  int(estimated)))
+    
+    def flush(self):
+        """等待队列中的写入全部提交"""
+        if self.thread is not None:
+            self.queue.join()
+    
+    def wait_for_session(self, session_key, timeout=10):
+        """等待会话尚未提交的写入（会话换出后立即重新加载时，保证读到最新数据）"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.pending.get(session_key) and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+    
+    def _run(self):
+        """写线程：每次取出队列中已有的写入（最多batch_size条），在一个事务中提交"""
+        conn = self._connect()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            error = self._commit_with_retry(conn, batch)
+            dropped = []
+            if error is not None and len(batch) > 1:
+                # 整批反复失败时逐条提交，只丢弃本身写不进去的写入
+                for item in batch:
+                    item_error = self._commit_with_retry(conn, [item], retries=0)
+                    if item_error is not None:
+                        error = item_error
+                        dropped.append(item)
+            elif error is not None:
+                dropped = batch
+            
+            self.counters["committed"] += len(batch) - len(dropped)
+            self.counters["batches"] += 1
+            if dropped:
+                self.counters["errors"] += len(dropped)
+                kinds = {}
+                for kind, _, _ in dropped:
+                    kinds[kind] = kinds.get(kind, 0) + 1
+                sessions = sorted({session_key for _, session_key, _ in dropped if session_key is not None})
+                log_event("sqlite_error", f"写入数据库失败，丢弃{len(dropped)}条写入{kinds}，涉及会话: "
+                          f"{', '.join(sessions[:10]) or '无'}{' 等' if len(sessions) > 10 else ''}: {error}",
+                          logging.ERROR, dropped=kinds, sessions=sessions)
+            
+            with self.cond:
+                for _, session_key, _ in batch:
+                    if session_key is not None:
+                        count = self.pending.get(session_key, 0) - 1
+                        if count > 0:
+                            self.pending[session_key] = count
+                        else:
+                            self.pending.pop(session_key, None)
+                self.cond.notify_all()
+            for _ in batch:
+                self.queue.task_done()
+    
+    def _commit_with_retry(self, conn, batch, retries=SQLITE_MAX_RETRIES):
+        """
+        提交一批写入，失败时（事务已回滚）按指数退避重试
+        :return: 最后一次失败的异常，提交成功时返回None
+        """
+        for attempt in range(retries + 1):
+            try:
+                with metrics.timer("sqlite_commit_seconds"):
+                    self._commit(conn, batch)
+                return None
+            except sqlite3.Error as e:
+                # 只有数据库被锁、磁盘错误等操作错误值得重试，数据本身的问题重试也不会成功
+                if not isinstance(e, sqlite3.OperationalError) or attempt == retries:
+                    return e
+                self.counters["retries"] += 1
+                delay = min(SQLITE_RETRY_DELAY * (2 ** attempt), 5)
+                log_event("sqlite_retry", f"写入数据库失败，{delay:.1f}秒后重试({attempt + 1}/{retries}): {e}",
+                          logging.WARNING, writes=len(batch))
+                time.sleep(delay)
+    
+    def _commit(self, conn, batch):
+        """按类型合并写入：导入先于新消息，会话状态最后写入"""
+        rows = {"message": [], "card": [], "decision": [], "usage": []}
+        imports = []
+        sessions = {}
+        for kind, session_key, params in batch:
+            if kind == "session":
+                sessions[session_key] = params
+            elif kind == "import":
+                imports.append(params)
+            else:
+                rows[kind].append(params)
+        
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO cards (card_hash, data, created_at) VALUES (?, ?, ?)",
+                             rows["card"])
+            for session_key, messages in imports:
+                conn.execute("DELETE FROM messages WHERE session_key = ?", (session_key,))
+                conn.executemany("INSERT INTO messages (session_key, wxid, seq, role, content, ts) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", messages)
+            conn.executemany("INSERT OR REPLACE INTO messages (session_key, wxid, seq, role, content, ts) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", rows["message"])
+            conn.executemany("INSERT OR REPLACE INTO sessions (session_key, wxid, chatroom, seq, reset_seq, "
+                             "system_prompt, card_hash, summary, block_summaries, pending_summary, window_size, "
+                             "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                             "COALESCE((SELECT created_at FROM sessions WHERE session_key = ?), ?), ?)",
+                             list(sessions.values()))
+            conn.executemany("INSERT INTO decisions (session_key, wxid, ts, should_send, reason, message_type, mode) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows["decision"])
+            conn.executemany("INSERT INTO token_usage (ts, session_key, wxid, kind, prompt_tokens, "
+                             "completion_tokens, estimated) VALUES (?, ?, ?, ?, ?, ?, ?)", rows["usage"])
+    
+    # ---- 读取 ----
+    
+    def load_session(self, session_key):
+        """读取会话状态，不存在时返回None"""
+        self.wait_for_session(session_key)
+        row = self._connection().execute(
+            "SELECT seq, reset_seq, system_prompt, card_hash, summary, block_summaries, pending_summary, "
+            "window_size FROM sessions WHERE session_key = ?", (session_key,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "seq": row[0],
+            "reset_seq": row[1],
+            "system_prompt": row[2],
+            "card_hash": row[3],
+            "summary": row[4] or "",
+            "block_summaries": json.loads(row[5] or "[]"),
+            "pending_summary": json.loads(row[6] or "[]"),
+            "window_size": row[7]
+        }
+    
+    def load_card(self, card_hash):
+        """按哈希读取角色卡数据"""
+        row = self._connection().execute("SELECT data FROM cards WHERE card_hash = ?", (card_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def load_messages(self, session_key, after_seq, until_seq=None, limit=None):
+        """
+        读取会话中序号在(after_seq, until_seq]之间的消息
+        :param limit: 只取最后limit条
+        :return: [(序号, 消息), ...]，按序号升序
+        """
+        sql = "SELECT seq, role, content FROM messages WHERE session_key = ? AND seq > ?"
+        params = [session_key, after_seq]
+        if until_seq is not None:
+            sql += " AND seq <= ?"
+            params.append(until_seq)
+        sql += " ORDER BY seq DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        
+        rows = self._connection().execute(sql, params).fetchall()
+        return [(seq, {"role": role, "content": content}) for seq, role, content in reversed(rows)]
+    
+    def history(self, wxid, start=None, end=None, limit=100):
+        """按联系人和时间范围查询聊天记录（包括私聊和群聊中该联系人的会话），返回最近的limit条"""
+        rows = self._connection().execute(
+            "SELECT ts, session_key, role, content FROM messages WHERE wxid = ? AND ts >= ? AND ts < ? "
+            "ORDER BY ts DESC LIMIT ?",
+            (wxid, start or 0, end or float("inf"), limit)).fetchall()
+        return list(reversed(rows))
+    
+    def token_usage(self, since=0):
+        """按调用类型汇总since之后的token用量"""
+        return self._connection().execute(
+            "SELECT kind, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens) FROM token_usage "
+            "WHERE ts >= ? GROUP BY kind ORDER BY kind", (since,)).fetchall()
+    
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, queued=self.queue.qsize())
+
+# SQLite存储的历史对话记录
+class SqliteConversationManager(ConversationManager):
+    """
+    对话历史保存在SQLite数据库中：每条消息是messages表的一行，会话状态（摘要、角色卡等）定期写入sessions表作为检查点，
+    加载时读取检查点之前的最近消息，再重放检查点之后的消息。首次加载时自动迁移同名的JSON历史文件
+    """
+    def __init__(self, store, session_key, legacy_file, max_history=50, character_card=None):
+        self.store = store
+        self.session_key = session_key
+        self.reset_seq = 0  # 最近一次重置的序号，之前的消息不再属于当前对话
+        self.migrating = False
+        super().__init__(max_history=max_history, conversation_file=legacy_file, character_card=character_card)
+    
+    def _append_journal(self, record):
+        """消息写入messages表，其他变更（重置、摘要）立即写入检查点"""
+        if self.closed:
+            return
+        self.seq += 1
+        with metrics.timer("history_journal_seconds"):
+            if record["op"] != "message":
+                if record["op"] == "reset":
+                    self.reset_seq = self.seq
+                self.save_history()
+                return
+            
+            self.store.add_message(self.session_key, self.seq, record["role"], record["content"], time.time())
+            self.journal_records += 1
+        
+        # 限制加载时需要重放的消息数
+        if self.journal_records >= HISTORY_COMPACT_THRESHOLD:
+            self.save_history()
+    
+    def save_history(self):
+        """把会话状态写入检查点（只放入写入队列，不等待提交）"""
+        if self.migrating:
+            return
+        
+        with self.lock, metrics.timer("history_snapshot_seconds"):
+            if self.closed:
+                return
+            if self.card:
+                self.store.save_card(self.card)
+            self.store.save_session(self.session_key, self.seq, self.reset_seq, self.history[0]["content"],
+                                    self.card.content_hash if self.card else None, self.summary,
+                                    self.block_summaries, self.pending_summary,
+                                    len(self.history) - self.window_start)
+            self.journal_records = 0
+    
+    def load_history(self):
+        """从检查点和之后的消息恢复对话历史，数据库中没有该会话时迁移JSON历史文件"""
+        state = self.store.load_session(self.session_key)
+        if state is None:
+            if os.path.exists(self.conversation_file):
+                return self._migrate_legacy()
+            
+            with self.lock:
+                self.initialize_with_system_message()
+                self.save_history()
+            return False
+        
+        with self.lock:
+            self.loading = True
+            self.seq = state["seq"]
+            self.reset_seq = state["reset_seq"]
+            self.system_message = {"role": "system", "content": state["system_prompt"] or self.system_message["content"]}
+            self.summary = state["summary"]
+            self.block_summaries = state["block_summaries"]
+            self.pending_summary = state["pending_summary"]
+            
+            if state["card_hash"]:
+                if self.shared_card and state["card_hash"] == self.shared_card.content_hash:
+                    self.card = self.shared_card
+                else:
+                    character_data = self.store.load_card(state["card_hash"])
+                    self.card = self._load_card(character_data, state["card_hash"]) if character_data else None
+                self.character_data = self.card.raw if self.card else None
+            
+            messages = self.store.load_messages(self.session_key, self.reset_seq, self.seq, self.max_history)
+            self.history = deque([self.system_message] + [msg for _, msg in messages])
+            self._rebuild_token_index(state["window_size"])
+            
+            # 重放检查点之后的消息
+            replayed = self.store.load_messages(self.session_key, self.seq)
+            for seq, msg in replayed:
+                self._apply_message(msg["role"], msg["content"])
+                self.seq = seq
+            
+            self.loading = False
+            if SUMMARY_ENABLED and len(self.pending_summary) >= SUMMARY_BLOCK_SIZE:
+                history_summarizer.schedule(self)
+        
+        log_event("history_loaded", f"已加载{len(self.history) - 1}条历史消息", logging.DEBUG,
+                  session=self.session_key, replayed=len(replayed))
+        return True
+    
+    def _migrate_legacy(self):
+        """把JSON快照和日志中的历史导入数据库，成功后把旧文件重命名为.migrated"""
+        self.migrating = True
+        try:
+            loaded = super().load_history()
+        finally:
+            self.migrating = False
+        
+        with self.lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            
+            # 旧文件只保存了最近的消息，按顺序重新编号，时间统一记为文件的修改时间
+            ts = os.path.getmtime(self.conversation_file)
+            messages = list(itertools.islice(self.history, 1, None))
+            self.store.import_messages(self.session_key, [(seq, msg, ts) for seq, msg in enumerate(messages, 1)])
+            self.seq = len(messages)
+            self.reset_seq = 0
+            self.journal_records = 0
+            self.save_history()
+        
+        # 确认写入数据库后再处理旧文件
+        self.store.wait_for_session(self.session_key)
+        for path in (self.conversation_file, self.journal_file, self.rotated_journal_file):
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        
+        log_event("history_migrated", f"已把{self.conversation_file}中的{len(messages)}条消息导入数据库",
+                  session=self.session_key, messages=len(messages))
+        return loaded
+
+# 按联系人划分的会话存储
+class SessionStore:
+    """按wxid（群聊中按群+发送者）管理独立的对话历史，按需加载，闲置时按LRU换出"""
+    instances = weakref.WeakSet()  # 所有会话存储，用于导出内存中会话数指标
+    
+    def __init__(self, session_dir=SESSION_DIR, max_loaded=SESSION_MAX_LOADED,
+                 max_memory=SESSION_MAX_MEMORY, max_history=50, backend=STORAGE_BACKEND, db=None, account=None):
+        """
+        :param db: 共用的SqliteStore（多账号时传入），不传时在会话目录下创建
+        :param account: 账号名，共用数据库时作为会话键的前缀区分不同账号
+        """
+        self.session_dir = session_dir
+        self.max_loaded = max_loaded
+        self.max_memory = max_memory
+        self.max_history = max_history
+        self.character_data = None
+        self.card = None  # 所有会话共享的编译后角色卡
+        self.sessions = OrderedDict()  # key -> ConversationManager，按最近使用排序
+        self.last_access = {}
+        self.memory_usage = {}
+        self.total_memory = 0
+        self.pins = {}  # key -> 正在使用该会话的次数，使用中的会话不会被换出
+        self.evict_listeners = []  # 会话移出内存后调用listener(key)，用于释放与会话相关的状态
+        self.lock = threading.RLock()
+        self.account = account
+        SessionStore.instances.add(self)
+        
+        os.makedirs(self.session_dir, exist_ok=True)
+        if backend == "sqlite" and db is None:
+            db = SqliteStore(os.path.join(session_dir, SQLITE_DB_FILE))
+        self.db = db if backend == "sqlite" else None
+    
+    @staticmethod
+    def session_key(wxid, chatroom=None):
+        """生成会话键：私聊为wxid，群聊为 群ID:发送者wxid"""
+        if chatroom:
+            return f"{chatroom}:{wxid}"
+        return wxid
+    
+    def db_key(self, key):
+        """会话在数据库中的键：共用数据库时加上账号前缀"""
+        return f"{self.account}/{key}" if self.account else key
+    
+    def _session_file(self, key):
+        """会话对应的历史文件路径"""
+        safe_name = re.sub(r'[^\w@.-]', '_', key)
+        return os.path.join(self.session_dir, f"{safe_name}.json")
+    
+    def get(self, wxid, chatroom=None, pin=False):
+        """
+        获取会话，不在内存中时从磁盘加载
+        :param pin: 是否固定会话直到调用release，期间不会被换出（生成回复等耗时操作使用）
+        """
+        key = self.session_key(wxid, chatroom)
+        
+        with self.lock:
+            manager = self.sessions.get(key)
+            if manager is None:
+                if self.db is not None:
+                    manager = SqliteConversationManager(self.db, self.db_key(key), self._session_file(key),
+                                                        max_history=self.max_history, character_card=self.card)
+                else:
+                    manager = ConversationManager(max_history=self.max_history,
+                                                  conversation_file=self._session_file(key),
+                                                  character_card=self.card)
+                
+                # 磁盘上的历史属于其他角色卡时，按当前角色卡重新开始
+                if self.card and (manager.card is None or manager.card.content_hash != self.card.content_hash):
+                    manager.set_character(self.card)
+                
+                self.sessions[key] = manager
+            else:
+                self.sessions.move_to_end(key)
+            
+            self.last_access[key] = time.time()
+            if pin:
+                self.pins[key] = self.pins.get(key, 0) + 1
+            
+            # 更新该会话的内存估算值
+            usage = manager.estimate_memory()
+            self.total_memory += usage - self.memory_usage.get(key, 0)
+            self.memory_usage[key] = usage
+            
+            self._evict_idle()
+            return manager
+    
+    def release(self, wxid, chatroom=None):
+        """结束使用get(pin=True)固定的会话"""
+        key = self.session_key(wxid, chatroom)
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+    
+    @contextlib.contextmanager
+    def pinned(self, wxid, chatroom=None):
+        """with块内固定会话，返回对话管理器"""
+        manager = self.get(wxid, chatroom, pin=True)
+        try:
+            yield manager
+        finally:
+            self.release(wxid, chatroom)
+    
+    def _within_limits(self):
+        return len(self.sessions) <= self.max_loaded and self.total_memory <= self.max_memory
+    
+    def _evict_idle(self):
+        """超过数量或内存上限时，把最久未使用的闲置会话写回磁盘并移出内存"""
+        if self._within_limits():
+            return
+        
+        now = time.time()
+        for key in list(self.sessions):
+            # 最久未使用的会话仍然活跃，说明所有会话都在活跃中，暂不换出
+            if self._within_limits() or now - self.last_access.get(key, 0) < SESSION_MIN_IDLE:
+                break
+            self.evict(key)
+    
+    def evict(self, key):
+        """
+        把会话写回磁盘并移出内存，正在使用的会话不换出
+        :return: 是否已换出
+        """
+        # 持有锁直到写回完成，避免同一会话在写回期间被重新加载出第二个管理器
+        with self.lock:
+            if self.pins.get(key) or key not in self.sessions:
+                return False
+            manager = self.sessions.pop(key)
+            self.last_access.pop(key, None)
+            self.total_memory -= self.memory_usage.pop(key, 0)
+            
+            manager.save_history()
+            manager.close()
+            for listener in self.evict_listeners:
+                listener(key)
+        return True
+    
+    def set_character(self, character_data):
+        """为所有会话设置角色卡（未加载的会话在下次加载时应用）"""
+        try:
+            card = character_data if isinstance(character_data, CharacterCard) else \
+                   CharacterCard.compile(character_data)
+        except ValueError as e:
+            print(f"角色卡验证失败: {e}")
+            return False
+        
+        with self.lock:
+            self.card = card
+            self.character_data = card.raw
+            loaded_sessions = list(self.sessions.values())
+        
+        # 所有会话共用同一个编译结果
+        for manager in loaded_sessions:
+            manager.shared_card = card
+            manager.set_character(card)
+        
+        print(f"已为所有会话设置角色卡 (内存中会话: {len(loaded_sessions)})")
+        return True
+    
+    def flush_all(self):
+        """把内存中的所有会话写回磁盘"""
+        with self.lock:
+            loaded_sessions = list(self.sessions.values())
+        
+        for manager in loaded_sessions:
+            manager.save_history()
+        if self.db is not None:
+            self.db.flush()
+    
+    def import_legacy_history(self, path, wxid):
+        """把旧版单文件对话历史（conversation_history.json）迁移为wxid的会话，该会话已有历史时不导入"""
+        if not os.path.exists(path):
+            return False
+        
+        with self.lock:
+            session_file = self._session_file(wxid)
+            if wxid in self.sessions or (self.db.load_session(self.db_key(wxid)) is not None if self.db is not None
+                                         else os.path.exists(session_file)):
+                print(f"会话 {wxid} 已有历史记录，跳过迁移 {path}")
+                return False
+            
+            if self.db is not None:
+                SqliteConversationManager(self.db, self.db_key(wxid), path, max_history=self.max_history)
+            else:
+                # 快照和日志格式相同，复制到会话目录即可，原文件保留为.migrated
+                journal_file = os.path.splitext(path)[0] + ".journal"
+                session_journal = os.path.splitext(session_file)[0] + ".journal"
+                for src, dst in ((path, session_file), (journal_file, session_journal),
+                                 (journal_file + ".1", session_journal + ".1")):
+                    if os.path.exists(src):
+                        shutil.copy2(src, dst)
+                        os.replace(src, src + ".migrated")
+        
+        print(f"已把 {path} 迁移为会话 {wxid}")
+        return True
 
 # TavernCardValidator类 - 角色卡验证器
 class TavernCardValidator:
@@ -308,6 +2274,53 @@ class TavernCardValidator:
         
         return True
 
+# 编译后的角色卡
+class CharacterCard:
+    """验证并规范化后的V1/V2/V3角色卡，加载时构建一次，之后只读取属性"""
+    def __init__(self, raw, version):
+        self.raw = raw
+        self.version = version
+        
+        # V1字段在顶层，V2/V3字段在data中
+        fields = raw if version == 1 else (raw.get('data') or {})
+        self.name = fields.get('name') or 'Assistant'
+        self.description = fields.get('description', '')
+        self.personality = fields.get('personality', '')
+        self.scenario = fields.get('scenario', '')
+        self.first_mes = fields.get('first_mes', '')
+        self.mes_example = fields.get('mes_example', '')
+        self.creator_notes = fields.get('creator_notes', '')
+        self.post_history_instructions = fields.get('post_history_instructions') or ''
+        self.alternate_greetings = list(fields.get('alternate_greetings') or [])
+        self.tags = list(fields.get('tags') or [])
+        self.creator = fields.get('creator', '')
+        self.character_version = fields.get('character_version', '')
+        
+        # 预先生成系统提示词
+        default_prompt = f"You are {self.name}, {self.description}. Your personality: {self.personality}. Scenario: {self.scenario}"
+        if version == 1:
+            self.system_prompt = default_prompt
+        else:
+            self.system_prompt = fields.get('system_prompt') or default_prompt
+        
+        # 提示词中使用的JSON文本和用于比较角色卡的内容哈希
+        self.card_json = json.dumps(raw, ensure_ascii=False, indent=2)
+        self.content_hash = hashlib.sha256(
+            json.dumps(raw, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    @classmethod
+    def compile(cls, raw):
+        """验证并编译角色卡，验证失败时抛出ValueError"""
+        if not isinstance(raw, dict):
+            raise ValueError("角色卡数据不是JSON对象")
+        
+        card_validator = TavernCardValidator(raw)
+        card_version = card_validator.validate()
+        if not card_version:
+            raise ValueError(card_validator.lastValidationError)
+        
+        return cls(raw, card_version)
+
 # 角色卡处理
 def load_character_card(file_path):
     """加载角色卡（支持JSON和PNG格式）"""
@@ -333,30 +2346,30 @@ def load_character_card(file_path):
         return None
 
 def extract_character_from_png(png_path):
-    """从PNG图片中提取角色卡数据"""
+    """从PNG图片中提取角色卡数据（逐块读取，跳过图像数据，不把整个文件读入内存）"""
     try:
-        # 读取PNG文件
-        with open(png_path, 'rb') as f:
-            buffer = f.read()
-        
-        # 提取文本块
-        chunks = extract_chunks(buffer)
-        text_chunks = [chunk for chunk in chunks if chunk["type"] == b'tEXt']
-        
-        if not text_chunks:
-            print("PNG图片中不包含任何文本块")
-            return None
-        
         # 优先查找ccv3格式的数据
         ccv3_data = None
         chara_data = None
+        found_text = False
         
-        for chunk in text_chunks:
-            keyword, text = decode_text_chunk(chunk["data"])
-            if keyword.lower() == 'ccv3':
-                ccv3_data = text
-            elif keyword.lower() == 'chara':
-                chara_data = text
+        # 不使用缓冲，跳过大块图像数据时只读取块头
+        with open(png_path, 'rb', buffering=0) as f:
+            for chunk_type, chunk_data in iter_png_text_chunks(f):
+                found_text = True
+                keyword, text = decode_png_text_chunk(chunk_type, chunk_data)
+                if not keyword:
+                    continue
+                
+                if keyword.lower() == 'ccv3':
+                    ccv3_data = text
+                    break  # ccv3优先级最高，找到后无需继续读取
+                elif keyword.lower() == 'chara':
+                    chara_data = text
+        
+        if not found_text:
+            print("PNG图片中不包含任何文本块")
+            return None
         
         # 尝试解析ccv3数据
         if ccv3_data:
@@ -374,36 +2387,218 @@ def extract_character_from_png(png_path):
             except:
                 pass
         
-        print("无法从PNG提取角色数据")
-        return None
-    except Exception as e:
-        print(f"提取角色数据时出错: {e}")
-        return None
+        print("无法从PNG提取角色数据")
+        return None
+    except Exception as e:
+        print(f"提取角色数据时出错: {e}")
+        return None
+
+# 角色卡库
+class CharacterCardLibrary:
+    """扫描角色卡目录并维护磁盘索引（按路径、修改时间和大小），重新扫描时只解析有变化的文件"""
+    def __init__(self, directory=CARD_LIBRARY_DIR, index_file=CARD_LIBRARY_INDEX,
+                 cache_size=CARD_LIBRARY_CACHE_SIZE):
+        self.directory = directory
+        self.index_file = index_file
+        self.cache_size = cache_size
+        self.index = {}  # 路径 -> {mtime, size, name, tags, version, hash, error}
+        self.cache = OrderedDict()  # (路径, mtime, size) -> CharacterCard
+        self.lock = threading.RLock()
+        self._load_index()
+    
+    def _load_index(self):
+        """读取磁盘上的索引"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f).get("cards", {})
+        except Exception as e:
+            print(f"读取角色卡索引失败，将重新扫描: {e}")
+            self.index = {}
+    
+    def _save_index(self):
+        """原子写入索引文件"""
+        try:
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"directory": self.directory, "cards": self.index}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            print(f"保存角色卡索引失败: {e}")
+    
+    def scan(self):
+        """增量扫描角色卡目录，返回 (新增或更新数, 删除数)"""
+        if not os.path.isdir(self.directory):
+            return 0, 0
+        
+        with self.lock:
+            seen = set()
+            updated = 0
+            
+            for root, _, files in os.walk(self.directory):
+                for file_name in files:
+                    if os.path.splitext(file_name)[1].lower() not in ('.json', '.png'):
+                        continue
+                    
+                    path = os.path.join(root, file_name)
+                    seen.add(path)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    
+                    # 修改时间和大小都没变的文件不再解析
+                    entry = self.index.get(path)
+                    if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                        continue
+                    
+                    self.index[path] = self._index_entry(path, stat)
+                    updated += 1
+            
+            removed = [path for path in self.index if path not in seen]
+            for path in removed:
+                del self.index[path]
+            
+            if updated or removed:
+                self._save_index()
+            
+            return updated, len(removed)
+    
+    def _index_entry(self, path, stat):
+        """解析角色卡并生成索引条目（解析结果同时放入缓存）"""
+        entry = {"mtime": stat.st_mtime, "size": stat.st_size}
+        card = self._compile(path, stat)
+        if card:
+            entry.update({
+                "name": card.name,
+                "tags": card.tags,
+                "version": card.version,
+                "hash": card.content_hash
+            })
+        else:
+            entry["error"] = "无法加载或验证失败"
+        return entry
+    
+    def _compile(self, path, stat):
+        """加载并编译角色卡，结果按 (路径, mtime, size) 缓存"""
+        cache_key = (path, stat.st_mtime, stat.st_size)
+        card = self.cache.get(cache_key)
+        if card is not None:
+            self.cache.move_to_end(cache_key)
+            return card
+        
+        character_data = load_character_card(path)
+        if not character_data:
+            return None
+        
+        try:
+            card = CharacterCard.compile(character_data)
+        except ValueError as e:
+            print(f"角色卡验证失败: {path} ({e})")
+            return None
+        
+        self.cache[cache_key] = card
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return card
+    
+    def load(self, path):
+        """加载角色卡（可以是库外的路径），返回CharacterCard，失败时返回None"""
+        if not os.path.exists(path):
+            print(f"文件不存在: {path}")
+            return None
+        
+        with self.lock:
+            return self._compile(path, os.stat(path))
+    
+    def list_cards(self):
+        """返回可用角色卡列表 [(路径, 索引条目)]，按名称排序"""
+        with self.lock:
+            cards = [(path, entry) for path, entry in self.index.items() if not entry.get("error")]
+        return sorted(cards, key=lambda item: (item[1]["name"], item[0]))
+    
+    def find(self, query):
+        """按序号（从1开始）、路径或名称查找角色卡路径"""
+        cards = self.list_cards()
+        if query.isdigit() and 1 <= int(query) <= len(cards):
+            return cards[int(query) - 1][0]
+        
+        for path, entry in cards:
+            if query == path or query.lower() == entry["name"].lower():
+                return path
+        return None
+
+# PNG解析辅助函数
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+
+def iter_png_text_chunks(f):
+    """
+    逐块读取PNG文件，只读取并校验文本块，其余块（如IDAT图像数据）直接跳过
+    :param f: 以二进制模式打开的可seek文件对象
+    :return: 生成 (块类型, 块数据)
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("不是有效的PNG文件")
+    
+    while True:
+        # 每个块由4字节长度、4字节类型、数据和4字节CRC组成
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        
+        chunk_length = int.from_bytes(header[:4], 'big')
+        chunk_type = header[4:8]
+        
+        if chunk_type == b'IEND':
+            break
+        
+        if chunk_type not in PNG_TEXT_CHUNK_TYPES:
+            f.seek(chunk_length + 4, os.SEEK_CUR)
+            continue
+        
+        chunk_data = f.read(chunk_length)
+        crc = f.read(4)
+        if len(chunk_data) < chunk_length or len(crc) < 4:
+            raise ValueError("PNG文件不完整")
+        
+        if zlib.crc32(chunk_type + chunk_data) != int.from_bytes(crc, 'big'):
+            print(f"PNG文本块CRC校验失败，已跳过: {chunk_type.decode('latin1')}")
+            continue
+        
+        yield chunk_type, chunk_data
 
-# PNG解析辅助函数
-def extract_chunks(data):
-    """提取PNG中的数据块"""
-    chunks = []
+def decode_png_text_chunk(chunk_type, data):
+    """解码tEXt/zTXt/iTXt文本块，返回(关键字, 文本)"""
+    if chunk_type == b'tEXt':
+        return decode_text_chunk(data)
     
-    # PNG头部是8字节
-    pos = 8
+    null_pos = data.find(0)
+    if null_pos == -1:
+        return None, None
+    keyword = data[:null_pos].decode('latin1')
     
-    while pos < len(data):
-        # 每个块由4字节长度、4字节类型、数据和4字节CRC组成
-        chunk_length = int.from_bytes(data[pos:pos+4], 'big')
-        chunk_type = data[pos+4:pos+8]
-        chunk_data = data[pos+8:pos+8+chunk_length]
-        
-        chunks.append({
-            "length": chunk_length,
-            "type": chunk_type,
-            "data": chunk_data
-        })
+    try:
+        if chunk_type == b'zTXt':
+            # 关键字\0 + 1字节压缩方式 + zlib压缩的文本
+            return keyword, zlib.decompress(data[null_pos + 2:]).decode('latin1')
         
-        # 移动到下一个块
-        pos += 12 + chunk_length
+        if chunk_type == b'iTXt':
+            # 关键字\0 + 压缩标志 + 压缩方式 + 语言标签\0 + 翻译后的关键字\0 + UTF-8文本
+            compressed = data[null_pos + 1] == 1
+            rest = data[null_pos + 3:]
+            language_end = rest.find(0)
+            translated_end = rest.find(0, language_end + 1)
+            if language_end == -1 or translated_end == -1:
+                return None, None
+            text = rest[translated_end + 1:]
+            if compressed:
+                text = zlib.decompress(text)
+            return keyword, text.decode('utf-8')
+    except (zlib.error, UnicodeDecodeError, IndexError):
+        print(f"PNG文本块解码失败: {keyword}")
     
-    return chunks
+    return None, None
 
 def decode_text_chunk(data):
     """解码文本块数据"""
@@ -419,75 +2614,147 @@ def decode_text_chunk(data):
 
 # AI自主消息系统
 class AIAutonomousSystem:
-    def __init__(self, token, conversation_manager):
+    def __init__(self, token, conversation_manager, session_store=None):
         self.token = token
         self.wxid = "filehelper"  # 默认发送到文件传输助手
-        self.conversation_manager = conversation_manager
+        self._conversation_manager = conversation_manager
+        self.session_store = session_store
         self.running = False
-        self.thread = None
+        self.scheduler = None
         self.last_analysis_time = 0
         self.analyze_interval = 60  # 每60秒分析一次
         self.is_analyzing = False
         self.last_user_message_time = time.time()
         self.listener = None
+        
+        # 分析门控：对话状态未变化且上次判定为不发言时，按指数退避跳过分析
+        self.analyzed_version = None  # 上次分析时的历史版本号
+        self.consecutive_no = 0  # 连续判定不发言的次数
+        self.next_retry_time = 0  # 同一状态下次允许分析的时间
+        self.unanswered_count = 0  # 用户回复之前已发送的主动消息数
     
-    def start(self):
-        """启动自主消息系统"""
+    @property
+    def conversation_manager(self):
+        """当前目标对应的对话管理器（使用会话存储时按wxid获取）"""
+        if self.session_store:
+            return self.session_store.get(self.wxid)
+        return self._conversation_manager
+    
+    def start(self, scheduler=None, immediate=True):
+        """
+        启动自主消息系统
+        :param scheduler: 负责安排分析时间的调度器，默认使用全局共享的调度器
+        :param immediate: 是否立即进行第一次分析
+        """
         if self.running:
-            print("AI自主消息系统已在运行中")
+            log_event("autonomous_already_running", "AI自主消息系统已在运行中", wxid=self.wxid)
             return
         
-        if not self.conversation_manager.character_data:
-            print("请先加载角色卡再启动自主消息系统")
+        # 只检查角色卡是否已加载，不在这里加载会话
+        has_card = self.session_store.card if self.session_store else \
+                   getattr(self._conversation_manager, "character_data", None)
+        if not has_card:
+            log_event("autonomous_no_card", "请先加载角色卡再启动自主消息系统", logging.WARNING, wxid=self.wxid)
             return
         
         self.running = True
-        self.thread = threading.Thread(target=self._autonomous_loop)
-        self.thread.daemon = True
-        self.thread.start()
-        print(f"已启动AI自主消息系统 (目标: {self.wxid})")
+        self.scheduler = scheduler or autonomous_scheduler
+        self.scheduler.reschedule(self)
+        log_event("autonomous_started", f"已启动AI自主消息系统 (目标: {self.wxid})", wxid=self.wxid)
         
         # 立即进行第一次分析
-        self.analyze_now()
+        if immediate:
+            self.analyze_now()
     
     def stop(self):
         """停止自主消息系统"""
         if not self.running:
-            print("AI自主消息系统未运行")
+            log_event("autonomous_not_running", "AI自主消息系统未运行", wxid=self.wxid)
             return
         
         self.running = False
-        if self.thread:
-            self.thread.join(timeout=1.0)
-        print("已停止AI自主消息系统")
+        if self.scheduler:
+            self.scheduler.cancel(self)
+        log_event("autonomous_stopped", f"已停止AI自主消息系统 (目标: {self.wxid})", wxid=self.wxid)
     
     def record_user_activity(self):
         """记录用户活动时间"""
         self.last_user_message_time = time.time()
+        self.unanswered_count = 0
+        self.consecutive_no = 0
+        
+        # 用户刚发来消息，按新的闲置时间重新安排下次分析
+        if self.running and self.scheduler:
+            self.scheduler.reschedule(self)
+    
+    def next_analysis_delay(self, now):
+        """距离下次值得分析还有多少秒；返回None表示在用户回复之前不需要分析"""
+        if not self.running or self.unanswered_count >= AUTONOMOUS_MAX_UNANSWERED:
+            return None
+        
+        due_time = max(self.last_analysis_time + self.analyze_interval,
+                       self.last_user_message_time + AUTONOMOUS_MIN_IDLE)
+        # 连续判定不发言时按退避时间推迟
+        if self.consecutive_no > 0:
+            due_time = max(due_time, self.next_retry_time)
+        return max(due_time - now, 0)
+    
+    def _should_analyze(self, now):
+        """本地预过滤，判断是否值得调用AI分析（不满足条件时几乎零开销）"""
+        # 已经连续发送多条主动消息而用户没有回复
+        if self.unanswered_count >= AUTONOMOUS_MAX_UNANSWERED:
+            return False
+        
+        # 用户刚刚还在聊天，由正常回复流程处理
+        if now - self.last_user_message_time < AUTONOMOUS_MIN_IDLE:
+            return False
+        
+        # 对话状态与上次“不发言”的判定相同，退避期内不重复分析
+        if (self.analyzed_version == self.conversation_manager.version and
+                self.consecutive_no > 0 and now < self.next_retry_time):
+            return False
+        
+        return True
+    
+    def _record_verdict(self, version, should_send, reason=None, message_type=None):
+        """记录分析结论，用于后续门控（使用SQLite存储时同时写入decisions表）"""
+        metrics.inc("autonomous_decisions_total", result="send" if should_send else "skip")
+        conversation_manager = self.conversation_manager
+        if isinstance(conversation_manager, SqliteConversationManager):
+            conversation_manager.store.record_decision(
+                conversation_manager.session_key, should_send, reason, message_type,
+                "combined" if AUTONOMOUS_COMBINED_MODE else "two_step")
+        self.analyzed_version = version
+        if should_send:
+            self.consecutive_no = 0
+            self.next_retry_time = 0
+        else:
+            self.consecutive_no += 1
+            delay = min(self.analyze_interval * (2 ** (self.consecutive_no - 1)), AUTONOMOUS_MAX_BACKOFF)
+            self.next_retry_time = time.time() + delay
     
     def analyze_now(self):
         """立即分析对话状态"""
         if not self.is_analyzing and self.running:
             self._analyze_conversation_state()
     
-    def _autonomous_loop(self):
-        """自主消息循环"""
-        while self.running:
-            try:
-                now = time.time()
-                # 只在间隔时间到了才分析
-                if now - self.last_analysis_time > self.analyze_interval:
-                    # 确保WebSocket连接正常后再进行分析
-                    if hasattr(self, 'listener') and self.listener and self.listener.ws and self.listener.ws.sock and self.listener.ws.sock.connected:
-                        self._analyze_conversation_state()
-                        self.last_analysis_time = now
-                    else:
-                        print("WebSocket连接未就绪，跳过本次分析")
-                
-                time.sleep(5)  # 检查间隔
-            except Exception as e:
-                print(f"自主消息循环出错: {e}")
-                time.sleep(5)
+    def due(self, now):
+        """是否到了分析时间且本地预过滤通过"""
+        return (self.running and not self.is_analyzing and
+                now - self.last_analysis_time > self.analyze_interval and self._should_analyze(now))
+    
+    def tick(self, now=None):
+        """执行一次检查，需要时进行分析"""
+        now = now or time.time()
+        # 只在间隔时间到了、且本地预过滤通过时才分析
+        if self.due(now):
+            # 确保WebSocket连接正常后再进行分析
+            if hasattr(self, 'listener') and self.listener and self.listener.ws and self.listener.ws.sock and self.listener.ws.sock.connected:
+                self._analyze_conversation_state()
+                self.last_analysis_time = now
+            else:
+                log_event("autonomous_skipped", "WebSocket连接未就绪，跳过本次分析", logging.WARNING, wxid=self.wxid)
+    
     
     def _analyze_conversation_state(self):
         """分析对话状态，决定是否发送消息"""
@@ -495,13 +2762,25 @@ class AIAutonomousSystem:
             return
         
         self.is_analyzing = True
+        start_time = time.perf_counter()
+        pinned_wxid = None
         
         try:
+            # 分析和生成期间固定会话，避免耗时的AI请求期间会话被换出内存
+            if self.session_store:
+                pinned_wxid = self.wxid
+                self.session_store.get(pinned_wxid, pin=True)
+            version = self.conversation_manager.version
+            
+            if AUTONOMOUS_COMBINED_MODE:
+                self._decide_and_generate(version)
+                return
+            
             # 创建分析提示词
             system_prompt = "你将分析一个角色是否会在当前对话情境中自然地主动发言。分析时使用角色卡中的原始定义。请返回JSON格式：{\"shouldSendMessage\": true/false, \"reason\": \"理由\", \"messageType\": \"消息类型\"}"
             user_prompt = f"""以下是原始角色卡数据：
 ```json
-{json.dumps(self.conversation_manager.character_data, ensure_ascii=False, indent=2)}
+{self.conversation_manager.get_card_json()}
 ```
 
 完整对话历史记录（从开始到现在）：
@@ -533,11 +2812,14 @@ class AIAutonomousSystem:
                 "stream": False
             }
             
-            response = httpx.post(AI_API_URL, headers=headers, json=payload)
-            data = response.json()
+            with metrics.timer("ai_request_seconds", kind="autonomous_analysis"):
+                response = http_clients.post("ai", AI_API_URL, headers=headers, json=payload)
+                data = response.json()
             
             if "choices" in data and len(data["choices"]) > 0:
                 analysis_result = data["choices"][0]["message"]["content"]
+                record_ai_usage("autonomous_analysis", payload, data, analysis_result,
+                                conversation=self.conversation_manager)
                 
                 # 解析JSON结果 - 处理可能的markdown格式
                 try:
@@ -549,28 +2831,40 @@ class AIAutonomousSystem:
                         # 直接尝试解析整个文本
                         decision = json.loads(analysis_result)
                     
+                    self._record_verdict(version, bool(decision.get("shouldSendMessage")),
+                                         decision.get("reason"), decision.get("messageType"))
                     if decision.get("shouldSendMessage"):
-                        print(f"[分析] {self.conversation_manager.get_character_name()}会在此时主动发言，原因：{decision.get('reason')}")
+                        log_event("autonomous_decision", f"[分析] {self.conversation_manager.get_character_name()}会在此时主动发言，原因：{decision.get('reason')}",
+                                  wxid=self.wxid, should_send=True, message_type=decision.get("messageType"))
                         self._generate_and_send_message(decision.get("messageType", "一般对话"))
                     else:
-                        print(f"[分析] {self.conversation_manager.get_character_name()}此时不会主动发言，原因：{decision.get('reason')}")
+                        log_event("autonomous_decision", f"[分析] {self.conversation_manager.get_character_name()}此时不会主动发言，原因：{decision.get('reason')}",
+                                  wxid=self.wxid, should_send=False)
                 
                 except json.JSONDecodeError:
                     # 如果JSON解析失败，使用简单的文本匹配
                     if "应该主动发言" in analysis_result.lower() and "不应该主动发言" not in analysis_result.lower():
-                        print("[分析] 基于文本分析，角色应该主动发言")
+                        log_event("autonomous_decision", "[分析] 基于文本分析，角色应该主动发言", wxid=self.wxid, should_send=True)
+                        self._record_verdict(version, True, "基于文本分析")
                         self._generate_and_send_message("一般对话")
                     else:
-                        print("[分析] 基于文本分析，角色不应该主动发言")
+                        log_event("autonomous_decision", "[分析] 基于文本分析，角色不应该主动发言", wxid=self.wxid, should_send=False)
+                        self._record_verdict(version, False, "基于文本分析")
             
             else:
-                print("分析API返回格式错误")
+                log_event("ai_bad_response", "分析API返回格式错误", logging.WARNING, kind="autonomous")
+                metrics.inc("ai_errors_total", kind="autonomous_analysis")
         
         except Exception as e:
-            print(f"分析对话状态出错: {e}")
+            log_event("autonomous_error", f"分析对话状态出错: {e}", logging.ERROR, wxid=self.wxid)
+            metrics.inc("autonomous_decisions_total", result="error")
         
         finally:
             self.is_analyzing = False
+            if pinned_wxid is not None:
+                self.session_store.release(pinned_wxid)
+            mode = "combined" if AUTONOMOUS_COMBINED_MODE else "two_step"
+            metrics.observe("autonomous_analysis_seconds", time.perf_counter() - start_time, mode=mode)
     
     def _generate_and_send_message(self, message_type):
         """生成并发送自主消息"""
@@ -579,7 +2873,7 @@ class AIAutonomousSystem:
             system_prompt = "根据角色卡定义和对话历史生成一条符合当前情境的自然回复。"
             user_prompt = f"""角色卡数据：
 ```json
-{json.dumps(self.conversation_manager.character_data, ensure_ascii=False, indent=2)}
+{self.conversation_manager.get_card_json()}
 ```
 
 完整对话历史记录：
@@ -603,80 +2897,1088 @@ class AIAutonomousSystem:
                 "stream": False
             }
             
-            response = httpx.post(AI_API_URL, headers=headers, json=payload)
-            data = response.json()
+            message = None
+            if STREAM_REPLIES:
+                # 流式生成，逐句发送，完整文本最后写入历史
+                wxid = self.wxid
+                message = stream_chat_completion(
+                    headers, payload, lambda chunk: send_wechat_message(wxid, chunk, self.token),
+                    kind="autonomous_generate", conversation=self.conversation_manager)
+                if message:
+                    self.conversation_manager.add_message("assistant", message)
+            else:
+                with metrics.timer("ai_request_seconds", kind="autonomous_generate"):
+                    response = http_clients.post("ai", AI_API_URL, headers=headers, json=payload)
+                    data = response.json()
+                
+                if "choices" in data and len(data["choices"]) > 0:
+                    message = data["choices"][0]["message"]["content"]
+                    record_ai_usage("autonomous_generate", payload, data, message,
+                                    conversation=self.conversation_manager)
+                    
+                    # 添加到对话历史
+                    self.conversation_manager.add_message("assistant", message)
+                    
+                    # 发送消息
+                    send_wechat_message(self.wxid, message, self.token)
+            
+            if message:
+                self._on_autonomous_message_sent(message)
+            else:
+                log_event("ai_bad_response", "生成消息API返回格式错误", logging.WARNING, kind="autonomous_generate")
+        
+        except StreamInterrupted as e:
+            log_event("autonomous_error", f"生成和发送自主消息出错: {e}", logging.ERROR, wxid=self.wxid)
+            self.conversation_manager.add_message("assistant", e.partial_text + STREAM_INTERRUPTED_MARK)
+            self._on_autonomous_message_sent(e.partial_text)
+        except Exception as e:
+            log_event("autonomous_error", f"生成和发送自主消息出错: {e}", logging.ERROR, wxid=self.wxid)
+    
+    def _decide_and_generate(self, version):
+        """一次结构化输出请求同时完成是否发言的判断和消息生成"""
+        system_prompt = "你将分析一个角色是否会在当前对话情境中自然地主动发言；如果会，同时写出角色此刻要说的话。分析时使用角色卡中的原始定义。不发言时message为空字符串。"
+        user_prompt = f"""以下是原始角色卡数据：
+```json
+{self.conversation_manager.get_card_json()}
+```
+
+完整对话历史记录（从开始到现在）：
+{self.conversation_manager.get_formatted_history(include_system=False)}
+
+请根据角色卡原始数据与完整对话历史，仔细分析判断角色是否会在当前情境下主动发言。分析时考虑：
+1. 角色的个性特点和内在动机
+2. 当前对话的情感氛围和上下文
+3. 角色与用户之间建立的关系
+4. 对话中的重要线索或信息
+5. 角色面临的情景和环境
+
+只有当符合角色的性格和当前情境时，才返回shouldSendMessage=true，并在message中直接写出角色此刻会说的话，不添加额外说明。
+记住，一个写得好的角色不会频繁打断用户，而是会在合适的时机自然地主动发言。"""
+
+        headers = {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {AI_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        
+        payload = {
+            "model": "gpt-4o",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "response_format": {"type": "json_schema", "json_schema": AUTONOMOUS_DECISION_SCHEMA},
+            "stream": False
+        }
+        
+        with metrics.timer("ai_request_seconds", kind="autonomous_decision"):
+            response = http_clients.post("ai", AI_API_URL, headers=headers, json=payload)
+            data = response.json()
+        
+        if "choices" not in data or len(data["choices"]) == 0:
+            log_event("ai_bad_response", "分析API返回格式错误", logging.WARNING, kind="autonomous")
+            metrics.inc("ai_errors_total", kind="autonomous_decision")
+            return
+        
+        record_ai_usage("autonomous_decision", payload, data, data["choices"][0]["message"].get("content"),
+                        conversation=self.conversation_manager)
+        try:
+            decision = json.loads(data["choices"][0]["message"]["content"])
+        except (json.JSONDecodeError, TypeError):
+            log_event("autonomous_decision", "[分析] 结构化输出解析失败，本次不主动发言", logging.WARNING, wxid=self.wxid, should_send=False)
+            self._record_verdict(version, False, "结构化输出解析失败")
+            return
+        
+        message = (decision.get("message") or "").strip()
+        should_send = bool(decision.get("shouldSendMessage")) and bool(message)
+        self._record_verdict(version, should_send, decision.get("reason"), decision.get("messageType"))
+        
+        char_name = self.conversation_manager.get_character_name()
+        if not should_send:
+            log_event("autonomous_decision", f"[分析] {char_name}此时不会主动发言，原因：{decision.get('reason')}",
+                      wxid=self.wxid, should_send=False)
+            return
+        
+        log_event("autonomous_decision", f"[分析] {char_name}会在此时主动发言，原因：{decision.get('reason')}",
+                  wxid=self.wxid, should_send=True, message_type=decision.get("messageType"))
+        self.conversation_manager.add_message("assistant", message)
+        send_wechat_message(self.wxid, message, self.token)
+        self._on_autonomous_message_sent(message)
+    
+    def _on_autonomous_message_sent(self, message):
+        """主动消息发送后的记录和提示"""
+        self.unanswered_count += 1
+        
+        # 输出提示
+        log_event("autonomous_sent", f"[自主消息] {self.conversation_manager.get_character_name()}: {message}",
+                  wxid=self.wxid, unanswered=self.unanswered_count)
+
+# 流式回复分段
+class SentenceChunker:
+    """把流式返回的增量文本切分成完整的句子或段落"""
+    BOUNDARY = re.compile(r'\n\s*\n|[。！？!?…～~]+[”’」』）)"\']*|\.(?=\s)|\n')
+    
+    def __init__(self, min_chars=STREAM_MIN_CHUNK_CHARS):
+        self.min_chars = min_chars
+        self.buffer = ""
+    
+    def feed(self, text):
+        """追加增量文本，返回已经完整的分段列表"""
+        self.buffer += text
+        chunks = []
+        start = 0
+        
+        for match in self.BOUNDARY.finditer(self.buffer):
+            # 边界恰好在缓冲区末尾时，后续文本可能还有标点或引号，等待下一段增量
+            if match.end() == len(self.buffer):
+                break
+            
+            # 换行/段落总是切分，句末标点只在分段足够长时切分
+            segment = self.buffer[start:match.end()].strip()
+            if len(segment) >= self.min_chars or (segment and "\n" in match.group()):
+                chunks.append(segment)
+                start = match.end()
+        
+        self.buffer = self.buffer[start:]
+        return chunks
+    
+    def flush(self):
+        """返回剩余未发送的文本"""
+        remaining = self.buffer.strip()
+        self.buffer = ""
+        return remaining
+
+def iter_stream_deltas(response):
+    """解析chat/completions的SSE响应，逐个返回增量文本"""
+    for line in response.iter_lines():
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        
+        choices = chunk.get("choices") or []
+        if choices:
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+class ReplyCancelled(Exception):
+    """回复在生成过程中被取消（例如用户又发来了新消息），partial_text为已经发出的部分"""
+    def __init__(self, partial_text=""):
+        super().__init__("回复已取消")
+        self.partial_text = partial_text
+
+class StreamInterrupted(Exception):
+    """流式回复发出一部分之后出错，partial_text为已经发出的部分"""
+    def __init__(self, error, partial_text):
+        super().__init__(str(error))
+        self.partial_text = partial_text
+
+def record_ai_usage(kind, payload, data=None, completion=None, prompt_tokens=None, conversation=None):
+    """
+    记录一次AI调用和token用量
+    :param kind: 调用类型（reply、summary、autonomous_decision等）
+    :param payload: 请求体
+    :param data: 非流式响应，带usage时使用接口返回的用量
+    :param completion: 回复文本，接口没有返回用量时用于估算
+    :param prompt_tokens: 调用方已知的提示词token数，省去重新计算
+    :param conversation: 调用所属的对话管理器，使用SQLite存储时用量写入token_usage表
+    """
+    store = conversation.store if isinstance(conversation, SqliteConversationManager) else None
+    if not METRICS_ENABLED and store is None:
+        return
+    
+    usage = (data.get("usage") if isinstance(data, dict) else None) or {}
+    estimated = usage.get("prompt_tokens") is None or usage.get("completion_tokens") is None
+    if usage.get("prompt_tokens") is not None:
+        prompt_tokens = usage["prompt_tokens"]
+    elif prompt_tokens is None:
+        prompt_tokens = sum(count_message_tokens(msg) for msg in payload.get("messages", []))
+    
+    completion_tokens = usage.get("completion_tokens")
+    if completion_tokens is None:
+        completion_tokens = count_tokens(completion or "")
+    
+    metrics.inc("ai_calls_total", kind=kind)
+    metrics.inc("ai_tokens_total", prompt_tokens, kind=kind, type="prompt")
+    metrics.inc("ai_tokens_total", completion_tokens, kind=kind, type="completion")
+    if store is not None:
+        store.record_usage(conversation.session_key, kind, prompt_tokens, completion_tokens, estimated)
+
+def stream_chat_completion(headers, payload, on_chunk, is_cancelled=None, kind="reply", prompt_tokens=None,
+                           conversation=None):
+    """
+    以流式方式调用AI接口
+    :param headers: 请求头
+    :param payload: 请求体（会被设置为stream模式）
+    :param on_chunk: 每生成一个完整句子/段落时的回调 on_chunk(text)
+    :param is_cancelled: 可选，返回True时停止生成并抛出ReplyCancelled
+    :param kind: 监控指标中的调用类型
+    :param prompt_tokens: 可选，已知的提示词token数
+    :param conversation: 可选，调用所属的对话管理器（用于记录token用量）
+    :return: 完整回复文本；已经发出部分内容后出错时抛出StreamInterrupted
+    """
+    payload = dict(payload, stream=True)
+    headers = dict(headers, Accept="text/event-stream")
+    chunker = SentenceChunker()
+    parts = []
+    sent = []
+    start_time = time.perf_counter()
+    
+    try:
+        with http_clients.stream("ai", AI_API_URL, headers=headers, json=payload) as response:
+            if response.status_code != 200:
+                response.read()
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+            
+            for delta in iter_stream_deltas(response):
+                if not parts:
+                    metrics.observe("ai_first_chunk_seconds", time.perf_counter() - start_time, kind=kind)
+                parts.append(delta)
+                for chunk in chunker.feed(delta):
+                    if is_cancelled and is_cancelled():
+                        raise ReplyCancelled("".join(sent))
+                    on_chunk(chunk)
+                    sent.append(chunk)
+    except ReplyCancelled:
+        record_ai_usage(kind, payload, completion="".join(parts), prompt_tokens=prompt_tokens,
+                        conversation=conversation)
+        raise
+    except Exception as e:
+        metrics.inc("ai_errors_total", kind=kind)
+        if sent:
+            raise StreamInterrupted(e, "".join(sent)) from e
+        raise
+    finally:
+        metrics.observe("ai_request_seconds", time.perf_counter() - start_time, kind=kind)
+    
+    record_ai_usage(kind, payload, completion="".join(parts), prompt_tokens=prompt_tokens,
+                        conversation=conversation)
+    
+    tail = chunker.flush()
+    if tail:
+        if is_cancelled and is_cancelled():
+            raise ReplyCancelled("".join(sent))
+        on_chunk(tail)
+    
+    return "".join(parts)
+
+# 对话摘要
+def summarize_conversation(messages, previous_summary, char_name, conversation=None):
+    """
+    为一段对话生成摘要
+    :param messages: 需要总结的消息列表
+    :param previous_summary: 已有的摘要（作为上下文，不重复总结）
+    :param char_name: 角色名称
+    :param conversation: 可选，摘要所属的对话管理器（用于记录token用量）
+    :return: 摘要文本，失败时返回None
+    """
+    transcript = "\n".join(
+        f"{'用户' if msg['role'] == 'user' else char_name}: {msg['content']}" for msg in messages)
+    user_prompt = f"""已有的对话摘要（仅供参考，不要重复其中内容）：
+{previous_summary or '无'}
+
+需要总结的新对话：
+{transcript}
+
+请用不超过200字总结这段新对话，保留人物关系、重要事实、约定和情绪变化。只输出摘要正文。"""
+    
+    return _request_summary("你负责为长期对话生成简洁准确的摘要。", user_prompt, conversation)
+
+def merge_summaries(previous_summary, block_summaries, conversation=None):
+    """把总摘要和若干分段摘要合并为新的总摘要，失败时返回None"""
+    parts = "\n".join(f"- {block}" for block in block_summaries)
+    user_prompt = f"""已有的总摘要：
+{previous_summary or '无'}
+
+按时间顺序排列的分段摘要：
+{parts}
+
+请把以上内容合并为一段不超过400字的总摘要，保留人物关系、重要事实、约定和情绪变化。只输出摘要正文。"""
+    
+    return _request_summary("你负责为长期对话维护一份简洁准确的总摘要。", user_prompt, conversation)
+
+def _request_summary(system_prompt, user_prompt, conversation=None):
+    """调用AI接口生成摘要"""
+    headers = {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {AI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": "gpt-4o",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "stream": False
+    }
+    
+    try:
+        with metrics.timer("ai_request_seconds", kind="summary"):
+            response = http_clients.post("ai", AI_API_URL, headers=headers, json=payload)
+            data = response.json()
+        
+        if "choices" in data and len(data["choices"]) > 0:
+            summary = data["choices"][0]["message"]["content"].strip()
+            record_ai_usage("summary", payload, data, summary, conversation=conversation)
+            return summary
+        log_event("ai_bad_response", "摘要API返回格式错误", logging.WARNING, kind="summary")
+        metrics.inc("ai_errors_total", kind="summary")
+    except Exception as e:
+        log_event("summary_error", f"生成对话摘要失败: {e}", logging.ERROR)
+        metrics.inc("ai_errors_total", kind="summary")
+    
+    return None
+
+# 回复缓存
+class ResponseCache:
+    """按角色卡、规范化的用户消息和最近几条上下文缓存AI回复，带TTL和LRU淘汰，每个键保留多个回复随机选用"""
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 variants=RESPONSE_CACHE_VARIANTS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.variants = variants
+        self.entries = OrderedDict()  # 键 -> [创建时间, 不重复的回复列表, 已生成次数]，按最近使用排序
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def normalize(text):
+        """规范化用户消息：忽略大小写、空白和标点（“在吗？”与“在吗”视为相同）"""
+        text = unicodedata.normalize("NFKC", text).strip().lower()
+        normalized = re.sub(r'[\W_]+', '', text)
+        return normalized or text
+    
+    def make_key(self, conversation_manager, user_message):
+        """生成缓存键，不适合缓存时返回None"""
+        card = conversation_manager.card
+        if card is None or len(user_message.strip()) > RESPONSE_CACHE_MAX_MESSAGE_CHARS:
+            return None
+        
+        context = [(msg["role"], msg["content"])
+                   for msg in conversation_manager.get_recent_messages(RESPONSE_CACHE_CONTEXT_MESSAGES)]
+        raw = json.dumps([card.content_hash, self.normalize(user_message), context], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """返回一个缓存的回复；回复数量还没攒够时返回None，让调用方生成新的回复"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            
+            if entry is None or entry[2] < self.variants:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+    
+    def put(self, key, response):
+        """记录一个新生成的回复"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [time.time(), [], 0]
+            entry[2] += 1
+            if response not in entry[1] and len(entry[1]) < self.variants:
+                entry[1].append(response)
+            self.entries.move_to_end(key)
+            
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+response_cache = ResponseCache()
+
+# 从AI获取回复
+def get_ai_response(user_message, conversation_manager, on_chunk=None, is_cancelled=None, group_context=None):
+    """
+    获取AI回复
+    :param user_message: 用户消息
+    :param conversation_manager: 对话管理器
+    :param on_chunk: 传入时使用流式模式，每生成一个完整句子/段落就调用一次
+    :param is_cancelled: 可选，返回True表示回复已被取代，此时不再发送剩余内容
+    :param group_context: 可选，群聊上下文，作为系统消息放在本条消息之前（不写入对话历史）
+    :return: 完整回复文本（出错时为错误提示，被取消时为None）
+    """
+    # 缓存键基于加入本条消息之前的上下文（群聊上下文每次不同，不使用缓存）
+    cache_key = response_cache.make_key(conversation_manager, user_message) \
+        if RESPONSE_CACHE_ENABLED and not group_context else None
+    
+    # 将用户消息添加到对话历史
+    conversation_manager.add_message("user", user_message)
+    
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        metrics.inc("response_cache_lookups_total", result="hit" if cached else "miss")
+        if cached:
+            if is_cancelled and is_cancelled():
+                return None
+            conversation_manager.add_message("assistant", cached)
+            if on_chunk is not None:
+                # 与流式回复一样按句子分段发送
+                chunker = SentenceChunker()
+                for chunk in chunker.feed(cached):
+                    on_chunk(chunk)
+                tail = chunker.flush()
+                if tail:
+                    on_chunk(tail)
+            return cached
+    
+    # 调用AI API
+    headers = {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {AI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": "gpt-4o",
+        "messages": conversation_manager.get_history_for_api(),
+        "stream": False
+    }
+    
+    prompt_tokens = conversation_manager.context_tokens()
+    if group_context:
+        context_message = {"role": "system", "content": group_context}
+        messages = payload["messages"]
+        messages.insert(max(i for i, msg in enumerate(messages) if msg["role"] == "user"), context_message)
+        prompt_tokens += count_message_tokens(context_message)
+    
+    try:
+        if on_chunk is not None:
+            ai_response = stream_chat_completion(headers, payload, on_chunk, is_cancelled,
+                                                 prompt_tokens=prompt_tokens, conversation=conversation_manager)
+        else:
+            with metrics.timer("ai_request_seconds", kind="reply"):
+                response = http_clients.post("ai", AI_API_URL, headers=headers, json=payload)
+                data = response.json()
+            
+            ai_response = None
+            if "choices" in data and len(data["choices"]) > 0:
+                ai_response = data["choices"][0]["message"]["content"]
+                record_ai_usage("reply", payload, data, ai_response, prompt_tokens, conversation_manager)
+            
+            if is_cancelled and is_cancelled():
+                raise ReplyCancelled()
+        
+        if ai_response:
+            # 完整回复生成后再写入对话历史
+            conversation_manager.add_message("assistant", ai_response)
+            if cache_key:
+                response_cache.put(cache_key, ai_response)
+            
+            return ai_response
+        else:
+            error_message = "AI响应格式错误"
+            log_event("ai_bad_response", error_message, logging.WARNING, kind="reply")
+            metrics.inc("ai_errors_total", kind="reply")
+            return f"抱歉，生成回复时出现问题: {error_message}"
+    except ReplyCancelled as e:
+        # 已经发给用户的部分仍然写入历史，保持与用户看到的内容一致
+        if e.partial_text:
+            conversation_manager.add_message("assistant", e.partial_text)
+        return None
+    except Exception as e:
+        error_message = str(e)
+        log_event("ai_error", f"调用AI API失败: {error_message}", logging.ERROR, kind="reply")
+        if isinstance(e, StreamInterrupted):
+            # 出错前已经发给用户的部分写入历史并标记为中断，下一轮的上下文与用户收到的内容一致
+            conversation_manager.add_message("assistant", e.partial_text + STREAM_INTERRUPTED_MARK)
+        if on_chunk is None:
+            # 流式请求的失败已在stream_chat_completion中记录
+            metrics.inc("ai_errors_total", kind="reply")
+        return f"抱歉，无法连接到AI服务: {error_message}"
+
+# 按键管理截止时间的定时器
+class DeadlineScheduler:
+    """单线程定时器：每个键只保留一个截止时间（最小堆+惰性删除），重新安排时覆盖旧的截止时间"""
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.heap = []  # (截止时间, 序号, 键)
+        self.entries = {}  # 键 -> (截止时间, 序号, 回调)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+    
+    def schedule(self, key, delay, callback):
+        """在delay秒后调用callback(key)；键已存在时替换原来的安排"""
+        with self.cond:
+            deadline = time.time() + max(delay, 0)
+            seq = next(self.counter)
+            self.entries[key] = (deadline, seq, callback)
+            heapq.heappush(self.heap, (deadline, seq, key))
+            
+            # 过期条目过多时重建堆
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [(d, q, k) for k, (d, q, _) in self.entries.items()]
+                heapq.heapify(self.heap)
+            
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+    
+    def cancel(self, key):
+        """取消键对应的安排"""
+        with self.cond:
+            self.entries.pop(key, None)
+    
+    def deadline(self, key):
+        """返回键的截止时间，未安排时返回None"""
+        entry = self.entries.get(key)
+        return entry[0] if entry else None
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _run(self):
+        """定时循环：到期后在锁外调用回调"""
+        while True:
+            with self.cond:
+                while True:
+                    # 丢弃已被取消或替换的堆顶条目
+                    while self.heap:
+                        deadline, seq, key = self.heap[0]
+                        entry = self.entries.get(key)
+                        if entry and entry[1] == seq:
+                            break
+                        heapq.heappop(self.heap)
+                    
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    
+                    wait = self.heap[0][0] - time.time()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                        continue
+                    
+                    _, _, key = heapq.heappop(self.heap)
+                    callback = self.entries.pop(key)[2]
+                    break
+            
+            try:
+                callback(key)
+            except Exception as e:
+                log_event("timer_error", f"定时任务执行出错: {e}", logging.ERROR, exc_info=True, scheduler=self.name)
+
+# 消息去重
+class MessageDeduplicator:
+    """固定TTL的去重缓存：按插入时间排序，过期条目从头部批量清理，查询和插入均摊O(1)"""
+    def __init__(self, ttl, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> 首次出现时间
+        self.lock = threading.Lock()
+    
+    def check_and_add(self, key, now=None):
+        """如果key在TTL内出现过返回True，否则记录并返回False"""
+        now = now or time.time()
+        with self.lock:
+            # 所有条目TTL相同，最早插入的条目最先过期
+            entries = self.entries
+            while entries:
+                if now - next(iter(entries.values())) < self.ttl:
+                    break
+                entries.popitem(last=False)
+            
+            if key in entries:
+                return True
+            
+            entries[key] = now
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            return False
+    
+    def __len__(self):
+        return len(self.entries)
+
+# 群聊回复门控
+class GroupRelevanceGate:
+    """
+    在调用AI之前用本地规则筛选群消息：@机器人、提到角色名称或关键词时回复，其余消息按概率回复，
+    同一个群在冷却时间内不重复回复。同时保存每个群的最近消息，回复时作为群聊上下文
+    """
+    def __init__(self, keywords=GROUP_TRIGGER_KEYWORDS, bot_names=GROUP_BOT_NAMES, probability=GROUP_REPLY_PROBABILITY,
+                 cooldown=GROUP_COOLDOWN, context_size=GROUP_CONTEXT_MESSAGES, max_rooms=GROUP_MAX_ROOMS):
+        self.keywords = [word for word in keywords if word]
+        self.bot_names = [name for name in bot_names if name]
+        self.probability = probability
+        self.cooldown = cooldown
+        self.context_size = context_size
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()  # 群ID -> {"recent": 最近消息, "last_reply": 上次回复时间}，按最近活跃排序
+        self.lock = threading.Lock()
+    
+    def _room(self, room):
+        """获取群的状态（需持有self.lock），超出数量上限时丢弃最久不活跃的群"""
+        state = self.rooms.get(room)
+        if state is None:
+            state = self.rooms[room] = {"recent": deque(maxlen=self.context_size), "last_reply": 0}
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        return state
+    
+    @staticmethod
+    def is_mentioned(data, text, own_wxid, names):
+        """消息是否@了机器人：优先读取消息来源中的@列表，其次匹配文本中的“@昵称”"""
+        if own_wxid:
+            match = re.search(r'<atuserlist>(?:<!\[CDATA\[)?([^<\]]*)', data.get('msg_source') or '')
+            if match and own_wxid in match.group(1).split(','):
+                return True
+        return any(f"@{name}" in text for name in names)
+    
+    def check(self, room, sender_id, text, data=None, own_wxid=None, char_name=None):
+        """
+        记录一条群消息并判断是否回复
+        :param char_name: 当前角色名称，和GROUP_BOT_NAMES一样用于匹配@和关键词
+        :return: (是否回复, 原因)，原因为mention、keyword、random、cooldown或ignored
+        """
+        names = self.bot_names + ([char_name] if char_name else [])
+        if self.is_mentioned(data or {}, text, own_wxid, names):
+            reason = "mention"
+        elif any(word in text for word in self.keywords + names):
+            reason = "keyword"
+        elif self.probability > 0 and random.random() < self.probability:
+            reason = "random"
+        else:
+            reason = "ignored"
+        
+        now = time.time()
+        with self.lock:
+            state = self._room(room)
+            state["recent"].append((sender_id, text))
+            if reason == "ignored":
+                return False, reason
+            # @机器人的消息总是回复，其他触发方式受冷却时间限制
+            if reason != "mention" and now - state["last_reply"] < self.cooldown:
+                return False, "cooldown"
+            state["last_reply"] = now
+            return True, reason
+    
+    def record_reply(self, room, name, text):
+        """把机器人在群里的回复加入群的最近消息"""
+        with self.lock:
+            self._room(room)["recent"].append((name, text))
+    
+    def context(self, room, sender_id):
+        """生成群聊上下文：群内最近的消息和当前发言的成员"""
+        with self.lock:
+            state = self.rooms.get(room)
+            recent = list(state["recent"]) if state else []
+        if not recent:
+            return ""
+        lines = "\n".join(f"{name}: {text}" for name, text in recent)
+        return f"你正在一个微信群中聊天。群里最近的消息：\n{lines}\n\n现在需要回复的是 {sender_id} 的消息。"
+
+# 消息处理流水线
+class MessagePipeline:
+    """同一联系人的消息按到达顺序串行处理，不同联系人的消息由多个工作线程并发处理"""
+    instances = weakref.WeakSet()  # 所有流水线，用于导出队列长度指标
+    
+    def __init__(self, workers=PIPELINE_WORKERS, name="reply"):
+        self.workers = workers
+        self.name = name
+        self.pending = {}  # key -> 待处理任务队列；键存在表示该联系人已在就绪队列中或正在处理
+        self.ready = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = False
+        MessagePipeline.instances.add(self)
+    
+    def start(self):
+        """启动工作线程"""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"pipeline-{i}")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+    
+    def stop(self):
+        """停止工作线程，丢弃尚未处理的任务"""
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            threads = self.threads
+            self.pending.clear()
+            
+            # 清空就绪队列，再为每个工作线程放入一个退出标记
+            while True:
+                try:
+                    self.ready.get_nowait()
+                except queue.Empty:
+                    break
+        
+        for _ in threads:
+            self.ready.put(None)
+        for thread in threads:
+            thread.join(timeout=1.0)
+    
+    def submit(self, key, func, *args, **kwargs):
+        """把任务加入指定联系人的队列"""
+        if not self.running:
+            self.start()
+        
+        with self.lock:
+            task = (func, args, kwargs, time.time())
+            tasks = self.pending.get(key)
+            if tasks is None:
+                self.pending[key] = deque([task])
+                self.ready.put(key)
+            else:
+                tasks.append(task)
+    
+    def queue_depth(self):
+        """当前排队中的任务总数"""
+        with self.lock:
+            return sum(len(tasks) for tasks in self.pending.values())
+    
+    def _worker(self):
+        """工作线程：每次取出一个联系人，处理其队首任务"""
+        while True:
+            key = self.ready.get()
+            if key is None:
+                break
+            
+            with self.lock:
+                tasks = self.pending.get(key)
+                if not tasks:
+                    continue
+                func, args, kwargs, queued_at = tasks.popleft()
             
-            if "choices" in data and len(data["choices"]) > 0:
-                message = data["choices"][0]["message"]["content"]
-                
-                # 添加到对话历史
-                self.conversation_manager.add_message("assistant", message)
-                
-                # 发送消息
-                send_wechat_message(self.wxid, message, self.token)
-                
-                # 输出提示
-                print(f"\n========== 自主消息 ==========")
-                print(f"{self.conversation_manager.get_character_name()}: {message}")
-                print(f"==============================\n")
+            metrics.observe("pipeline_queue_wait_seconds", time.time() - queued_at, pipeline=self.name)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                log_event("task_error", f"处理消息任务出错: {e}", logging.ERROR, exc_info=True, pipeline=self.name)
             
-            else:
-                print("生成消息API返回格式错误")
-        
+            # 还有后续消息则重新排到就绪队列末尾，保证各联系人公平轮转
+            with self.lock:
+                tasks = self.pending.get(key)
+                if tasks:
+                    self.ready.put(key)
+                elif tasks is not None:
+                    del self.pending[key]
+
+# 主动发言分析调度器
+class AutonomousScheduler:
+    """
+    集中管理所有自主系统的下次分析时间（最小堆定时器），到期的分析交给有限的工作线程执行，
+    代替每个自主系统各自轮询的线程
+    """
+    def __init__(self, workers=AUTONOMOUS_WORKERS):
+        self.timers = DeadlineScheduler(name="autonomous-timer")
+        self.pipeline = MessagePipeline(workers, name="autonomous")
+    
+    def reschedule(self, system, min_delay=0):
+        """根据自主系统当前状态重新计算下次分析时间"""
+        delay = system.next_analysis_delay(time.time())
+        if delay is None:
+            self.timers.cancel(system)
+        else:
+            self.timers.schedule(system, max(delay, min_delay), self._dispatch)
+    
+    def cancel(self, system):
+        self.timers.cancel(system)
+    
+    def scheduled_count(self):
+        """已安排分析时间的自主系统数"""
+        return len(self.timers)
+    
+    def _dispatch(self, system):
+        """分析时间到期，交给工作线程（同一自主系统的分析不会并发执行）"""
+        self.pipeline.submit(system, self._run, system)
+    
+    def _run(self, system):
+        if not system.running:
+            return
+        try:
+            system.tick()
         except Exception as e:
-            print(f"生成和发送自主消息出错: {e}")
+            log_event("autonomous_error", f"自主消息分析出错: {e}", logging.ERROR, wxid=system.wxid)
+        
+        # 分析后按新状态安排下一次；条件仍不满足时稍后再检查，避免立即重复触发
+        if system.running:
+            self.reschedule(system, min_delay=AUTONOMOUS_RECHECK_DELAY)
 
-# 从AI获取回复
-def get_ai_response(user_message, conversation_manager):
-    # 将用户消息添加到对话历史
-    conversation_manager.add_message("user", user_message)
+autonomous_scheduler = AutonomousScheduler()
+
+# 共享的WebSocket事件循环
+class WebSocketHub:
+    """
+    所有WebSocket连接共用一个线程：实现websocket-client的自定义dispatcher接口，
+    用selectors统一监听读事件，并负责定时ping和超时检测（代替每个连接各自的接收线程和ping线程）
+    """
+    def __init__(self, ping_interval=30, ping_timeout=10):
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.selector = None
+        self.callbacks = {}  # socket -> 可读时的回调
+        self.timers = []  # (到期时间, 序号, 回调, 参数)
+        self.counter = itertools.count()
+        self.watched = {}  # WebSocketApp -> (最近一次ping的时间, 断线回调)
+        self.lock = threading.RLock()  # 分发回调与注销连接互斥，避免关闭连接时仍在读取
+        self.thread = None
+        self.waker = None
+        self.wake_reader = None
     
-    # 调用AI API
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {AI_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            import selectors
+            import socket
+            self.selector = selectors.DefaultSelector()
+            self.wake_reader, self.waker = socket.socketpair()
+            self.wake_reader.setblocking(False)
+            self.selector.register(self.wake_reader, selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self._run, name="websocket-hub")
+            self.thread.daemon = True
+            self.thread.start()
     
-    payload = {
-        "model": "gpt-4o",
-        "messages": conversation_manager.get_history_for_api(),
-        "stream": False
-    }
+    def _wake(self):
+        try:
+            self.waker.send(b"\0")
+        except (OSError, AttributeError):
+            pass
     
-    try:
-        response = httpx.post(AI_API_URL, headers=headers, json=payload)
-        data = response.json()
+    # ---- websocket-client的dispatcher接口 ----
+    def signal(self, sig, func):
+        """信号只能在主线程注册，由主程序自行处理Ctrl+C"""
+    
+    def abort(self):
+        pass
+    
+    def read(self, sock, callback):
+        """注册连接的读回调（callback返回False时注销）"""
+        import selectors
+        self._ensure_started()
+        with self.lock:
+            self.callbacks[sock] = callback
+            self.selector.register(sock, selectors.EVENT_READ)
+        self._wake()
+    
+    def timeout(self, seconds, callback, *args):
+        """在seconds秒后于事件循环线程中调用callback"""
+        self._ensure_started()
+        with self.lock:
+            heapq.heappush(self.timers, (time.time() + (seconds or 0), next(self.counter), callback, args))
+        self._wake()
+    
+    def buffwrite(self, sock, data, send, handle_disconnect):
+        try:
+            send(sock, data)
+        except Exception as e:
+            handle_disconnect(e)
+    
+    # ---- 连接管理 ----
+    def watch(self, app, on_dead):
+        """对连接定时ping，超时未收到pong时关闭连接并调用on_dead(app)"""
+        with self.lock:
+            self.watched[app] = (0.0, on_dead)
+    
+    def close(self, app):
+        """注销并关闭连接（不会触发断线回调）"""
+        with self.lock:
+            self.watched.pop(app, None)
+            sock = app.sock.sock if app.sock else None
+            if sock is not None:
+                self._unregister(sock)
+        try:
+            app.close(timeout=1)
+        except Exception:
+            pass
+    
+    def connection_count(self):
+        with self.lock:
+            return len(self.callbacks)
+    
+    def _unregister(self, sock):
+        if self.callbacks.pop(sock, None) is not None:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError, OSError):
+                pass
+    
+    def _check_keepalive(self, now):
+        """发送ping并检查上一次ping是否按时收到pong"""
+        dead = []
+        with self.lock:
+            for app, (ping_time, on_dead) in list(self.watched.items()):
+                if app.sock is None or not app.keep_running:
+                    del self.watched[app]
+                    continue
+                
+                if ping_time and app.last_pong_tm < ping_time:
+                    if now - ping_time > self.ping_timeout:
+                        dead.append((app, on_dead))
+                    continue
+                
+                if now - ping_time >= self.ping_interval:
+                    try:
+                        app.sock.ping()
+                        self.watched[app] = (now, on_dead)
+                    except Exception:
+                        dead.append((app, on_dead))
         
-        if "choices" in data and len(data["choices"]) > 0:
-            ai_response = data["choices"][0]["message"]["content"]
+        for app, on_dead in dead:
+            self.close(app)
+            try:
+                on_dead(app)
+            except Exception as e:
+                log_event("ws_error", f"处理WebSocket断线出错: {e}", logging.ERROR)
+    
+    def _run(self):
+        """事件循环"""
+        next_keepalive = time.time() + 1
+        while True:
+            with self.lock:
+                wait = next_keepalive - time.time()
+                if self.timers:
+                    wait = min(wait, self.timers[0][0] - time.time())
             
-            # 将AI回复添加到对话历史
-            conversation_manager.add_message("assistant", ai_response)
+            events = self.selector.select(max(wait, 0))
             
-            return ai_response
-        else:
-            error_message = "AI响应格式错误"
-            print(error_message)
-            return f"抱歉，生成回复时出现问题: {error_message}"
-    except Exception as e:
-        error_message = str(e)
-        print(f"调用AI API失败: {error_message}")
-        return f"抱歉，无法连接到AI服务: {error_message}"
+            for key, _ in events:
+                sock = key.fileobj
+                if sock is self.wake_reader:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                
+                with self.lock:
+                    callback = self.callbacks.get(sock)
+                    if callback is None:
+                        continue
+                    try:
+                        # SSL连接可能已把多个帧读入缓冲区，需要全部处理完
+                        keep = callback()
+                        while keep and sock.fileno() != -1 and getattr(sock, "pending", lambda: 0)():
+                            keep = callback()
+                    except BlockingIOError:
+                        # 非阻塞套接字上的帧还没收完：已收到的部分留在websocket-client的帧缓冲中，下次可读时继续；
+                        # 一直收不完的连接由ping超时检测并关闭
+                        keep = True
+                    except Exception as e:
+                        log_event("ws_error", f"WebSocket读取出错: {e}", logging.ERROR)
+                        keep = False
+                    if not keep or sock.fileno() == -1:
+                        self._unregister(sock)
+            
+            now = time.time()
+            due = []
+            with self.lock:
+                while self.timers and self.timers[0][0] <= now:
+                    _, _, callback, args = heapq.heappop(self.timers)
+                    due.append((callback, args))
+            for callback, args in due:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    log_event("ws_error", f"WebSocket定时任务出错: {e}", logging.ERROR)
+            
+            if now >= next_keepalive:
+                self._check_keepalive(now)
+                next_keepalive = now + 1
+
+ws_hub = WebSocketHub()
+
+def _http_connection_gauge():
+    """各连接池的活动和空闲连接数"""
+    values = []
+    for name, item in http_clients.stats().items():
+        if "connections" in item:
+            values.append(({"pool": name, "state": "active"}, item["connections"] - item["idle_connections"]))
+            values.append(({"pool": name, "state": "idle"}, item["idle_connections"]))
+    return values
+
+def _pipeline_depth_gauge():
+    """按名称汇总各流水线排队的任务数"""
+    depths = {}
+    for pipeline in list(MessagePipeline.instances):
+        depths[pipeline.name] = depths.get(pipeline.name, 0) + pipeline.queue_depth()
+    return [({"pipeline": name}, depth) for name, depth in depths.items()]
+
+# 队列长度等仪表在导出时读取
+metrics.gauge("pipeline_queue_depth", "流水线中排队的任务数", _pipeline_depth_gauge)
+metrics.gauge("outbound_pending", "发送队列中等待发送的消息数", outbound.pending)
+metrics.gauge("autonomous_scheduled", "已安排下次分析时间的自主系统数", autonomous_scheduler.scheduled_count)
+metrics.gauge("ws_connections", "共享事件循环中的WebSocket连接数", ws_hub.connection_count)
+metrics.gauge("sessions_loaded", "内存中的会话数", lambda: sum(len(store.sessions) for store in list(SessionStore.instances)))
+metrics.gauge("session_memory_bytes", "内存中会话消息的估算字节数",
+              lambda: sum(store.total_memory for store in list(SessionStore.instances)))
+metrics.gauge("sqlite_write_queue", "等待写入SQLite的记录数",
+              lambda: sum(db.queue.qsize() for db in list(SqliteStore.instances)))
+metrics.gauge("http_connections", "各连接池的连接数", _http_connection_gauge)
+metrics.gauge("threads", "进程中的线程数", threading.active_count)
 
 # 添加微信消息监听器类
 class WeChatMessageListener:
-    def __init__(self, server_url, token, conversation_manager, ai_system=None):
+    def __init__(self, server_url, token, conversation_manager, ai_system=None, session_store=None,
+                 pipeline=None, hub=None, timers=None):
         self.server_url = server_url
         self.token = token
         self.ws = None
         self.conversation_manager = conversation_manager
+        self.session_store = session_store
+        self.owns_pipeline = pipeline is None  # 共享的流水线由创建者负责停止
+        self.pipeline = pipeline or MessagePipeline()
+        self.hub = hub or ws_hub  # WebSocket连接由共享事件循环收发
         self.ai_system = ai_system
+        self.autonomous_per_contact = False  # 为每个私聊联系人创建独立的自主系统
+        self.autonomous_systems = {}  # wxid -> AIAutonomousSystem
         self.running = False
         self.thread = None
+        self.retry_count = 0
+        self.connected_once = False  # 之后的连接建立时需要补拉断线期间的消息
+        self.own_wxid = None  # 当前账号的wxid（从收到的私聊消息中得知，用于识别补拉到的自己发出的消息）
+        self.reconnect_pending = False
+        self.watchdog_id = 0
+        self.last_frame_time = 0
         self.target_wxid = None  # 添加目标wxid属性，为None时接收所有消息
         self.debug_mode = False  # 调试模式，用于查看所有消息
-        self.processed_messages = {}  # 添加已处理消息缓存
+        self.processed_messages = MessageDeduplicator(DEDUP_TTL)  # 已处理的消息ID
+        
+        # 连发消息合并：安静期内的消息合并为一轮，新消息会取代尚未完成的回复
+        self.timers = timers if timers is not None else DeadlineScheduler(name="burst-timer")
+        self.bursts = {}  # 会话键 -> 等待合并的消息
+        self.reply_generation = {}  # 会话键 -> 收到的消息批次号
+        self.burst_lock = threading.Lock()
+        self.recent_contents = MessageDeduplicator(DEDUP_CONTENT_WINDOW)  # 没有消息ID时按内容去重
+        self.group_gate = GroupRelevanceGate()  # 群消息先经过本地规则筛选，只有需要回复的才调用AI
+        if session_store is not None:
+            session_store.evict_listeners.append(self._on_session_evicted)
         
     def set_target_wxid(self, wxid):
         """设置要监听的目标wxid"""
@@ -686,10 +3988,53 @@ class WeChatMessageListener:
         else:
             print("已设置监听所有微信号的消息")
             
+    def get_autonomous_system(self, wxid):
+        """获取（首次收到消息时创建并启动）联系人对应的自主系统，在处理该联系人消息的流水线工作线程中调用"""
+        ai_system = self.autonomous_systems.get(wxid)
+        if ai_system is None:
+            if not self.session_store or not self.session_store.card:
+                return None
+            ai_system = AIAutonomousSystem(self.token, None, session_store=self.session_store)
+            ai_system.listener = self
+            ai_system.wxid = wxid
+            self.autonomous_systems[wxid] = ai_system
+            ai_system.start(immediate=False)
+        return ai_system
+    
+    def _on_session_evicted(self, key):
+        """
+        会话移出内存时，只删除在用户回复之前不会再分析的自主系统（下次收到消息时重新创建）；
+        仍在等待分析的保留定时器，到期时通过会话存储重新加载会话（闲置的联系人正是主动发言的对象）
+        """
+        ai_system = self.autonomous_systems.get(key)
+        if ai_system is None or ai_system.next_analysis_delay(time.time()) is not None:
+            return
+        self.autonomous_systems.pop(key, None)
+        if ai_system.running:
+            ai_system.stop()
+    
+    def stop_autonomous(self):
+        """停止所有联系人的自主系统"""
+        for ai_system in list(self.autonomous_systems.values()):
+            if ai_system.running:
+                ai_system.stop()
+    
+    def get_conversation(self, wxid, chatroom=None, pin=False):
+        """获取联系人对应的对话管理器（pin=True时固定会话，用完后调用release_conversation）"""
+        if self.session_store:
+            return self.session_store.get(wxid, chatroom, pin=pin)
+        return self.conversation_manager
+    
+    def release_conversation(self, wxid, chatroom=None):
+        """结束使用固定的会话"""
+        if self.session_store:
+            self.session_store.release(wxid, chatroom)
+    
     def set_debug_mode(self, enabled=True):
-        """设置调试模式，开启后会显示所有收到的WebSocket消息"""
+        """设置调试模式，开启后按采样率保存收到的原始消息帧，并写入日志文件"""
         self.debug_mode = enabled
-        print(f"调试模式: {'开启' if enabled else '关闭'}")
+        set_debug_logging(enabled)
+        print(f"调试模式: {'开启' if enabled else '关闭'} (采样比例: {frame_capture.sample_rate})")
         
     def start(self):
         """启动WebSocket监听"""
@@ -698,9 +4043,13 @@ class WeChatMessageListener:
             return False
             
         self.running = True
-        self.thread = threading.Thread(target=self._connect_websocket)
-        self.thread.daemon = True
-        self.thread.start()
+        self.retry_count = 0
+        self.pipeline.start()
+        self._connect_async()
+        
+        # 启动看门狗（重新启动时旧的看门狗会自行退出）
+        self.watchdog_id += 1
+        self.hub.timeout(WS_WATCHDOG_INTERVAL, self._watchdog, self.watchdog_id)
         return True
         
     def stop(self):
@@ -710,85 +4059,153 @@ class WeChatMessageListener:
             
         self.running = False
         if self.ws:
-            self.ws.close()
+            self.hub.close(self.ws)
         
         if self.thread:
             self.thread.join(timeout=1.0)
-        print("已停止消息监听")
+        if self.owns_pipeline:
+            self.pipeline.stop()
+        log_event("listener_stopped", "已停止消息监听")
+    
+    def _connect_async(self):
+        """在临时线程中建立连接（握手期间不阻塞共享事件循环）"""
+        self.thread = threading.Thread(target=self._connect_websocket)
+        self.thread.daemon = True
+        self.thread.start()
     
     def _connect_websocket(self):
-        """连接WebSocket"""
+        """连接WebSocket，连接成功后交给共享事件循环接收消息"""
+        self.reconnect_pending = False
+        if not self.running:
+            return
+        
         # 修改WebSocket路径，添加/ws/前缀
         ws_url = f"{self.server_url.replace('http://', 'ws://')}/ws/GetSyncMsg?key={self.token}"
-        print(f"正在连接WebSocket: {ws_url}")
+        log_event("ws_connecting", f"正在连接WebSocket: {self.server_url}/ws/GetSyncMsg")
         
-        # 配置WebSocket
+        # 配置WebSocket（每次连接使用新的WebSocketApp，避免沿用上次连接的状态）
         websocket.enableTrace(False)
-        self.ws = websocket.WebSocketApp(
+        ws = websocket.WebSocketApp(
             ws_url,
             on_message=self._on_message,
             on_error=self._on_error,
             on_close=self._on_close,
             on_open=self._on_open
         )
+        self.ws = ws
         
-        # 最大重试次数
-        max_retries = 5
-        retry_count = 0
+        try:
+            # 使用自定义dispatcher时，run_forever在握手完成并注册到事件循环后立即返回
+            ws.run_forever(dispatcher=self.hub, reconnect=0)
+        except Exception as e:
+            log_event("ws_error", f"WebSocket连接异常: {e}", logging.ERROR)
+            self._schedule_reconnect(ws)
+            return
         
-        while self.running and retry_count < max_retries:
-            try:
-                # 运行WebSocket客户端
-                self.ws.run_forever(ping_interval=30, ping_timeout=10)
-                
-                # 如果WebSocket关闭但程序仍在运行，则尝试重连
-                if self.running:
-                    retry_count += 1
-                    print(f"WebSocket连接断开，尝试重连... (尝试 {retry_count}/{max_retries})")
-                    time.sleep(5)
-                else:
-                    break
-            except Exception as e:
-                retry_count += 1
-                print(f"WebSocket连接异常: {e}，尝试重连... (尝试 {retry_count}/{max_retries})")
-                time.sleep(5)
+        if ws.keep_running and ws.sock:
+            self.hub.watch(ws, self._schedule_reconnect)
+    
+    def _schedule_reconnect(self, ws):
+        """连接断开后稍后重连（只处理当前连接的断开），不限次数，等待时间指数增长并加入随机抖动"""
+        if not self.running or ws is not self.ws or self.reconnect_pending:
+            return
+        
+        self.reconnect_pending = True
+        self.retry_count += 1
+        metrics.inc("ws_reconnects_total")
+        delay = min(WS_RECONNECT_BASE_DELAY * (2 ** (self.retry_count - 1)), WS_RECONNECT_MAX_DELAY)
+        # 抖动避免大量账号在服务恢复时同时重连
+        delay = random.uniform(delay / 2, delay)
+        
+        log_event("ws_reconnect_scheduled", f"WebSocket连接断开，{delay:.1f}秒后重连... (第{self.retry_count}次)", logging.WARNING,
+                  delay=round(delay, 1), attempt=self.retry_count)
+        self.hub.timeout(delay, self._connect_async)
+    
+    def _watchdog(self, watchdog_id):
+        """定期检查连接：已断开但没有安排重连，或长时间收不到任何数据时重新连接"""
+        if not self.running or watchdog_id != self.watchdog_id:
+            return
+        
+        try:
+            ws = self.ws
+            connecting = self.thread is not None and self.thread.is_alive()
+            if ws is not None and not self.reconnect_pending and not connecting:
+                if not self.is_connected():
+                    log_event("ws_watchdog", "看门狗: WebSocket连接已断开，重新连接", logging.WARNING, reason="disconnected")
+                    self._schedule_reconnect(ws)
+                elif time.time() - max(self.last_frame_time, ws.last_pong_tm) > WS_STALE_TIMEOUT:
+                    log_event("ws_watchdog", f"看门狗: 超过{WS_STALE_TIMEOUT}秒未收到数据，重新连接", logging.WARNING, reason="stale")
+                    self.hub.close(ws)
+                    self._schedule_reconnect(ws)
+        finally:
+            self.hub.timeout(WS_WATCHDOG_INTERVAL, self._watchdog, watchdog_id)
+    
+    def _catch_up(self):
+        """通过HTTP同步接口补拉断线期间的消息，去重后按正常流程处理"""
+        total = 0
+        for _ in range(WS_CATCHUP_MAX_ROUNDS):
+            messages = fetch_sync_messages(self.token)
+            if not messages:
+                break
+            
+            messages.sort(key=lambda msg: msg.get('create_time') or 0)
+            for data in messages:
+                if self._handle_message(data):
+                    total += 1
         
-        if retry_count >= max_retries and self.running:
-            print("WebSocket连接失败，已达到最大重试次数。请检查网络或服务器状态。")
-            print("提示: 您可以继续使用其他功能，或尝试重新启动程序。")
+        if total:
+            log_event("ws_caught_up", f"已补拉断线期间的 {total} 条消息", count=total)
+            metrics.inc("messages_caught_up_total", total)
     
     def _on_message(self, ws, message):
         """处理收到的消息"""
+        self.last_frame_time = time.time()
+        
+        # 调试模式下按采样率保存原始帧，不重新序列化，也不在接收线程中输出
+        if self.debug_mode and frame_capture.capture(message, account=self.token[:8]):
+            logger.debug("收到WebSocket消息: %s", message, extra={"event": "ws_frame", "fields": {}})
+        
         try:
             # 解析消息
             data = json.loads(message)
-            
-            # 调试模式下打印所有消息
-            if self.debug_mode:
-                print(f"[DEBUG] 收到WebSocket消息: {json.dumps(data, ensure_ascii=False, indent=2)}")
-            
+        except json.JSONDecodeError:
+            log_event("ws_bad_frame", "收到无效的JSON数据", logging.WARNING, frame=message[:200])
+            return
+        
+        with metrics.timer("ws_message_handle_seconds"):
+            self._handle_message(data)
+    
+    def _handle_message(self, data):
+        """
+        处理一条消息（来自WebSocket推送或HTTP补拉）
+        :return: 是否作为新消息进入了处理流程
+        """
+        try:
             # 获取消息发送者ID
             from_wxid = data.get('from_user_name', {}).get('str', '')
             
             # 立即检查是否是目标wxid的消息，如果设置了target_wxid且消息不是来自目标，直接返回
             if self.target_wxid and from_wxid != self.target_wxid:
                 # 完全静默处理，不显示任何提示，就像这条消息从未收到过一样
-                return
+                return False
                 
             # 判断消息类型和方向
             to_wxid = data.get('to_user_name', {}).get('str', '')
-            is_sent_by_self = data.get('is_self_msg', 0) == 1
+            is_sent_by_self = data.get('is_self_msg', 0) == 1 or (self.own_wxid and from_wxid == self.own_wxid)
+            # 只有WebSocket推送带有is_self_msg标记，据此可靠地得知当前账号的wxid
+            if 'is_self_msg' in data and not is_sent_by_self and to_wxid and '@chatroom' not in from_wxid:
+                self.own_wxid = to_wxid
             
             # 过滤自己发送的消息和特殊账号
             if (from_wxid.startswith('gh_') or 
                 from_wxid == 'weixin' or 
                 from_wxid == to_wxid or
                 is_sent_by_self):
-                return
+                return False
                 
             content = data.get('content', {}).get('str', '')
             if not content:  # 添加对空内容的检查
-                return
+                return False
             
             # 处理群消息
             if '@chatroom' in from_wxid:
@@ -798,69 +4215,222 @@ class WeChatMessageListener:
                     sender_id = parts[0]
                     message_text = parts[1].strip()
                 else:
-                    return
+                    return False
+                session_key = SessionStore.session_key(sender_id, chatroom=from_wxid)
             else:
                 # 私聊消息
+                sender_id = from_wxid
                 message_text = content
+                session_key = SessionStore.session_key(from_wxid)
             
-            # 添加消息去重逻辑
-            # 使用消息内容和发送者作为唯一标识
-            msg_id = f"{from_wxid}:{message_text}"
-            current_time = time.time()
-            
-            # 检查是否已处理过这条消息(5秒内的相同消息视为重复)
-            if msg_id in self.processed_messages:
-                last_time = self.processed_messages[msg_id]
-                if current_time - last_time < 5:  # 5秒内的相同消息不重复处理
-                    return
-            
-            # 记录这条消息已被处理
-            self.processed_messages[msg_id] = current_time
+            # 消息去重
+            if self.is_duplicate(data, from_wxid, message_text):
+                metrics.inc("dedup_hits_total")
+                return False
+            metrics.inc("messages_received_total", chat="group" if '@chatroom' in from_wxid else "private")
             
-            # 清理过期的消息记录(保留最近10分钟内的)
-            self.processed_messages = {k: v for k, v in self.processed_messages.items() 
-                                    if current_time - v < 600}
+            # 群消息只有@机器人、命中关键词或按概率选中时才回复，其余只记入群聊上下文
+            if '@chatroom' in from_wxid:
+                if not GROUP_REPLY_ENABLED:
+                    return False
+                card = self.session_store.card if self.session_store else getattr(self.conversation_manager, "card", None)
+                should_reply, reason = self.group_gate.check(from_wxid, sender_id, message_text, data,
+                                                             self.own_wxid or to_wxid, card.name if card else None)
+                metrics.inc("group_messages_total", result=reason)
+                if not should_reply:
+                    log_event("group_message_skipped", f"群消息 [{from_wxid}] {sender_id}: {message_text}（不回复: {reason}）",
+                              logging.DEBUG, wxid=from_wxid, sender=sender_id, reason=reason)
+                    return True
             
-            # 记录用户活动
-            if self.ai_system:
+            # 记录用户活动（每个联系人的自主系统在流水线工作线程中创建，见_process_message）
+            if not self.autonomous_per_contact and self.ai_system:
                 self.ai_system.record_user_activity()
                 # 直接设置ai_system的wxid属性
                 self.ai_system.wxid = from_wxid
             
-            # 处理消息并生成回复
-            print(f"\n收到消息 [{from_wxid}]: {message_text}")
+            log_event("message_received", f"收到消息 [{from_wxid}]: {message_text}", wxid=from_wxid, session=session_key,
+                      chars=len(message_text))
+            
+            # 接收线程只负责解析和入队，生成与发送回复交给流水线（同一联系人按顺序处理）
+            self._add_to_burst(session_key, from_wxid, sender_id, message_text)
+            return True
+            
+        except Exception as e:
+            log_event("message_error", f"处理收到的消息出错: {e}", logging.ERROR, exc_info=True)
+            return False
+    
+    def is_duplicate(self, data, from_wxid, message_text):
+        """判断消息是否已处理过：优先使用服务器消息ID，没有ID时按发送者+内容短时间去重"""
+        server_msg_id = data.get('new_msg_id') or data.get('msg_id')
+        if server_msg_id:
+            return self.processed_messages.check_and_add(str(server_msg_id))
+        return self.recent_contents.check_and_add(f"{from_wxid}:{message_text}")
+    
+    def _add_to_burst(self, session_key, from_wxid, sender_id, message_text):
+        """把消息放入联系人的合并缓冲区，安静期结束后再一起处理"""
+        with self.burst_lock:
+            # 新消息到达，正在生成或排队中的旧回复都会被取代
+            generation = self.reply_generation.get(session_key, 0) + 1
+            self.reply_generation[session_key] = generation
+            
+            now = time.time()
+            if BURST_QUIET_PERIOD <= 0:
+                self.pipeline.submit((self.token, session_key), self._process_message, from_wxid, sender_id,
+                                     message_text, session_key, generation, now)
+                return
+            
+            burst = self.bursts.get(session_key)
+            if burst is None:
+                burst = {"from_wxid": from_wxid, "sender_id": sender_id, "messages": [], "first_time": now}
+                self.bursts[session_key] = burst
+            burst["messages"].append(message_text)
+            
+            delay = min(BURST_QUIET_PERIOD, burst["first_time"] + BURST_MAX_WAIT - now)
+            # 定时器和流水线可能被多个账号共享，键中带上账号token
+            self.timers.schedule((self.token, session_key), delay, self._flush_burst)
+    
+    def _flush_burst(self, timer_key):
+        """安静期结束，把缓冲的消息合并为一轮对话交给流水线"""
+        session_key = timer_key[1]
+        with self.burst_lock:
+            burst = self.bursts.pop(session_key, None)
+            if not burst:
+                return
+            generation = self.reply_generation.get(session_key, 0)
+        
+        message_text = "\n".join(burst["messages"])
+        if len(burst["messages"]) > 1:
+            log_event("burst_merged", f"已合并 [{burst['from_wxid']}] 的{len(burst['messages'])}条连续消息",
+                      wxid=burst["from_wxid"], count=len(burst["messages"]))
+        metrics.observe("burst_wait_seconds", time.time() - burst["first_time"])
+        
+        self.pipeline.submit(timer_key, self._process_message, burst["from_wxid"], burst["sender_id"],
+                             message_text, session_key, generation, burst["first_time"])
+    
+    def _process_message(self, from_wxid, sender_id, message_text, session_key=None, generation=None,
+                         received_at=None):
+        """在流水线工作线程中生成并发送回复（received_at为收到消息的时间，用于统计回复延迟）"""
+        received_at = received_at or time.time()
+        first_sent = []
+        
+        def finish(result):
+            """记录本轮回复的结果和总耗时"""
+            metrics.inc("replies_total", result=result)
+            metrics.observe("reply_total_seconds", time.time() - received_at)
+        
+        def on_sent():
+            if not first_sent:
+                first_sent.append(True)
+                metrics.observe("reply_first_send_seconds", time.time() - received_at)
+        
+        # 群聊按群+发送者区分对话历史，另外附带群内所有成员的最近消息
+        group_context = None
+        if '@chatroom' in from_wxid:
+            wxid, chatroom = sender_id, from_wxid
+            group_context = self.group_gate.context(from_wxid, sender_id)
+        else:
+            wxid, chatroom = from_wxid, None
+        
+        # 生成回复期间固定会话，避免耗时的AI请求期间会话被换出内存
+        conversation_manager = self.get_conversation(wxid, chatroom, pin=True)
+        try:
+            if self.autonomous_per_contact and chatroom is None:
+                ai_system = self.get_autonomous_system(from_wxid)
+                if ai_system:
+                    ai_system.record_user_activity()
+            
+            def is_superseded():
+                """用户在回复完成前又发来了新消息"""
+                return generation is not None and self.reply_generation.get(session_key) != generation
+            
+            # 排队期间已有更新的消息，只记录用户消息，由下一轮统一回复
+            if is_superseded():
+                conversation_manager.add_message("user", message_text)
+                log_event("reply_superseded", f"[{from_wxid}] 有更新的消息，本轮不单独回复", wxid=from_wxid)
+                finish("superseded")
+                return
             
-            # 添加时间戳和消息来源标记，以区分不同消息
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{timestamp}] 开始处理消息...")
+            log_event("reply_started", f"开始处理消息 [{from_wxid}]...", wxid=from_wxid,
+                      waited=round(time.time() - received_at, 3))
             
-            ai_response = get_ai_response(message_text, self.conversation_manager)
+            if STREAM_REPLIES:
+                # 流式模式：每生成一个完整句子/段落就立即发送
+                sent_chunks = []
+                
+                def send_chunk(chunk):
+                    sent_chunks.append(chunk)
+                    if send_wechat_message(from_wxid, chunk, self.token):
+                        on_sent()
+                    else:
+                        log_event("reply_send_failed", "分段回复发送失败，请检查网络和token是否有效", logging.ERROR, wxid=from_wxid)
+                
+                with metrics.timer("reply_generate_seconds", stream="true"):
+                    ai_response = get_ai_response(message_text, conversation_manager, on_chunk=send_chunk,
+                                                  is_cancelled=is_superseded, group_context=group_context)
+                if ai_response is None:
+                    log_event("reply_cancelled", f"[{from_wxid}] 回复生成中收到新消息，已停止本轮回复", wxid=from_wxid)
+                    finish("cancelled")
+                    return
+                if group_context is not None:
+                    self.group_gate.record_reply(from_wxid, conversation_manager.get_character_name(), ai_response)
+                if sent_chunks:
+                    log_event("reply_done", f"发送回复 -> [{from_wxid}]: {ai_response} (分{len(sent_chunks)}条发送)", wxid=from_wxid,
+                              chunks=len(sent_chunks), elapsed=round(time.time() - received_at, 3))
+                    finish("sent" if first_sent else "failed")
+                    return
+            else:
+                with metrics.timer("reply_generate_seconds", stream="false"):
+                    ai_response = get_ai_response(message_text, conversation_manager, is_cancelled=is_superseded,
+                                                  group_context=group_context)
+                if ai_response is None:
+                    log_event("reply_cancelled", f"[{from_wxid}] 回复生成中收到新消息，已丢弃本轮回复", wxid=from_wxid)
+                    finish("cancelled")
+                    return
+                if group_context is not None:
+                    self.group_gate.record_reply(from_wxid, conversation_manager.get_character_name(), ai_response)
             
             # 发送回复
             success = send_wechat_message(from_wxid, ai_response, self.token)
             if success:
-                print(f"发送回复 -> [{from_wxid}]: {ai_response}\n")
+                on_sent()
+                log_event("reply_done", f"发送回复 -> [{from_wxid}]: {ai_response}", wxid=from_wxid, chunks=1,
+                          elapsed=round(time.time() - received_at, 3))
             else:
-                print(f"回复发送失败，请检查网络和token是否有效\n")
-            
-        except json.JSONDecodeError:
-            print("收到无效的JSON数据")
-        except Exception as e:
-            print(f"处理收到的消息出错: {e}")
-            import traceback
-            traceback.print_exc()
+                log_event("reply_send_failed", "回复发送失败，请检查网络和token是否有效", logging.ERROR, wxid=from_wxid)
+            finish("sent" if success else "failed")
+        finally:
+            self.release_conversation(wxid, chatroom)
+            self._finish_generation(session_key, generation)
+    
+    def _finish_generation(self, session_key, generation):
+        """最新一批消息处理完后删除批次号，避免联系人越来越多时字典无限增长"""
+        if generation is None:
+            return
+        with self.burst_lock:
+            if self.reply_generation.get(session_key) == generation and session_key not in self.bursts:
+                del self.reply_generation[session_key]
     
     def _on_error(self, ws, error):
         """处理WebSocket错误"""
-        print(f"WebSocket错误: {error}")
+        log_event("ws_error", f"WebSocket错误: {error}", logging.ERROR)
     
     def _on_close(self, ws, close_status_code, close_msg):
         """处理WebSocket关闭"""
-        print(f"WebSocket连接关闭: {close_status_code} {close_msg}")
+        log_event("ws_closed", f"WebSocket连接关闭: {close_status_code} {close_msg}", logging.WARNING, code=close_status_code)
+        self._schedule_reconnect(ws)
     
     def _on_open(self, ws):
         """处理WebSocket连接建立"""
-        print("WebSocket连接已建立，开始接收消息")
+        self.retry_count = 0
+        self.last_frame_time = time.time()
+        # 共享事件循环中的套接字不能阻塞：帧没收完时立即返回，等下次可读时继续（见WebSocketHub._run）
+        ws.sock.settimeout(0)
+        log_event("ws_connected", "WebSocket连接已建立，开始接收消息", reconnect=self.connected_once)
+        
+        # 重连成功后在后台补拉断线期间的消息
+        if self.connected_once:
+            threading.Thread(target=self._catch_up, daemon=True).start()
+        self.connected_once = True
 
     def is_connected(self):
         """检查WebSocket连接状态"""
@@ -872,22 +4442,53 @@ class WeChatMessageListener:
 
     def reconnect(self):
         """强制重新连接WebSocket"""
-        print("正在尝试重新连接WebSocket...")
+        log_event("ws_reconnect", "正在尝试重新连接WebSocket...")
         if self.ws:
-            try:
-                self.ws.close()
-            except:
-                pass
+            self.hub.close(self.ws)
         
-        # 重新启动连接线程
+        # 等待上一次连接尝试结束后重新连接
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=1.0)
         
-        self.thread = threading.Thread(target=self._connect_websocket)
-        self.thread.daemon = True
-        self.thread.start()
+        self.retry_count = 0
+        self.reconnect_pending = False
+        self._connect_async()
         return True
 
+# 通过HTTP同步接口拉取消息
+def normalize_sync_message(msg):
+    """把HttpSyncMsg返回的消息（字段为驼峰命名）转换为与WebSocket推送相同的格式"""
+    data = {}
+    for key, value in msg.items():
+        name = re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', key).lower()
+        if isinstance(value, dict) and 'string' in value and 'str' not in value:
+            value = {'str': value['string']}
+        elif name in ('from_user_name', 'to_user_name', 'content') and isinstance(value, str):
+            value = {'str': value}
+        data[name] = value
+    return data
+
+def fetch_sync_messages(token):
+    """
+    调用/message/HttpSyncMsg拉取尚未同步的新消息
+    :return: 与WebSocket推送格式相同的消息列表，出错时返回空列表
+    """
+    url = f"{SERVER_URL}/message/HttpSyncMsg?key={token}"
+    try:
+        response = http_clients.post("wechat", url, json={"Count": 0})
+        data = response.json()
+        if data.get("Code") != 200:
+            log_event("sync_error", f"同步消息失败: {data.get('Text')}", logging.WARNING)
+            return []
+        
+        payload = data.get("Data") or []
+        if isinstance(payload, dict):
+            payload = payload.get("AddMsgs") or payload.get("List") or []
+        return [normalize_sync_message(msg) for msg in payload if isinstance(msg, dict)]
+    except Exception as e:
+        log_event("sync_error", f"同步消息异常: {e}", logging.ERROR)
+        return []
+
 # 添加根据微信号查找wxid的功能
 def find_wxid_by_wechat_account(token, wechat_account):
     """根据微信号查找wxid"""
@@ -902,7 +4503,7 @@ def find_wxid_by_wechat_account(token, wechat_account):
             "UserName": wechat_account
         }
         
-        response = httpx.post(url, headers=headers, json=payload)
+        response = http_clients.post("wechat", url, headers=headers, json=payload)
         
         try:
             data = response.json()
@@ -921,11 +4522,242 @@ def find_wxid_by_wechat_account(token, wechat_account):
     print(f"未找到微信号 {wechat_account} 对应的wxid")
     return None
 
+# 多账号托管
+class AccountManager:
+    """
+    在同一进程中托管多个微信账号：账号从配置文件读取，
+    所有账号共用WebSocket事件循环、HTTP连接池、发送调度器、消息流水线和定时器，
+    线程数与账号数量无关，内存随活跃会话增长（每个账号的会话按需加载、闲置换出）
+    """
+    def __init__(self, accounts_file=ACCOUNTS_FILE, card_library=None):
+        self.accounts_file = accounts_file
+        self.card_library = card_library or CharacterCardLibrary()
+        self.accounts = OrderedDict()  # 账号名 -> 账号信息
+        self.pipeline = MessagePipeline(PIPELINE_WORKERS)
+        self.timers = DeadlineScheduler(name="burst-timer")
+        # 所有账号共用一个数据库和写线程，各账号的会话键带账号前缀
+        self.db = SqliteStore(os.path.join(SESSION_DIR, SQLITE_DB_FILE)) if STORAGE_BACKEND == "sqlite" else None
+        self.running = False
+    
+    @staticmethod
+    def load_config(accounts_file):
+        """
+        读取账号配置，格式为账号列表（或 {"accounts": [...]}），每项包含：
+        token（必填）、name（账号名，默认取token前8位）、target（只监听并主动联系的微信号或wxid，留空监听所有人）、card（角色卡路径）
+        """
+        with open(accounts_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        if isinstance(data, dict):
+            data = data.get("accounts", [])
+        
+        accounts = []
+        for item in data:
+            if not item.get("token"):
+                print(f"跳过缺少token的账号配置: {item}")
+                continue
+            accounts.append(item)
+        return accounts
+    
+    def add_account(self, config, account_count=1):
+        """创建账号的会话存储、监听器和自主系统"""
+        token = config["token"]
+        name = config.get("name") or token[:8]
+        
+        # 每个账号的会话存放在独立目录（JSON历史和迁移来源），数据库共用；内存上限在所有账号之间分配
+        safe_name = re.sub(r'[^\w@.-]', '_', name)
+        session_store = SessionStore(
+            session_dir=os.path.join(SESSION_DIR, safe_name),
+            max_loaded=max(SESSION_MAX_LOADED // account_count, 10),
+            max_memory=max(SESSION_MAX_MEMORY // account_count, 1024 * 1024),
+            db=self.db, account=safe_name
+        )
+        
+        target = config.get("target") or None
+        if target and not (target.startswith("wxid_") or target == "filehelper"):
+            target = find_wxid_by_wechat_account(token, target) or target
+        
+        listener = WeChatMessageListener(SERVER_URL, token, None, None, session_store=session_store,
+                                         pipeline=self.pipeline, timers=self.timers)
+        listener.set_target_wxid(target)
+        
+        # 设置了target的账号只对该联系人主动发言，否则按配置为每个私聊联系人分别判断
+        ai_system = None
+        if target:
+            ai_system = AIAutonomousSystem(token, None, session_store=session_store)
+            ai_system.listener = listener
+            ai_system.wxid = target
+            listener.ai_system = ai_system
+        else:
+            listener.autonomous_per_contact = AUTONOMOUS_PER_CONTACT
+        
+        card_path = config.get("card")
+        if not card_path:
+            card_path = next((p for p in ("角色卡.json", "character.json", "default.json") if os.path.exists(p)), None)
+        if card_path:
+            character_card = self.card_library.load(card_path)
+            if character_card:
+                session_store.set_character(character_card)
+        
+        self.accounts[name] = {
+            "name": name,
+            "token": token,
+            "target": target,
+            "session_store": session_store,
+            "listener": listener,
+            "ai_system": ai_system
+        }
+        return self.accounts[name]
+    
+    def start(self):
+        """读取配置并启动所有账号"""
+        configs = self.load_config(self.accounts_file)
+        if not configs:
+            print(f"账号配置文件 {self.accounts_file} 中没有可用账号")
+            return False
+        
+        self.card_library.scan()
+        for config in configs:
+            self.add_account(config, len(configs))
+        
+        self.running = True
+        self.pipeline.start()
+        for account in self.accounts.values():
+            account["listener"].start()
+            if account["ai_system"] and account["session_store"].card:
+                account["ai_system"].start(immediate=False)
+        
+        print(f"已启动 {len(self.accounts)} 个账号")
+        return True
+    
+    def status(self):
+        """返回各账号的运行状态"""
+        result = []
+        for name, account in self.accounts.items():
+            result.append({
+                "name": name,
+                "target": account["target"] or "所有人",
+                "connected": bool(account["listener"].is_connected()),
+                "sessions": len(account["session_store"].sessions),
+                "character": account["session_store"].card.name if account["session_store"].card else None,
+                "autonomous": (1 if account["ai_system"] and account["ai_system"].running else
+                               sum(1 for a in account["listener"].autonomous_systems.values() if a.running))
+            })
+        return result
+    
+    def stop(self):
+        """停止所有账号并保存会话"""
+        self.running = False
+        for account in self.accounts.values():
+            if account["ai_system"] and account["ai_system"].running:
+                account["ai_system"].stop()
+            account["listener"].stop_autonomous()
+            account["listener"].stop()
+        self.pipeline.stop()
+        for account in self.accounts.values():
+            account["session_store"].flush_all()
+        outbound.flush()
+        http_clients.close()
+
+def print_pool_stats():
+    """打印连接池和发送队列状态"""
+    pool_stats = http_clients.stats()
+    if not pool_stats:
+        print("尚未发起任何HTTP请求")
+    for name, item in pool_stats.items():
+        print(f"[{name}] 请求: {item['requests']}, 失败: {item['errors']}, "
+              f"平均耗时: {item['avg_latency']:.3f}秒, "
+              f"连接: {item.get('connections', '-')} (空闲 {item.get('idle_connections', '-')})")
+    send_stats = outbound.stats()
+    print(f"[发送队列] 批次: {send_stats['batches']}, 成功: {send_stats['sent']}, "
+          f"失败: {send_stats['failed']}, 重试: {send_stats['retries']}, 排队: {send_stats['pending']}")
+    if RESPONSE_CACHE_ENABLED:
+        cache_stats = response_cache.stats()
+        print(f"[回复缓存] 条目: {cache_stats['entries']}, 命中: {cache_stats['hits']}, 未命中: {cache_stats['misses']}")
+    
+    # 多账号共用一个数据库，按数据库而不是按会话存储统计
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    for db in list(SqliteStore.instances):
+        db_stats = db.stats()
+        tokens = sum((prompt or 0) + (completion or 0) for _, _, prompt, completion in db.token_usage(today))
+        print(f"[数据库 {db.path}] 已写入: {db_stats['committed']}, 事务: {db_stats['batches']}, "
+              f"重试: {db_stats['retries']}, 丢弃: {db_stats['errors']}, 排队: {db_stats['queued']}, 今日token: {tokens}")
+    
+    # 各阶段平均耗时，定位回复慢的原因
+    stages = [("消息排队", "pipeline_queue_wait_seconds"), ("生成回复", "reply_generate_seconds"),
+              ("AI首段", "ai_first_chunk_seconds"), ("写入历史", "history_journal_seconds"),
+              ("发送排队", "outbound_queue_wait_seconds"), ("发送请求", "wechat_send_seconds"),
+              ("首条回复", "reply_first_send_seconds")]
+    parts = []
+    for label, name in stages:
+        count = total = 0
+        for item_count, item_total in metrics.histogram_stats(name).values():
+            count += item_count
+            total += item_total
+        if count:
+            parts.append(f"{label} {total / count * 1000:.0f}ms")
+    if parts:
+        print(f"[阶段耗时] {', '.join(parts)}")
+
+def dump_debug_frames():
+    """导出调试模式下保存的最近原始消息帧"""
+    if not frame_capture.frames:
+        print("没有保存的消息帧（开启调试模式后，收到的消息会按采样比例保存）")
+        return
+    try:
+        path, count = frame_capture.dump()
+        print(f"已导出最近的 {count} 个消息帧到 {path} (共收到 {frame_capture.seen} 帧，保存 {frame_capture.captured} 帧)")
+    except OSError as e:
+        print(f"导出消息帧失败: {e}")
+
+def run_accounts(accounts_file=ACCOUNTS_FILE):
+    """多账号模式主循环"""
+    manager = AccountManager(accounts_file)
+    if not manager.start():
+        return
+    start_metrics_server()
+    
+    while True:
+        print("\n==== 微信AI助手（多账号） ====")
+        print("1. 查看账号状态")
+        print("2. 查看连接池状态")
+        print("3. 开启/关闭调试模式")
+        print("4. 导出最近的原始消息帧")
+        print("0. 退出程序")
+        print("=============================")
+        choice = input("请选择操作 (0-4): ")
+        
+        if choice == "1":
+            for item in manager.status():
+                print(f"[{item['name']}] 目标: {item['target']}, 连接: {'正常' if item['connected'] else '断开'}, "
+                      f"角色: {item['character'] or '未加载'}, 内存中会话: {item['sessions']}, "
+                      f"主动发言对象: {item['autonomous']}")
+            print(f"WebSocket连接数: {ws_hub.connection_count()}, 排队任务: {manager.pipeline.queue_depth()}, "
+                  f"待分析: {autonomous_scheduler.scheduled_count()}")
+        elif choice == "2":
+            print_pool_stats()
+        elif choice == "3":
+            enabled = not any(account["listener"].debug_mode for account in manager.accounts.values())
+            for account in manager.accounts.values():
+                account["listener"].set_debug_mode(enabled)
+        elif choice == "4":
+            dump_debug_frames()
+        elif choice == "0":
+            print("正在退出程序...")
+            manager.stop()
+            break
+        else:
+            print("无效选择，请重新输入")
+
 # 修改主菜单，简化选项
 def show_menu():
     """显示简化后的主菜单"""
     print("\n==== 微信AI助手 ====")
     print("1. 加载/更换角色卡")
+    print("2. 查看连接池状态")
+    print("3. 从角色卡库切换角色")
+    print("4. 开启/关闭调试模式")
+    print("5. 导出最近的原始消息帧")
     print("0. 退出程序")
     print("===================")
 
@@ -935,11 +4767,18 @@ if __name__ == "__main__":
     print("=" * 50)
     print("微信AI助手 - 启动中...")
     print("=" * 50)
+    setup_logging()
+    
+    # 存在账号配置文件时以多账号模式运行
+    if os.path.exists(ACCOUNTS_FILE):
+        print(f"发现账号配置文件 {ACCOUNTS_FILE}，以多账号模式启动")
+        run_accounts(ACCOUNTS_FILE)
+        sys.exit(0)
     
     token = input("请输入微信token: ")
     
-    # 初始化对话管理器
-    conversation_manager = ConversationManager()
+    # 初始化会话存储（每个联系人独立的对话历史）
+    session_store = SessionStore()
     
     # 提示输入监听目标
     target_input = input("请输入要监听的微信号或wxid: ")
@@ -963,15 +4802,18 @@ if __name__ == "__main__":
             print(f"警告: 未找到微信号 {target_input} 对应的wxid，将使用原始输入作为wxid")
             target_wxid = target_input
     
+    # 旧版本的单文件对话历史迁移为目标联系人的会话
+    session_store.import_legacy_history("conversation_history.json", target_wxid)
+    
     # 初始化消息监听器
-    listener = WeChatMessageListener(SERVER_URL, token, conversation_manager, None)
+    listener = WeChatMessageListener(SERVER_URL, token, None, None, session_store=session_store)
     
     # 设置监听目标
     listener.set_target_wxid(target_wxid)
     print(f"已设置消息接收和发送目标: {target_wxid}")
     
     # 初始化AI自主系统并设置关联
-    ai_system = AIAutonomousSystem(token, conversation_manager)
+    ai_system = AIAutonomousSystem(token, None, session_store=session_store)
     ai_system.listener = listener  # 添加对listener的引用
     ai_system.wxid = target_wxid  # 设置AI系统发送目标
     listener.ai_system = ai_system  # 关联AI系统到监听器
@@ -979,6 +4821,13 @@ if __name__ == "__main__":
     # 自动启动监听器
     listener.start()
     print("已自动启动消息监听器")
+    start_metrics_server()
+    
+    # 扫描角色卡库（只解析新增或修改过的文件）
+    card_library = CharacterCardLibrary()
+    updated, removed = card_library.scan()
+    if card_library.index:
+        print(f"角色卡库: 共{len(card_library.list_cards())}张可用角色卡 (更新 {updated}, 移除 {removed})")
     
     # 自动加载默认角色卡(如果存在)
     default_card_paths = ["角色卡.json", "character.json", "default.json"]
@@ -987,8 +4836,8 @@ if __name__ == "__main__":
     for card_path in default_card_paths:
         if os.path.exists(card_path):
             print(f"发现默认角色卡: {card_path}，正在加载...")
-            character_data = load_character_card(card_path)
-            if character_data and conversation_manager.set_character(character_data):
+            character_card = card_library.load(card_path)
+            if character_card and session_store.set_character(character_card):
                 print("默认角色卡加载成功，自动启动AI自主系统")
                 ai_system.start()
                 loaded_default = True
@@ -997,18 +4846,34 @@ if __name__ == "__main__":
     # 主循环
     while True:
         show_menu()
-        choice = input("请选择操作 (0-1): ")
+        choice = input("请选择操作 (0-5): ")
         
-        if choice == "1":
-            # 加载角色卡
-            file_path = input("请输入角色卡文件路径 (PNG或JSON): ")
-            if not file_path:
-                print("未输入文件路径，操作取消")
-                continue
+        if choice in ("1", "3"):
+            if choice == "1":
+                # 加载角色卡
+                file_path = input("请输入角色卡文件路径 (PNG或JSON): ")
+                if not file_path:
+                    print("未输入文件路径，操作取消")
+                    continue
+            else:
+                # 从角色卡库中选择
+                card_library.scan()
+                cards = card_library.list_cards()
+                if not cards:
+                    print(f"角色卡库为空，请把角色卡放入目录: {CARD_LIBRARY_DIR}")
+                    continue
+                for i, (path, entry) in enumerate(cards, 1):
+                    tags = f" [{', '.join(entry['tags'][:3])}]" if entry.get("tags") else ""
+                    print(f"{i}. {entry['name']} (V{entry['version']}){tags} - {path}")
                 
-            character_data = load_character_card(file_path)
-            if character_data:
-                if conversation_manager.set_character(character_data):
+                file_path = card_library.find(input("请输入序号或角色名称: ").strip())
+                if not file_path:
+                    print("未找到对应的角色卡，操作取消")
+                    continue
+            
+            character_card = card_library.load(file_path)
+            if character_card:
+                if session_store.set_character(character_card):
                     print("角色卡加载成功，自动启动AI自主系统")
                     # 如果AI系统还未启动，启动它
                     if not ai_system.running:
@@ -1017,12 +4882,25 @@ if __name__ == "__main__":
                         # 已经启动，只需触发立即分析
                         ai_system.analyze_now()
             
+        elif choice == "2":
+            # 查看连接池状态
+            print_pool_stats()
+            
+        elif choice == "4":
+            listener.set_debug_mode(not listener.debug_mode)
+            
+        elif choice == "5":
+            dump_debug_frames()
+            
         elif choice == "0":
             # 退出程序
             print("正在退出程序...")
             ai_system.stop()
             if listener:
                 listener.stop()
+            session_store.flush_all()
+            outbound.flush()
+            http_clients.close()
             break
             
         else:
@@ -0,0 +1,195 @@
+"""
+本地模拟的OpenAI兼容接口 /v1/chat/completions（仅用于压力测试，只依赖标准库）
+
+支持普通与流式（SSE）回复、结构化输出（response_format），响应延迟按指定分布随机生成。
+
+单独运行: python benchmark/fake_openai_server.py --port 8060 --latency-dist lognormal --latency 0.8
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_REPLIES = [
+    "在的在的，刚刚在忙，怎么啦？",
+    "早呀！今天天气不错，你吃早饭了吗？",
+    "哈哈，你这么说我都不知道怎么接了。不过我挺喜欢和你聊天的。",
+    "嗯……让我想想。其实我也遇到过类似的事情，当时也挺纠结的。",
+    "好呀，那就这么说定了！到时候别放我鸽子哦。",
+]
+
+# 延迟分布
+class LatencyModel:
+    """
+    按分布生成延迟秒数
+    :param dist: fixed / uniform / normal / lognormal
+    :param mean: 平均延迟
+    :param spread: uniform为上下浮动范围，normal为标准差，lognormal为对数标准差
+    """
+    def __init__(self, dist="lognormal", mean=0.8, spread=0.5):
+        self.dist = dist
+        self.mean = mean
+        self.spread = spread
+    
+    def sample(self):
+        if self.mean <= 0:
+            return 0.0
+        if self.dist == "fixed":
+            return self.mean
+        if self.dist == "uniform":
+            return max(0.0, random.uniform(self.mean - self.spread, self.mean + self.spread))
+        if self.dist == "normal":
+            return max(0.0, random.gauss(self.mean, self.spread))
+        # 对数正态分布：调整mu使期望等于mean，长尾更接近真实的大模型延迟
+        mu = math.log(self.mean) - self.spread ** 2 / 2
+        return random.lognormvariate(mu, self.spread)
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_POST(self):
+        if not self.path.startswith("/v1/chat/completions"):
+            self.send_error(404)
+            return
+        
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_error(400)
+            return
+        
+        server = self.server
+        server.record_request(request)
+        content = server.make_reply(request)
+        
+        # 首个token之前的延迟
+        time.sleep(server.latency.sample())
+        
+        if request.get("stream"):
+            self._send_stream(content)
+        else:
+            body = json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)}
+            }, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    def _send_stream(self, content):
+        """以SSE分块返回，每块之间按chunk_delay等待"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        
+        def write_event(data):
+            payload = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+        
+        size = self.server.chunk_chars
+        try:
+            for i in range(0, len(content), size):
+                delta = {"choices": [{"index": 0, "delta": {"content": content[i:i + size]}}]}
+                write_event(json.dumps(delta, ensure_ascii=False))
+                if self.server.chunk_delay:
+                    time.sleep(self.server.chunk_delay)
+            
+            write_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 机器人取消被取代的回复时会提前断开流式连接
+            self.close_connection = True
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    模拟的OpenAI兼容服务
+    :param latency: 首个token前的延迟分布（LatencyModel）
+    :param chunk_delay: 流式回复中每块之间的延迟秒数
+    :param speak_probability: 结构化输出（主动发言判断）中返回shouldSendMessage=true的概率
+    """
+    daemon_threads = True
+    
+    def __init__(self, host="127.0.0.1", port=0, latency=None, chunk_delay=0.02, chunk_chars=4,
+                 speak_probability=0.3):
+        super().__init__((host, port), FakeOpenAIHandler)
+        self.latency = latency or LatencyModel()
+        self.chunk_delay = chunk_delay
+        self.chunk_chars = chunk_chars
+        self.speak_probability = speak_probability
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "stream": 0, "structured": 0}
+    
+    def handle_error(self, request, client_address):
+        # 测试结束时机器人关闭连接池，空闲的keep-alive连接被重置属于正常情况
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+    
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+    
+    def start(self):
+        """在后台线程中运行服务"""
+        thread = threading.Thread(target=self.serve_forever, name="fake-openai")
+        thread.daemon = True
+        thread.start()
+        return self
+    
+    def record_request(self, request):
+        with self.lock:
+            self.stats["requests"] += 1
+            if request.get("stream"):
+                self.stats["stream"] += 1
+            if request.get("response_format"):
+                self.stats["structured"] += 1
+    
+    def make_reply(self, request):
+        """生成回复内容：结构化输出请求返回符合主动发言判断格式的JSON，其余返回随机的示例回复"""
+        if request.get("response_format"):
+            should_send = random.random() < self.speak_probability
+            return json.dumps({
+                "shouldSendMessage": should_send,
+                "reason": "模拟判断",
+                "messageType": "问候" if should_send else "",
+                "message": random.choice(SAMPLE_REPLIES) if should_send else ""
+            }, ensure_ascii=False)
+        return random.choice(SAMPLE_REPLIES)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8060)
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "normal", "lognormal"])
+    parser.add_argument("--latency", type=float, default=0.8, help="首个token前的平均延迟秒数")
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式回复每块之间的延迟秒数")
+    parser.add_argument("--speak-probability", type=float, default=0.3)
+    args = parser.parse_args()
+    
+    server = FakeOpenAIServer(args.host, args.port,
+                              latency=LatencyModel(args.latency_dist, args.latency, args.latency_spread),
+                              chunk_delay=args.chunk_delay, speak_probability=args.speak_probability)
+    print(f"模拟AI接口已启动: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,300 @@
+"""
+本地模拟的WeChatPadPro服务（仅用于压力测试，只依赖标准库）
+
+提供机器人用到的接口：
+- /ws/GetSyncMsg       WebSocket消息推送
+- /message/SendTextMessage  发送文本消息（支持MsgItem批量）
+- /message/HttpSyncMsg      拉取WebSocket断开期间未推送的消息
+- /friend/SearchContact     根据微信号查找wxid
+
+单独运行: python benchmark/fake_wechat_server.py --port 8059
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# 服务端的WebSocket连接
+class WebSocketConnection:
+    def __init__(self, handler, token):
+        self.handler = handler
+        self.token = token
+        self.send_lock = threading.Lock()
+        self.closed = False
+    
+    @staticmethod
+    def encode_frame(opcode, payload):
+        """编码一个未分片、不带掩码的帧"""
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack(">H", length)
+        else:
+            header += bytes([127]) + struct.pack(">Q", length)
+        return header + payload
+    
+    def send_frame(self, opcode, payload):
+        """发送一个帧，连接已关闭时返回False"""
+        frame = self.encode_frame(opcode, payload)
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                self.handler.wfile.write(frame)
+                self.handler.wfile.flush()
+                return True
+            except (OSError, ValueError):
+                self.closed = True
+                return False
+    
+    def send_json(self, data):
+        return self.send_frame(0x1, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    
+    def read_frame(self):
+        """读取一个客户端帧，连接断开时返回(None, None)"""
+        rfile = self.handler.rfile
+        head = rfile.read(2)
+        if len(head) < 2:
+            return None, None
+        
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", rfile.read(8))[0]
+        
+        mask = rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+        data = rfile.read(length)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        return opcode, payload
+    
+    def close(self):
+        """主动断开连接（用于模拟服务端故障）"""
+        # 在同一个锁内标记关闭并发出关闭帧，之后推送的消息一定会进入积压队列，不会写在关闭帧之后
+        with self.send_lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.handler.wfile.write(self.encode_frame(0x8, struct.pack(">H", 1001)))
+                self.handler.wfile.flush()
+            except (OSError, ValueError):
+                # 客户端已经断开，处理线程关闭了wfile
+                pass
+        try:
+            self.handler.connection.shutdown(2)
+        except OSError:
+            pass
+
+class FakeWeChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _token(self):
+        return parse_qs(urlparse(self.path).query).get("key", [""])[0]
+    
+    def _send_json(self, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        if urlparse(self.path).path != "/ws/GetSyncMsg":
+            self.send_error(404)
+            return
+        
+        # WebSocket握手
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        
+        conn = WebSocketConnection(self, self._token())
+        self.server.add_connection(conn)
+        try:
+            while not conn.closed:
+                opcode, payload = conn.read_frame()
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    conn.send_frame(0xA, payload)
+        except (OSError, struct.error):
+            pass
+        finally:
+            self.server.remove_connection(conn)
+            self.close_connection = True
+    
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            payload = {}
+        
+        path = urlparse(self.path).path
+        if path == "/message/SendTextMessage":
+            self._send_json(self.server.handle_send(self._token(), payload.get("MsgItem", [])))
+        elif path == "/message/HttpSyncMsg":
+            self._send_json({"Code": 200, "Data": {"AddMsgs": self.server.take_pending(self._token())}})
+        elif path == "/friend/SearchContact":
+            account = payload.get("UserName", "")
+            wxid = self.server.contacts.get(account) or (account if account.startswith("wxid_") else f"wxid_{account}")
+            self._send_json({"Code": 200, "Data": {"user_name": {"str": wxid}}})
+        else:
+            self._send_json({"Code": 404, "Text": f"未模拟的接口: {path}"})
+
+class FakeWeChatServer(ThreadingHTTPServer):
+    """
+    模拟的WeChatPadPro服务
+    :param send_fail_rate: SendTextMessage中每条消息随机失败的概率
+    :param on_send: 每发送一条消息时的回调 on_send(token, to_user, text)
+    """
+    daemon_threads = True
+    
+    def __init__(self, host="127.0.0.1", port=0, bot_wxid="wxid_bot", send_fail_rate=0.0, on_send=None):
+        super().__init__((host, port), FakeWeChatHandler)
+        self.bot_wxid = bot_wxid
+        self.send_fail_rate = send_fail_rate
+        self.on_send = on_send
+        self.contacts = {}  # 微信号 -> wxid
+        self.connections = {}  # token -> 连接列表
+        self.pending = {}  # token -> 没有连接时积压的消息（HttpSyncMsg格式）
+        self.msg_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = {"pushed": 0, "sent": 0, "send_failed": 0, "batches": 0}
+    
+    def handle_error(self, request, client_address):
+        # 测试结束时机器人关闭连接池，空闲的keep-alive连接被重置属于正常情况
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+    
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def start(self):
+        """在后台线程中运行服务"""
+        thread = threading.Thread(target=self.serve_forever, name="fake-wechat")
+        thread.daemon = True
+        thread.start()
+        return self
+    
+    def add_connection(self, conn):
+        with self.lock:
+            self.connections.setdefault(conn.token, []).append(conn)
+    
+    def remove_connection(self, conn):
+        with self.lock:
+            conns = self.connections.get(conn.token, [])
+            if conn in conns:
+                conns.remove(conn)
+    
+    def connection_count(self, token=None):
+        with self.lock:
+            if token is not None:
+                return len(self.connections.get(token, []))
+            return sum(len(conns) for conns in self.connections.values())
+    
+    def push_message(self, token, from_wxid, text, to_wxid=None):
+        """向机器人推送一条收到的文本消息；没有连接时积压，等待HttpSyncMsg拉取"""
+        msg_id = next(self.msg_ids)
+        now = int(time.time())
+        to_wxid = to_wxid or self.bot_wxid
+        message = {
+            "msg_id": msg_id,
+            "new_msg_id": 10 ** 12 + msg_id,
+            "from_user_name": {"str": from_wxid},
+            "to_user_name": {"str": to_wxid},
+            "msg_type": 1,
+            "content": {"str": text},
+            "create_time": now,
+            "is_self_msg": 0
+        }
+        
+        with self.lock:
+            self.stats["pushed"] += 1
+            conns = list(self.connections.get(token, []))
+        
+        if any([conn.send_json(message) for conn in conns]):
+            return msg_id
+        
+        with self.lock:
+            self.pending.setdefault(token, []).append({
+                "MsgId": msg_id,
+                "NewMsgId": message["new_msg_id"],
+                "FromUserName": {"string": from_wxid},
+                "ToUserName": {"string": to_wxid},
+                "MsgType": 1,
+                "Content": {"string": text},
+                "CreateTime": now
+            })
+        return msg_id
+    
+    def take_pending(self, token):
+        with self.lock:
+            return self.pending.pop(token, [])
+    
+    def drop_connections(self, token=None):
+        """断开WebSocket连接，模拟服务端抖动"""
+        with self.lock:
+            conns = [conn for t, items in self.connections.items() if token is None or t == token for conn in items]
+        for conn in conns:
+            conn.close()
+    
+    def handle_send(self, token, items):
+        results = []
+        for item in items:
+            success = random.random() >= self.send_fail_rate
+            results.append({
+                "isSendSuccess": success,
+                "errMsg": "" if success else "模拟发送失败",
+                "toUserName": item.get("ToUserName")
+            })
+            
+            with self.lock:
+                self.stats["sent" if success else "send_failed"] += 1
+            if success and self.on_send:
+                self.on_send(token, item.get("ToUserName"), item.get("TextContent", ""))
+        
+        with self.lock:
+            self.stats["batches"] += 1
+        return {"Code": 200, "Data": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的WeChatPadPro服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8059)
+    parser.add_argument("--send-fail-rate", type=float, default=0.0, help="每条消息随机发送失败的概率")
+    args = parser.parse_args()
+    
+    server = FakeWeChatServer(args.host, args.port, send_fail_rate=args.send_fail_rate,
+                              on_send=lambda token, to_user, text: print(f"[{token}] -> {to_user}: {text}"))
+    print(f"模拟WeChatPadPro服务已启动: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
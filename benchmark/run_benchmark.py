@@ -0,0 +1,260 @@
+"""
+端到端压力测试：启动本地模拟的WeChatPadPro服务和AI接口，让N个模拟联系人与机器人对话，
+统计消息吞吐量、回复延迟（收到消息到发出第一条回复）和内存占用
+
+示例:
+    python benchmark/run_benchmark.py --contacts 200 --messages 5 --latency 0.8
+    python benchmark/run_benchmark.py --contacts 50 --autonomous --drop-every 10
+"""
+import argparse
+import heapq
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from fake_openai_server import FakeOpenAIServer, LatencyModel
+from fake_wechat_server import FakeWeChatServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_MODULE = "AI微信主动聊天机器人"
+
+SAMPLE_MESSAGES = ["在吗", "早安", "今天好累啊", "你在干嘛呢？", "[微笑]", "晚上一起吃饭吗", "哈哈哈哈", "晚安"]
+
+def percentile(values, p):
+    """返回第p百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+def peak_rss_mb():
+    """进程的峰值常驻内存（MB），无法获取时返回None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS上单位是字节，Linux上是KB
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        return None
+
+def print_stage_breakdown(registry):
+    """按机器人记录的耗时直方图打印各阶段的平均耗时"""
+    stages = [
+        ("WebSocket消息处理", "ws_message_handle_seconds"),
+        ("连发合并等待", "burst_wait_seconds"),
+        ("流水线排队", "pipeline_queue_wait_seconds"),
+        ("AI首段文本", "ai_first_chunk_seconds"),
+        ("AI请求", "ai_request_seconds"),
+        ("写入历史日志", "history_journal_seconds"),
+        ("发送队列等待", "outbound_queue_wait_seconds"),
+        ("SendTextMessage", "wechat_send_seconds"),
+        ("生成回复（含发送）", "reply_generate_seconds"),
+    ]
+    print("各阶段平均耗时:")
+    for label, name in stages:
+        for labels, (count, total) in sorted(registry.histogram_stats(name).items()):
+            if not count:
+                continue
+            suffix = f" {dict(labels)}" if labels else ""
+            print(f"  {label}{suffix}: {total / count * 1000:.1f}ms（{count}次）")
+
+# 模拟联系人
+class ContactSimulator:
+    """每个联系人发送一条消息，收到回复后等待think_time再发送下一条，直到发完指定条数"""
+    def __init__(self, wechat, token, contacts, messages, think_time):
+        self.wechat = wechat
+        self.token = token
+        self.contacts = [f"wxid_bench_{i:05d}" for i in range(contacts)]
+        self.messages = messages
+        self.think_time = think_time
+        self.sent_count = {wxid: 0 for wxid in self.contacts}
+        self.waiting_since = {}  # wxid -> 发出消息的时间（等待回复中）
+        self.latencies = []
+        self.replies = 0
+        self.outbound = 0
+        self.events = []  # (时间, wxid)，下一条消息的发送时间
+        self.cond = threading.Condition()
+    
+    def on_send(self, token, to_user, text):
+        """模拟服务收到机器人发出的消息"""
+        now = time.time()
+        with self.cond:
+            self.outbound += 1
+            sent_time = self.waiting_since.pop(to_user, None)
+            if sent_time is None:
+                # 没有待回复的消息：流式回复的后续分段，或主动发言
+                return
+            self.latencies.append(now - sent_time)
+            self.replies += 1
+            if self.sent_count[to_user] < self.messages:
+                heapq.heappush(self.events, (now + self.think_time, to_user))
+            self.cond.notify()
+    
+    def finished(self):
+        return (not self.waiting_since and not self.events and
+                all(count >= self.messages for count in self.sent_count.values()))
+    
+    def run(self, timeout, ramp_up=1.0):
+        """驱动所有联系人发送消息，返回是否在超时前全部收到回复"""
+        start = time.time()
+        with self.cond:
+            # 首条消息在ramp_up秒内均匀发出，避免所有联系人同一瞬间发送
+            for i, wxid in enumerate(self.contacts):
+                heapq.heappush(self.events, (start + ramp_up * i / max(len(self.contacts), 1), wxid))
+        
+        while time.time() - start < timeout:
+            with self.cond:
+                if self.finished():
+                    return True
+                now = time.time()
+                if not self.events or self.events[0][0] > now:
+                    wait = self.events[0][0] - now if self.events else 0.5
+                    self.cond.wait(min(wait, 0.5))
+                    continue
+                _, wxid = heapq.heappop(self.events)
+                index = self.sent_count[wxid]
+                self.sent_count[wxid] += 1
+                self.waiting_since[wxid] = time.time()
+            
+            text = SAMPLE_MESSAGES[index % len(SAMPLE_MESSAGES)]
+            self.wechat.push_message(self.token, wxid, text)
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="微信AI助手端到端压力测试")
+    parser.add_argument("--contacts", type=int, default=100, help="模拟联系人数")
+    parser.add_argument("--messages", type=int, default=5, help="每个联系人发送的消息数")
+    parser.add_argument("--think-time", type=float, default=0.5, help="收到回复后等待多少秒再发下一条")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="首条消息在多少秒内陆续发出")
+    parser.add_argument("--timeout", type=float, default=300, help="测试最长秒数")
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "normal", "lognormal"])
+    parser.add_argument("--latency", type=float, default=0.8, help="AI接口首个token前的平均延迟秒数")
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式回复每块之间的延迟秒数")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式回复")
+    parser.add_argument("--workers", type=int, default=None, help="生成回复的工作线程数（默认使用PIPELINE_WORKERS）")
+    parser.add_argument("--burst-quiet", type=float, default=0.3, help="连发消息合并的安静期秒数（0表示不合并）")
+    parser.add_argument("--keep-rate-limit", action="store_true", help="保留发送限速（默认关闭以测量处理能力）")
+    parser.add_argument("--send-fail-rate", type=float, default=0.0, help="模拟发送失败的概率")
+    parser.add_argument("--autonomous", action="store_true", help="为每个联系人启用主动发言分析")
+    parser.add_argument("--autonomous-idle", type=float, default=5, help="主动发言分析前的最短闲置秒数")
+    parser.add_argument("--drop-every", type=float, default=0, help="每隔多少秒断开一次WebSocket连接（0表示不断开）")
+    parser.add_argument("--storage", default=None, choices=["sqlite", "json"],
+                        help="对话历史的存储方式（默认使用STORAGE_BACKEND）")
+    parser.add_argument("--card", default=os.path.join(REPO_DIR, "露西.json"), help="使用的角色卡")
+    parser.add_argument("--metrics-port", type=int, default=0, help="测试期间在该端口提供机器人的/metrics接口（0表示不启动）")
+    parser.add_argument("--verbose", action="store_true", help="显示机器人的运行日志")
+    args = parser.parse_args()
+    
+    token = "benchmark"
+    openai = FakeOpenAIServer(latency=LatencyModel(args.latency_dist, args.latency, args.latency_spread),
+                              chunk_delay=args.chunk_delay).start()
+    wechat = FakeWeChatServer(send_fail_rate=args.send_fail_rate).start()
+    simulator = ContactSimulator(wechat, token, args.contacts, args.messages, args.think_time)
+    wechat.on_send = simulator.on_send
+    
+    # 导入机器人模块并指向本地模拟服务
+    sys.path.insert(0, REPO_DIR)
+    bot = importlib.import_module(BOT_MODULE)
+    bot.SERVER_URL = wechat.url
+    bot.AI_API_URL = openai.url
+    bot.AI_API_KEY = "benchmark"
+    bot.STREAM_REPLIES = not args.no_stream
+    bot.BURST_QUIET_PERIOD = args.burst_quiet
+    bot.AUTONOMOUS_MIN_IDLE = args.autonomous_idle
+    if args.verbose:
+        bot.setup_logging(log_file=None)
+    else:
+        # 机器人每条消息都会输出日志，测试时屏蔽以免影响结果
+        bot.print = lambda *a, **k: None
+        bot.logger.disabled = True
+    if not args.keep_rate_limit:
+        bot.OUTBOUND_CONTACT_RATE = bot.OUTBOUND_ACCOUNT_RATE = 1e6
+        bot.OUTBOUND_CONTACT_BURST = bot.OUTBOUND_ACCOUNT_BURST = 1e6
+        bot.OUTBOUND_BATCH_SIZE = 100
+    
+    session_dir = tempfile.mkdtemp(prefix="wechat-bench-")
+    try:
+        session_store = bot.SessionStore(session_dir=session_dir, backend=args.storage or bot.STORAGE_BACKEND)
+        character_card = bot.load_character_card(args.card)
+        if not character_card or not session_store.set_character(character_card):
+            print(f"角色卡加载失败: {args.card}")
+            return
+        
+        pipeline = bot.MessagePipeline(args.workers or bot.PIPELINE_WORKERS)
+        listener = bot.WeChatMessageListener(wechat.url, token, None, session_store=session_store,
+                                             pipeline=pipeline)
+        listener.autonomous_per_contact = args.autonomous
+        listener.start()
+        if args.metrics_port:
+            bot.start_metrics_server(port=args.metrics_port)
+        
+        deadline = time.time() + 10
+        while not listener.is_connected() and time.time() < deadline:
+            time.sleep(0.05)
+        if not listener.is_connected():
+            print("无法连接模拟的WebSocket服务")
+            return
+        
+        # 定期断开连接，检验重连和补拉
+        stop_dropping = threading.Event()
+        if args.drop_every > 0:
+            def drop_loop():
+                while not stop_dropping.wait(args.drop_every):
+                    wechat.drop_connections(token)
+            threading.Thread(target=drop_loop, daemon=True).start()
+        
+        # 运行期间采样线程数
+        peak_threads = [threading.active_count()]
+        
+        def sample_threads():
+            while not stop_dropping.wait(0.5):
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+        threading.Thread(target=sample_threads, daemon=True).start()
+        
+        print(f"开始测试: {args.contacts}个联系人 x {args.messages}条消息，"
+              f"AI延迟 {args.latency_dist}({args.latency}s)，工作线程: {pipeline.workers}，流式回复: {bot.STREAM_REPLIES}")
+        start = time.time()
+        completed = simulator.run(args.timeout, args.ramp_up)
+        duration = time.time() - start
+        stop_dropping.set()
+        
+        inbound = sum(simulator.sent_count.values())
+        print("\n==== 测试结果 ====")
+        print(f"完成: {'是' if completed else '否（超时）'}，耗时 {duration:.2f} 秒")
+        print(f"收到消息: {inbound}，已回复: {simulator.replies}，未回复: {len(simulator.waiting_since)}")
+        print(f"吞吐量: {simulator.replies / duration:.1f} 条消息/秒")
+        print(f"回复延迟: p50 {percentile(simulator.latencies, 50) * 1000:.0f}ms, "
+              f"p90 {percentile(simulator.latencies, 90) * 1000:.0f}ms, "
+              f"p99 {percentile(simulator.latencies, 99) * 1000:.0f}ms, "
+              f"max {max(simulator.latencies, default=0) * 1000:.0f}ms")
+        print(f"发出消息: {simulator.outbound}（SendTextMessage请求 {wechat.stats['batches']} 次，"
+              f"失败 {wechat.stats['send_failed']} 条）")
+        print(f"AI请求: {openai.stats['requests']}（流式 {openai.stats['stream']}，"
+              f"主动发言判断 {openai.stats['structured']}）")
+        rss = peak_rss_mb()
+        print(f"峰值内存: {f'{rss:.1f} MB' if rss is not None else '无法获取'}，"
+              f"峰值线程数: {peak_threads[0]}，内存中会话: {len(session_store.sessions)}")
+        print_stage_breakdown(bot.metrics)
+        
+        if args.autonomous:
+            listener.stop_autonomous()
+        listener.stop()
+        session_store.flush_all()
+    finally:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        openai.shutdown()
+        wechat.shutdown()
+
+if __name__ == "__main__":
+    main()